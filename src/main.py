@@ -6,7 +6,11 @@ import sys
 import utime
 import xbee
 import micropython
+from micropython import const
 import gc
+from array import array
+
+BOOT_TICKS = utime.ticks_ms()
 
 
 ###############################################################
@@ -14,12 +18,72 @@ import gc
 ###############################################################
 
 NAME = "XBee P1"
-DEBUG = False
-
-# Always publish data, not just on change
+# manufacturer code of the P1 data cluster and the manufacturer specific
+# attributes. WARNING: 0x1234 is a placeholder, not a registered code. Replace
+# it with the code assigned to you by the Connectivity Standards Alliance
+# before the device joins a network that other manufacturers' devices use
+MANUFACTURER_CODE = 0x1234
+# 1 prints debug messages, with 0 they are left out when compiling
+DEBUG = const(0)
+# 1 records events and the time spent per phase, see trace_dump()
+TRACE = const(0)
+# number of events kept by the trace
+TRACE_SIZE = 64
+
+# Always publish data every CYCLE_TIME, not just on change, unless the
+# coordinator configures reporting for an attribute
 ALWAYS_PUBLISH = True
-# perform p1 read + send every N seceonds
+# every telegram is read, attributes are reported at most every N seconds
+# unless the coordinator configures reporting for an attribute
 CYCLE_TIME = 15
+# attributes that do not change (multipliers, divisors, units, status) are
+# reported after a join, when read and every STATIC_REFRESH seconds
+STATIC_REFRESH = 3600
+# maximum time in ms to receive a complete telegram once it started
+P1_TIMEOUT = 1500
+# maximum telegram size, DSMR5 telegrams are around 1kb
+P1_BUFFER_SIZE = 2048
+# maximum number of lines in a telegram
+P1_MAX_LINES = 64
+# automatic garbage collection after allocating 1/N of the free heap, normally
+# the heap is collected right after the reports are sent
+GC_FRACTION = 2
+# remembers faults that caused a reset, for the diagnostics cluster
+FAULT_FILE = "fault.txt"
+# while not joined or when reports fail the energy and gas counters are kept
+# every BACKLOG_INTERVAL seconds, at most BACKLOG_SIZE records
+BACKLOG_SIZE = 96
+BACKLOG_INTERVAL = 300
+# ms between backlog frames after a rejoin
+BACKLOG_DELAY = 1000
+# keep the backlog on the XBee filesystem across resets, rewritten every
+# BACKLOG_SAVE records and once it is sent, None keeps it in ram
+BACKLOG_FILE = None
+BACKLOG_SAVE = 3
+# every HISTORY_INTERVAL seconds the average phase powers and the energy and
+# gas used are kept as a sample, at most HISTORY_SIZE samples of 16 bytes. The
+# coordinator can download a time range, a frame every HISTORY_DELAY ms
+HISTORY_SIZE = 180
+HISTORY_INTERVAL = 60
+HISTORY_DELAY = 100
+# keep the history on the XBee filesystem, rewritten every HISTORY_SAVE
+# samples, None keeps it in ram
+HISTORY_FILE = None
+HISTORY_SAVE = 15
+# 1 also sends the complete telegram, as changes to the previous one, at most
+# every PASSTHROUGH_INTERVAL seconds and in full every PASSTHROUGH_KEYFRAME
+PASSTHROUGH = const(0)
+PASSTHROUGH_INTERVAL = 10
+PASSTHROUGH_KEYFRAME = 30
+# reports ask the coordinator for a default response, without one in
+# LINK_TIMEOUT ms a report counts as lost. When more than LINK_LOSS percent
+# is lost or the responses take longer than LINK_RTT ms on average, the
+# reporting intervals double, up to LINK_BACKOFF times, and they shrink back
+# once the link recovers
+LINK_TIMEOUT = 10000
+LINK_LOSS = 10
+LINK_RTT = 1000
+LINK_BACKOFF = 8
 
 # Pin definitions
 repl_button = machine.Pin(machine.Pin.board.D5, machine.Pin.IN, machine.Pin.PULL_UP)
@@ -35,35 +99,32 @@ RTS = machine.Pin(machine.Pin.board.D9, machine.Pin.OUT)
 TESTDATA = b""
 #TESTDATA = b"""/ISk5\\2MT382-1000\r\n\r\n1-3:0.2.8(50)\r\n0-0:1.0.0(170102192002W)\r\n0-0:96.1.1(4B384547303034303436333935353037)\r\n1-0:1.8.1(000004.426*kWh)\r\n1-0:1.8.2(000002.399*kWh)\r\n1-0:2.8.1(000002.444*kWh)\r\n1-0:2.8.2(000000.000*kWh)\r\n0-0:96.14.0(0002)\r\n1-0:1.7.0(00.244*kW)\r\n1-0:2.7.0(00.000*kW)\r\n0-0:96.7.21(00013)\r\n0-0:96.7.9(00000)\r\n1-0:99.97.0(0)(0-0:96.7.19)\r\n1-0:32.32.0(00000)\r\n1-0:52.32.0(00000)\r\n1-0:72.32.0(00000)\r\n1-0:32.36.0(00000)\r\n1-0:52.36.0(00000)\r\n1-0:72.36.0(00000)\r\n0-0:96.13.0()\r\n1-0:32.7.0(0230.0*V)\r\n1-0:52.7.0(0230.0*V)\r\n1-0:72.7.0(0229.0*V)\r\n1-0:31.7.0(0.48*A)\r\n1-0:51.7.0(0.44*A)\r\n1-0:71.7.0(0.86*A)\r\n1-0:21.7.0(00.070*kW)\r\n1-0:41.7.0(00.032*kW)\r\n1-0:61.7.0(00.142*kW)\r\n1-0:22.7.0(00.000*kW)\r\n1-0:42.7.0(00.000*kW)\r\n1-0:62.7.0(00.000*kW)\r\n0-1:24.1.0(003)\r\n0-1:96.1.0(3232323241424344313233343536373839)\r\n0-1:24.2.1(170102161005W)(00000.107*m3)\r\n0-2:24.1.0(003)\r\n0-2:96.1.0()\r\n!6EEE"""
 
-CRC_TABLE = [
-    0x0000,0xC0C1,0xC181,0x0140,0xC301,0x03C0,0x0280,0xC241,0xC601,0x06C0,0x0780,0xC741,0x0500,
-    0xC5C1,0xC481,0x0440,0xCC01,0x0CC0,0x0D80,0xCD41,0x0F00,0xCFC1,0xCE81,0x0E40,0x0A00,0xCAC1,
-    0xCB81,0x0B40,0xC901,0x09C0,0x0880,0xC841,0xD801,0x18C0,0x1980,0xD941,0x1B00,0xDBC1,0xDA81,
-    0x1A40,0x1E00,0xDEC1,0xDF81,0x1F40,0xDD01,0x1DC0,0x1C80,0xDC41,0x1400,0xD4C1,0xD581,0x1540,
-    0xD701,0x17C0,0x1680,0xD641,0xD201,0x12C0,0x1380,0xD341,0x1100,0xD1C1,0xD081,0x1040,0xF001,
-    0x30C0,0x3180,0xF141,0x3300,0xF3C1,0xF281,0x3240,0x3600,0xF6C1,0xF781,0x3740,0xF501,0x35C0,
-    0x3480,0xF441,0x3C00,0xFCC1,0xFD81,0x3D40,0xFF01,0x3FC0,0x3E80,0xFE41,0xFA01,0x3AC0,0x3B80,
-    0xFB41,0x3900,0xF9C1,0xF881,0x3840,0x2800,0xE8C1,0xE981,0x2940,0xEB01,0x2BC0,0x2A80,0xEA41,
-    0xEE01,0x2EC0,0x2F80,0xEF41,0x2D00,0xEDC1,0xEC81,0x2C40,0xE401,0x24C0,0x2580,0xE541,0x2700,
-    0xE7C1,0xE681,0x2640,0x2200,0xE2C1,0xE381,0x2340,0xE101,0x21C0,0x2080,0xE041,0xA001,0x60C0,
-    0x6180,0xA141,0x6300,0xA3C1,0xA281,0x6240,0x6600,0xA6C1,0xA781,0x6740,0xA501,0x65C0,0x6480,
-    0xA441,0x6C00,0xACC1,0xAD81,0x6D40,0xAF01,0x6FC0,0x6E80,0xAE41,0xAA01,0x6AC0,0x6B80,0xAB41,
-    0x6900,0xA9C1,0xA881,0x6840,0x7800,0xB8C1,0xB981,0x7940,0xBB01,0x7BC0,0x7A80,0xBA41,0xBE01,
-    0x7EC0,0x7F80,0xBF41,0x7D00,0xBDC1,0xBC81,0x7C40,0xB401,0x74C0,0x7580,0xB541,0x7700,0xB7C1,
-    0xB681,0x7640,0x7200,0xB2C1,0xB381,0x7340,0xB101,0x71C0,0x7080,0xB041,0x5000,0x90C1,0x9181,
-    0x5140,0x9301,0x53C0,0x5280,0x9241,0x9601,0x56C0,0x5780,0x9741,0x5500,0x95C1,0x9481,0x5440,
-    0x9C01,0x5CC0,0x5D80,0x9D41,0x5F00,0x9FC1,0x9E81,0x5E40,0x5A00,0x9AC1,0x9B81,0x5B40,0x9901,
-    0x59C0,0x5880,0x9841,0x8801,0x48C0,0x4980,0x8941,0x4B00,0x8BC1,0x8A81,0x4A40,0x4E00,0x8EC1,
-    0x8F81,0x4F40,0x8D01,0x4DC0,0x4C80,0x8C41,0x4400,0x84C1,0x8581,0x4540,0x8701,0x47C0,0x4680,
-    0x8641,0x8201,0x42C0,0x4380,0x8341,0x4100,0x81C1,0x8081,0x4040
-]
+# crc16 (poly 0xA001) per byte, little endian uint16s in a bytes literal so
+# booting copies 512 bytes instead of building a list of 256 ints
+CRC_TABLE = array('H',
+    b"\x00\x00\xc1\xc0\x81\xc1\x40\x01\x01\xc3\xc0\x03\x80\x02\x41\xc2\x01\xc6\xc0\x06\x80\x07\x41\xc7\x00\x05\xc1\xc5\x81\xc4\x40\x04"
+    b"\x01\xcc\xc0\x0c\x80\x0d\x41\xcd\x00\x0f\xc1\xcf\x81\xce\x40\x0e\x00\x0a\xc1\xca\x81\xcb\x40\x0b\x01\xc9\xc0\x09\x80\x08\x41\xc8"
+    b"\x01\xd8\xc0\x18\x80\x19\x41\xd9\x00\x1b\xc1\xdb\x81\xda\x40\x1a\x00\x1e\xc1\xde\x81\xdf\x40\x1f\x01\xdd\xc0\x1d\x80\x1c\x41\xdc"
+    b"\x00\x14\xc1\xd4\x81\xd5\x40\x15\x01\xd7\xc0\x17\x80\x16\x41\xd6\x01\xd2\xc0\x12\x80\x13\x41\xd3\x00\x11\xc1\xd1\x81\xd0\x40\x10"
+    b"\x01\xf0\xc0\x30\x80\x31\x41\xf1\x00\x33\xc1\xf3\x81\xf2\x40\x32\x00\x36\xc1\xf6\x81\xf7\x40\x37\x01\xf5\xc0\x35\x80\x34\x41\xf4"
+    b"\x00\x3c\xc1\xfc\x81\xfd\x40\x3d\x01\xff\xc0\x3f\x80\x3e\x41\xfe\x01\xfa\xc0\x3a\x80\x3b\x41\xfb\x00\x39\xc1\xf9\x81\xf8\x40\x38"
+    b"\x00\x28\xc1\xe8\x81\xe9\x40\x29\x01\xeb\xc0\x2b\x80\x2a\x41\xea\x01\xee\xc0\x2e\x80\x2f\x41\xef\x00\x2d\xc1\xed\x81\xec\x40\x2c"
+    b"\x01\xe4\xc0\x24\x80\x25\x41\xe5\x00\x27\xc1\xe7\x81\xe6\x40\x26\x00\x22\xc1\xe2\x81\xe3\x40\x23\x01\xe1\xc0\x21\x80\x20\x41\xe0"
+    b"\x01\xa0\xc0\x60\x80\x61\x41\xa1\x00\x63\xc1\xa3\x81\xa2\x40\x62\x00\x66\xc1\xa6\x81\xa7\x40\x67\x01\xa5\xc0\x65\x80\x64\x41\xa4"
+    b"\x00\x6c\xc1\xac\x81\xad\x40\x6d\x01\xaf\xc0\x6f\x80\x6e\x41\xae\x01\xaa\xc0\x6a\x80\x6b\x41\xab\x00\x69\xc1\xa9\x81\xa8\x40\x68"
+    b"\x00\x78\xc1\xb8\x81\xb9\x40\x79\x01\xbb\xc0\x7b\x80\x7a\x41\xba\x01\xbe\xc0\x7e\x80\x7f\x41\xbf\x00\x7d\xc1\xbd\x81\xbc\x40\x7c"
+    b"\x01\xb4\xc0\x74\x80\x75\x41\xb5\x00\x77\xc1\xb7\x81\xb6\x40\x76\x00\x72\xc1\xb2\x81\xb3\x40\x73\x01\xb1\xc0\x71\x80\x70\x41\xb0"
+    b"\x00\x50\xc1\x90\x81\x91\x40\x51\x01\x93\xc0\x53\x80\x52\x41\x92\x01\x96\xc0\x56\x80\x57\x41\x97\x00\x55\xc1\x95\x81\x94\x40\x54"
+    b"\x01\x9c\xc0\x5c\x80\x5d\x41\x9d\x00\x5f\xc1\x9f\x81\x9e\x40\x5e\x00\x5a\xc1\x9a\x81\x9b\x40\x5b\x01\x99\xc0\x59\x80\x58\x41\x98"
+    b"\x01\x88\xc0\x48\x80\x49\x41\x89\x00\x4b\xc1\x8b\x81\x8a\x40\x4a\x00\x4e\xc1\x8e\x81\x8f\x40\x4f\x01\x8d\xc0\x4d\x80\x4c\x41\x8c"
+    b"\x00\x44\xc1\x84\x81\x85\x40\x45\x01\x87\xc0\x47\x80\x46\x41\x86\x01\x82\xc0\x42\x80\x43\x41\x83\x00\x41\xc1\x81\x81\x80\x40\x40")
 
 
 # globals
 STATUS = 0
+JOINS = 0 # times the modem joined, task_report() starts again after each
 SERVER_NWK = None
 SERVER_ADDR = None
-first = True
 
 
 ###############################################################
@@ -80,6 +141,8 @@ ENDPOINTS = {
         0, # basic 0x0000
         1794, # seMetering 0x0702
         2820, # haElectricalMeasurement
+        2821, # haDiagnostic 0x0b05
+        64513, # P1 data 0xfc01, manufacturer specific
     ],
     'output_clusters': [
     ],
@@ -97,47 +160,65 @@ ENDPOINTS = {
 },
 }
 
+CLUSTER_P1 = 0xfc01
 
 ###############################################################
 # Global attributes, change these if you must                 #
 ###############################################################
 
 ATTRIBUTES = {
- '0': [0x20, int(8).to_bytes(1, 'little')],
- '1': [0x20, int(0).to_bytes(1, 'little')],
- '2': [0x20, int(0).to_bytes(1, 'little')],
- '3': [0x20, int(0).to_bytes(1, 'little')],
- '4': [0x42, b"consp"],
- '5': [0x42, b"Zigbee P1 Meter"],
- '6': [0x42, b"2023-01-15"],
- '7': [0x30, int(4).to_bytes(1, 'little')],
- '8': [0x30, b"\x00"],
- '9': [0x30, b"\xff"],
- '16384': [0x42, b"v0.1"],
+ 0x0000: [0x20, b"\x08"],
+ 0x0001: [0x20, b"\x00"],
+ 0x0002: [0x20, b"\x00"],
+ 0x0003: [0x20, b"\x00"],
+ 0x0004: [0x42, b"consp"],
+ 0x0005: [0x42, b"Zigbee P1 Meter"],
+ 0x0006: [0x42, b"2023-01-15"],
+ 0x0007: [0x30, b"\x04"],
+ 0x0008: [0x30, b"\x00"],
+ 0x0009: [0x30, b"\xff"],
+ 0x4000: [0x42, b"v0.1"],
 }
 
 ###############################################################
 # Smart energy endpoint and variables.                        #
 ###############################################################
+# [cluster, attribute, type, value], compile_reports() appends
+# [frame, offset of the value in the frame, size, pending,
+#  min interval, max interval, reportable change, reported value, reported at, slot]
+RP_REPORT = const(4) # the REPORT_FRAMES entry
+RP_OFFSET = const(5)
+RP_SIZE = const(6)
+RP_PENDING = const(7) # 2 while in a transmit
+RP_MIN = const(8)
+RP_MAX = const(9)
+RP_CHANGE = const(10)
+RP_LAST = const(11) # None until reported
+RP_LAST_AT = const(12) # ticks_ms
+RP_SLOT = const(13) # index in SLOTS and bit in DIRTY
 RP_ENERGY_SUM =     [0x0702, 0x0000, 0x25, None]
 RP_ENERGY_T1 =      [0x0702, 0x0100, 0x25, None]
 RP_ENERGY_T2 =      [0x0702, 0x0102, 0x25, None]
 RP_ENERGY_D_T1 =    [0x0702, 0x0101, 0x25, None]
 RP_ENERGY_D_T2 =    [0x0702, 0x0103, 0x25, None]
-RP_ENERGY_STATUS =  [0x0702, 0x0200, 0x18, b"\x00"]
-RP_ENERGY_UOM =     [0x0702, 0x0300, 0x30, b"\x00"]
-RP_ENERGY_MUL =     [0x0702, 0x0301, 0x22, int(1).to_bytes(3, 'little')]
-RP_ENERGY_DIV =     [0x0702, 0x0302, 0x22, int(1000).to_bytes(3, 'little')]
+RP_ENERGY_STATUS =  [0x0702, 0x0200, 0x18, 0]
+RP_ENERGY_UOM =     [0x0702, 0x0300, 0x30, 0]
+RP_ENERGY_MUL =     [0x0702, 0x0301, 0x22, 1]
+RP_ENERGY_DIV =     [0x0702, 0x0302, 0x22, 1000]
 
 RP_GAS_SUM =        [0x0702, 0x0000, 0x25, None] # gas is at point 2
 RP_GAS_T1 =         [0x0702, 0x0100, 0x25, None]
-RP_GAS_STATUS =     [0x0702, 0x0200, 0x18, b"\x00"]
-RP_GAS_UOM =        [0x0702, 0x0300, 0x30, b"\x01"]
-RP_GAS_MUL =        [0x0702, 0x0301, 0x22, int(1).to_bytes(3, 'little')]
-RP_GAS_DIV =        [0x0702, 0x0302, 0x22, int(1000).to_bytes(3, 'little')]
+RP_GAS_STATUS =     [0x0702, 0x0200, 0x18, 0]
+RP_GAS_UOM =        [0x0702, 0x0300, 0x30, 1]
+RP_GAS_MUL =        [0x0702, 0x0301, 0x22, 1]
+RP_GAS_DIV =        [0x0702, 0x0302, 0x22, 1000]
 
 RP_GAS =            [0x0702, 0x0000, 0x25, None]
 
+RP_DEMAND =         [0x0702, 0x0400, 0x2a, None] # import - export in W
+RP_POWER_IN =       [0, 0, 0x2b, None] # not reported, used for RP_DEMAND
+RP_POWER_OUT =      [0, 0, 0x2b, None]
+
 ###############################################################
 # Energy endpoints and veriables.                             #
 ###############################################################
@@ -151,21 +232,318 @@ RP_L2_P = [0x0b04, 0x090b, 0x21, None]
 RP_L3_A = [0x0b04, 0x0a08, 0x21, None]
 RP_L3_V = [0x0b04, 0x0a05, 0x21, None]
 RP_L3_P = [0x0b04, 0x0a0b, 0x21, None]
-RP_V_MUL = [0x0b04, 0x0600, 0x21, int(1).to_bytes(2, 'little')]
-RP_V_DIV = [0x0b04, 0x0601, 0x21, int(10).to_bytes(2, 'little')]
-RP_A_MUL = [ 0x0b04, 0x0602, 0x21, int(1).to_bytes(2, 'little')]
-RP_A_DIV = [ 0x0b04, 0x0603, 0x21, int(100).to_bytes(2, 'little')]
-RP_P_MUL = [ 0x0b04, 0x0402, 0x23, int(1).to_bytes(4, 'little')]
-RP_P_DIV = [ 0x0b04, 0x0403, 0x23, int(1).to_bytes(4, 'little')]
-RP_PHASES = [ 0x0b04, 0x0000, 0x1b, int(0b001001).to_bytes(4, 'little')] # only L1
+RP_V_MUL = [0x0b04, 0x0600, 0x21, 1]
+RP_V_DIV = [0x0b04, 0x0601, 0x21, 10]
+RP_A_MUL = [ 0x0b04, 0x0602, 0x21, 1]
+RP_A_DIV = [ 0x0b04, 0x0603, 0x21, 100]
+RP_P_MUL = [ 0x0b04, 0x0402, 0x23, 1]
+RP_P_DIV = [ 0x0b04, 0x0403, 0x23, 1]
+RP_PHASES = [ 0x0b04, 0x0000, 0x1b, 0b001001] # only L1
+
+# active power per phase over the reporting window, mean and average are not
+# zcl attributes (see RP_MANUFACTURER): mean is over the telegrams, average is
+# weighted by time
+RP_L1_P_MIN = [0x0b04, 0x050c, 0x29, None]
+RP_L1_P_MAX = [0x0b04, 0x050d, 0x29, None]
+RP_L1_P_MEAN = [0x0b04, 0x05f0, 0x29, None]
+RP_L1_P_AVG = [0x0b04, 0x05f1, 0x29, None]
+RP_L2_P_MIN = [0x0b04, 0x090c, 0x29, None]
+RP_L2_P_MAX = [0x0b04, 0x090d, 0x29, None]
+RP_L2_P_MEAN = [0x0b04, 0x09f0, 0x29, None]
+RP_L2_P_AVG = [0x0b04, 0x09f1, 0x29, None]
+RP_L3_P_MIN = [0x0b04, 0x0a0c, 0x29, None]
+RP_L3_P_MAX = [0x0b04, 0x0a0d, 0x29, None]
+RP_L3_P_MEAN = [0x0b04, 0x0af0, 0x29, None]
+RP_L3_P_AVG = [0x0b04, 0x0af1, 0x29, None]
 
+###############################################################
+# Diagnostics, heap usage and faults.                         #
+###############################################################
+# not reported unless the coordinator configures reporting
+RP_DIAG_RESETS =     [0x0b05, 0x0000, 0x21, 0] # resets after a fault
+RP_DIAG_FAULT =      [0x0b05, 0xf000, 0x30, 0] # last fault: 0 none, 1 out of memory, 2 other
+RP_DIAG_MEM_FREE =   [0x0b05, 0xf001, 0x23, None] # free heap after the last collection
+RP_DIAG_MEM_LOW =    [0x0b05, 0xf002, 0x23, None] # lowest free heap seen before a collection
+RP_DIAG_ALLOC_READ = [0x0b05, 0xf003, 0x23, None] # bytes allocated per cycle reading p1
+RP_DIAG_ALLOC_PARSE =[0x0b05, 0xf004, 0x23, None] # parsing
+RP_DIAG_ALLOC_SEND = [0x0b05, 0xf005, 0x23, None] # sending reports
+RP_DIAG_COLLECTS =   [0x0b05, 0xf006, 0x23, 0] # scheduled collections
+RP_DIAG_BOOT =       [0x0b05, 0xf007, 0x23, None] # ms from boot to the first report
+RP_DIAG_RTT =        [0x0b05, 0xf008, 0x21, None] # average ms until a report is acknowledged
+RP_DIAG_LOSS =       [0x0b05, 0xf009, 0x21, None] # percent of reports lost, recent average
+RP_DIAG_PACE =       [0x0b05, 0xf00a, 0x21, None] # reporting intervals in 1/8, 8 is nominal
+RP_DIAG_AIR_FRAMES = [0x0b05, 0xf00b, 0x21, None] # frames sent in the last cycle
+RP_DIAG_AIR_BYTES =  [0x0b05, 0xf00c, 0x21, None] # payload bytes sent in the last cycle
+RP_DIAG_TX_FRAMES =  [0x0b05, 0xf00d, 0x23, None] # frames sent since boot
+RP_DIAG_TX_BYTES =   [0x0b05, 0xf00e, 0x23, None] # payload bytes sent since boot
+# us spent in the last cycle, only with TRACE
+RP_DIAG_TIMES = (
+    [0x0b05, 0xf010, 0x23, None], # waiting for the uart
+    [0x0b05, 0xf011, 0x23, None], # framing and crc
+    [0x0b05, 0xf012, 0x23, None], # parsing
+    [0x0b05, 0xf013, 0x23, None], # encoding reports
+    [0x0b05, 0xf014, 0x23, None], # transmitting
+)
+RP_DIAG = (RP_DIAG_RESETS, RP_DIAG_FAULT, RP_DIAG_MEM_FREE, RP_DIAG_MEM_LOW,
+           RP_DIAG_ALLOC_READ, RP_DIAG_ALLOC_PARSE, RP_DIAG_ALLOC_SEND, RP_DIAG_COLLECTS,
+           RP_DIAG_BOOT, RP_DIAG_RTT, RP_DIAG_LOSS, RP_DIAG_PACE,
+           RP_DIAG_AIR_FRAMES, RP_DIAG_AIR_BYTES, RP_DIAG_TX_FRAMES, RP_DIAG_TX_BYTES) + RP_DIAG_TIMES
 
-# filled with values
-REPORTING_ATTRIBUTES = []
+###############################################################
+# OBIS codes, maps P1 lines to the attributes above.          #
+###############################################################
+
+# an OBIS code A-B:C.D.E packed into a small int, see obis_key()
+OBIS_MUL = (0, 8, 100, 100, 256)
+
+def obis_key(code):
+    key = 0
+    for n, group in enumerate(code.replace(b"-", b".").replace(b":", b".").split(b".")):
+        key = key * OBIS_MUL[n] + int(group)
+    return key
+
+# code: attribute, decimals, phase bits, value group
+OBIS = {}
+for code, entry in (
+    (b"1-0:1.8.1", (RP_ENERGY_T1, 3, 0, 0)), # energy in t1
+    (b"1-0:1.8.2", (RP_ENERGY_T2, 3, 0, 0)), # energy in t2
+    (b"1-0:2.8.1", (RP_ENERGY_D_T1, 3, 0, 0)), # energy from t1
+    (b"1-0:2.8.2", (RP_ENERGY_D_T2, 3, 0, 0)), # energy from t2
+    (b"1-0:1.7.0", (RP_POWER_IN, 3, 0, 0)), # actual total power received from net
+    (b"1-0:2.7.0", (RP_POWER_OUT, 3, 0, 0)), # actual total power delivered to net
+    (b"1-0:31.7.0", (RP_L1_A, 2, 0, 0)), # amps from L1
+    (b"1-0:51.7.0", (RP_L2_A, 2, 0b010000, 0)), # amps from L2
+    (b"1-0:71.7.0", (RP_L3_A, 2, 0b100000, 0)), # amps from L3
+    (b"1-0:32.7.0", (RP_L1_V, 1, 0, 0)), # volts from L1
+    (b"1-0:52.7.0", (RP_L2_V, 1, 0b010000, 0)), # volts from L2
+    (b"1-0:72.7.0", (RP_L3_V, 1, 0b100000, 0)), # volts from L3
+    (b"1-0:21.7.0", (RP_L1_P, 3, 0, 0)), # POWER from L1
+    (b"1-0:41.7.0", (RP_L2_P, 3, 0b010000, 0)), # POWER from L2
+    (b"1-0:61.7.0", (RP_L3_P, 3, 0b100000, 0)), # POWER from L3
+    (b"0-1:24.2.1", (RP_GAS, 3, 0, 1)), # gas meter, value after the timestamp
+    (b"0-1:24.2.3", (RP_GAS, 3, 0, 1)), # gas meter, belgian e-MUCS
+):
+    OBIS[obis_key(code)] = entry
+
+
+###############################################################
+# Report frames, compiled once by compile_reports().          #
+###############################################################
+
+# endpoint, attributes reported from that endpoint
+REPORTS = (
+    (1, (RP_ENERGY_SUM, RP_ENERGY_T1, RP_ENERGY_T2, RP_ENERGY_D_T1, RP_ENERGY_D_T2, RP_DEMAND,
+         RP_ENERGY_STATUS, RP_ENERGY_UOM, RP_ENERGY_MUL, RP_ENERGY_DIV,
+         RP_PHASES, RP_POWER_SUM, RP_L1_A, RP_L1_V, RP_L1_P, RP_L2_A, RP_L2_V, RP_L2_P,
+         RP_L3_A, RP_L3_V, RP_L3_P, RP_V_MUL, RP_V_DIV, RP_A_MUL, RP_A_DIV, RP_P_MUL, RP_P_DIV,
+         RP_L1_P_MIN, RP_L1_P_MAX, RP_L1_P_MEAN, RP_L1_P_AVG,
+         RP_L2_P_MIN, RP_L2_P_MAX, RP_L2_P_MEAN, RP_L2_P_AVG,
+         RP_L3_P_MIN, RP_L3_P_MAX, RP_L3_P_MEAN, RP_L3_P_AVG) + RP_DIAG),
+    (2, (RP_GAS, RP_GAS_STATUS, RP_GAS_UOM, RP_GAS_MUL, RP_GAS_DIV)),
+)
+
+# attributes that are not in the zcl specification, they are reported, read
+# and configured in manufacturer specific frames with MANUFACTURER_CODE
+RP_MANUFACTURER = (RP_L1_P_MEAN, RP_L1_P_AVG, RP_L2_P_MEAN, RP_L2_P_AVG, RP_L3_P_MEAN, RP_L3_P_AVG) + \
+    tuple([rp for rp in RP_DIAG if rp[1] >= 0xf000])
+
+# attributes whose value does not change, reported every STATIC_REFRESH
+RP_STATIC = (RP_ENERGY_STATUS, RP_ENERGY_UOM, RP_ENERGY_MUL, RP_ENERGY_DIV, RP_PHASES,
+             RP_V_MUL, RP_V_DIV, RP_A_MUL, RP_A_DIV, RP_P_MUL, RP_P_DIV,
+             RP_GAS_STATUS, RP_GAS_UOM, RP_GAS_MUL, RP_GAS_DIV)
+
+# size in bytes of the zcl data types we use
+TYPE_SIZE = {0x18: 1, 0x1b: 4, 0x21: 2, 0x22: 3, 0x23: 4, 0x25: 6, 0x29: 2, 0x2a: 3, 0x2b: 4, 0x30: 1}
+
+# [endpoint, cluster, frame, attributes, header], frame is a report attributes
+# command with all attributes of the cluster: FC, TSQ, 0x0a, [AID, type, value]...
+# the manufacturer specific attributes of a cluster have a frame of their own
+# with the code after the FC, header is the length up to the first attribute
+REPORT_FRAMES = []
+# attribute of every slot, DIRTY has a bit per slot whose value changed and
+# is not written into its frame yet
+SLOTS = []
+DIRTY = None
+TX_BUFFER = None
+TX_VIEW = None
+# largest payload the modem accepts in one transmit, read from NP in setup()
+MAX_PAYLOAD = 64
+
+
+def report_set(rp, value):
+    # store a value, it is encoded when the frame is used. A value the type
+    # cannot hold is clamped to its range, without the all ones (0x80.. when
+    # signed) value that means invalid in zcl
+    size = rp[RP_SIZE]
+    dtype = rp[2]
+    if 0x28 <= dtype <= 0x2f:
+        if size < 4:
+            top = (1 << (8 * size - 1)) - 1
+            value = -top if value < -top else top if value > top else value
+    elif value < 0:
+        value = 0
+    elif size < 4:
+        top = (1 << (8 * size)) - (1 if 0x18 <= dtype <= 0x1f else 2) # bitmaps use all bits
+        if value > top:
+            value = top
+    rp[3] = value
+    slot = rp[RP_SLOT]
+    DIRTY[slot >> 4] |= 1 << (slot & 15)
+
+
+def report_encode():
+    # write the changed values little endian into their report frames
+    for word in range(len(DIRTY)):
+        bits = DIRTY[word]
+        if bits == 0:
+            continue
+        DIRTY[word] = 0
+        slot = word << 4
+        while bits:
+            if bits & 1:
+                rp = SLOTS[slot]
+                value = rp[3]
+                frame = rp[RP_REPORT][2]
+                for i in range(rp[RP_OFFSET], rp[RP_OFFSET] + rp[RP_SIZE]):
+                    frame[i] = value & 0xFF
+                    value >>= 8
+            bits >>= 1
+            slot += 1
+
+
+def compile_reports():
+    global TX_BUFFER, TX_VIEW, DIRTY
+    largest = 0
+    specific = [id(a) for a in RP_MANUFACTURER]
+    for endpoint, attributes in REPORTS:
+        for rp in attributes:
+            cluster = rp[0]
+            if rp[2] not in TYPE_SIZE or len(rp) > 4:
+                continue
+            # all (manufacturer specific) attributes of this cluster go in one frame
+            manufacturer = id(rp) in specific
+            members = [a for a in attributes if a[0] == cluster and (id(a) in specific) == manufacturer]
+            header = 5 if manufacturer else 3
+            frame = bytearray(header + sum([3 + TYPE_SIZE[a[2]] for a in members]))
+            if manufacturer:
+                frame[0] = 0x04
+                frame[1] = MANUFACTURER_CODE & 0xFF
+                frame[2] = MANUFACTURER_CODE >> 8
+            frame[header - 1] = 0x0a
+            report = [endpoint, cluster, frame, members, header]
+            n = header
+            for a in members:
+                frame[n] = a[1] & 0xFF
+                frame[n + 1] = a[1] >> 8
+                frame[n + 2] = a[2]
+                a.extend((report, n + 3, TYPE_SIZE[a[2]], False,
+                          CYCLE_TIME, CYCLE_TIME if ALWAYS_PUBLISH else 0, 0, None, 0, len(SLOTS)))
+                SLOTS.append(a)
+                n += 3 + TYPE_SIZE[a[2]]
+            REPORT_FRAMES.append(report)
+            largest = max(largest, n)
+    DIRTY = array('H', [0] * ((len(SLOTS) + 15) // 16))
+    for rp in SLOTS:
+        if rp[3] is not None:
+            report_set(rp, rp[3])
+    report_encode()
+    TX_BUFFER = bytearray(largest)
+    TX_VIEW = memoryview(TX_BUFFER)
+
+compile_reports()
+for rp in RP_DIAG:
+    rp[RP_MAX] = 0xFFFF
+for rp in RP_STATIC:
+    rp[RP_MAX] = STATIC_REFRESH
+
+
+###############################################################
+# Attribute store, every readable attribute by endpoint,      #
+# cluster and attribute id.                                   #
+###############################################################
+
+# attribute_key(): {attribute: (buffer, start, stop, rp)}, buffer[start:stop]
+# is the encoded type and value. Reported attributes point into their report
+# frame so report_encode() keeps them current, rp is None for static attributes
+ATTRIBUTE_INDEX = {}
+# read attributes responses are built here
+ZCL_BUFFER = bytearray(128)
 
-def debug(*args, **kwargs):
-    if DEBUG:
-        print(*args, **kwargs)
+
+def attribute_value(data):
+    return b"" + data[0].to_bytes(1, 'little') + (data[1] if data[0] not in [0x42] else (len(data[1]).to_bytes(1, 'little') + data[1]))
+
+
+def attribute_key(endpoint, cluster, manufacturer=False):
+    # manufacturer specific attributes are kept apart from the standard ones
+    return (0x1000000 if manufacturer else 0) | (endpoint << 16) | cluster
+
+
+def compile_attributes():
+    for name in ENDPOINTS:
+        endpoint = ENDPOINTS[name]
+        if 0 in endpoint['input_clusters']:
+            basic = ATTRIBUTE_INDEX.setdefault(attribute_key(endpoint['endpoint'], 0), {})
+            for attribute in ATTRIBUTES:
+                encoded = attribute_value(ATTRIBUTES[attribute])
+                basic[attribute] = (encoded, 0, len(encoded), None)
+    for report in REPORT_FRAMES:
+        attributes = ATTRIBUTE_INDEX.setdefault(attribute_key(report[0], report[1], report[4] == 5), {})
+        for rp in report[3]:
+            attributes[rp[1]] = (report[2], rp[RP_OFFSET] - 1, rp[RP_OFFSET] + rp[RP_SIZE], rp)
+
+compile_attributes()
+
+
+def zcl_read_attributes(endpoint, cluster, sequence, data, manufacturer=False):
+    # answer from the store, the encoded values are copied as they are
+    # returns the length of the response in ZCL_BUFFER
+    report_encode()
+    out = ZCL_BUFFER
+    out[0] = 0x18
+    out[1] = sequence
+    out[2] = 0x01
+    n = 3
+    # the manufacturer code is added in front by zcl_respond()
+    limit = min(len(out), MAX_PAYLOAD - (2 if manufacturer else 0))
+    attributes = ATTRIBUTE_INDEX.get(attribute_key(endpoint, cluster, manufacturer))
+    for i in range(3, len(data) - 1, 2):
+        aid = data[i] | (data[i + 1] << 8)
+        entry = attributes.get(aid) if attributes is not None else None
+        if entry is None or (entry[3] is not None and entry[3][3] is None):
+            if n + 3 > limit:
+                break
+            out[n] = data[i]
+            out[n + 1] = data[i + 1]
+            out[n + 2] = 0x86 # unsupported attribute
+            n += 3
+            continue
+        buf = entry[0]
+        stop = entry[2]
+        if n + 3 + stop - entry[1] > limit:
+            break
+        out[n] = data[i]
+        out[n + 1] = data[i + 1]
+        out[n + 2] = 0x00
+        n += 3
+        for j in range(entry[1], stop):
+            out[n] = buf[j]
+            n += 1
+    return n
+
+
+###############################################################
+# Discovery, the ZDO descriptors and attribute discovery      #
+# answers, compiled once by setup().                          #
+###############################################################
+
+# profile: {(cluster << 8) | endpoint: response}, ZDO responses are complete
+# with a zero transaction number and network address, process_zdo() patches
+# both in. Discover attributes responses are the (attribute, type) records of
+# the cluster, sorted by attribute id, by attribute_key()
+DISCOVERY = {0x0000: {}, 0x0104: {}}
+# simple descriptor response for endpoints we do not have
+ZDO_INVALID_EP = bytearray(b"\x00\x82\x00\x00\x00")
 
 
 def simple_descriptor(data):
@@ -180,34 +558,217 @@ def simple_descriptor(data):
         b"".join([i.to_bytes(2, 'little') for i in data['output_clusters']])
     return response
 
-def attribute_value(data):
-    return b"" + data[0].to_bytes(1, 'little') + (data[1] if data[0] not in [0x42] else (len(data[1]).to_bytes(1, 'little') + data[1]))
+def compile_discovery():
+    zdo = DISCOVERY[0x0000]
+    active = bytes([ENDPOINTS[i]['endpoint'] for i in ENDPOINTS])
+    zdo[0x0005 << 8] = bytearray(b"\x00\x00\x00\x00" + len(active).to_bytes(1, 'little') + active)
+    for name in ENDPOINTS:
+        descriptor = simple_descriptor(ENDPOINTS[name])
+        zdo[(0x0004 << 8) | ENDPOINTS[name]['endpoint']] = bytearray(
+            b"\x00\x00\x00\x00" + len(descriptor).to_bytes(1, 'little') + descriptor)
+    # router, 2.4 GHz, mains powered and receiving when idle, the sizes are
+    # patched in by discovery_payload()
+    zdo[0x0002 << 8] = bytearray(
+        b"\x00\x00\x00\x00\x01\x40\x8e" + MANUFACTURER_CODE.to_bytes(2, 'little') +
+        b"\x00\x00\x00\x00\x2c\x00\x00\x00")
+    discovery_payload()
+    # extended response with no associated devices, the last byte is left
+    # out for a single device response
+    zdo[0x0001 << 8] = bytearray(
+        b"\x00\x00" + xbee.atcmd("SL").to_bytes(4, 'little') + xbee.atcmd("SH").to_bytes(4, 'little') +
+        b"\x00\x00\x00")
+    zcl = DISCOVERY[0x0104]
+    for key in ATTRIBUTE_INDEX:
+        attributes = ATTRIBUTE_INDEX[key]
+        records = b""
+        for aid in sorted(attributes):
+            entry = attributes[aid]
+            records += aid.to_bytes(2, 'little') + entry[0][entry[1]:entry[1] + 1]
+        zcl[key] = records
+
+
+def discovery_payload():
+    # the node descriptor tells the maximum buffer and transfer sizes, they
+    # change when NP is read after a join
+    descriptor = DISCOVERY[0x0000].get(0x0002 << 8)
+    if descriptor is None:
+        return
+    descriptor[9] = min(MAX_PAYLOAD, 0xFF)
+    for i in (10, 14):
+        descriptor[i] = MAX_PAYLOAD & 0xFF
+        descriptor[i + 1] = MAX_PAYLOAD >> 8
+
+
+def zcl_discover_attributes(endpoint, cluster, sequence, data, manufacturer=False):
+    # records from the start attribute on, as many as asked for and fit
+    # returns the length of the response in ZCL_BUFFER
+    out = ZCL_BUFFER
+    out[0] = 0x18
+    out[1] = sequence
+    out[2] = 0x0d
+    records = DISCOVERY[0x0104].get(attribute_key(endpoint, cluster, manufacturer), b"")
+    start = data[3] | (data[4] << 8) if len(data) >= 6 else 0
+    count = data[5] if len(data) >= 6 else 0xFF
+    i = 0
+    while i < len(records) and (records[i] | (records[i + 1] << 8)) < start:
+        i += 3
+    n = 4
+    limit = min(len(out), MAX_PAYLOAD - (2 if manufacturer else 0))
+    while i < len(records) and count > 0 and n + 3 <= limit:
+        out[n] = records[i]
+        out[n + 1] = records[i + 1]
+        out[n + 2] = records[i + 2]
+        n += 3
+        i += 3
+        count -= 1
+    # discovery complete when no attributes are left
+    out[3] = 1 if i >= len(records) else 0
+    return n
+
+
+###############################################################
+# Reporting, per attribute min/max interval and change.       #
+###############################################################
+
+def report_attribute(endpoint, cluster, attribute, manufacturer=False):
+    attributes = ATTRIBUTE_INDEX.get(attribute_key(endpoint, cluster, manufacturer))
+    if attributes is None or attribute not in attributes:
+        return None
+    return attributes[attribute][3]
+
+
+def report_reset():
+    # forget what was reported, everything is reported on the next cycle
+    for report in REPORT_FRAMES:
+        for rp in report[3]:
+            rp[RP_LAST] = None
+
+
+def report_static():
+    # the static attributes go out on the next cycle, after a (re)join
+    for rp in RP_STATIC:
+        rp[RP_LAST] = None
+
+
+def report_due(now):
+    # mark attributes as pending when their reporting rules fire:
+    # never reported, max interval passed (unless 0) or changed by at least
+    # the reportable change after the min interval, max 0xFFFF disables,
+    # the intervals stretch with the link pace
+    pace = LINK[LINK_PACE]
+    count = 0
+    for report in REPORT_FRAMES:
+        for rp in report[3]:
+            value = rp[3]
+            if value is None or rp[RP_MAX] == 0xFFFF:
+                continue
+            last = rp[RP_LAST]
+            if last is None:
+                rp[RP_PENDING] = True
+            else:
+                elapsed = utime.ticks_diff(now, rp[RP_LAST_AT])
+                maximum = rp[RP_MAX] if pace == 8 else min(rp[RP_MAX] * pace >> 3, 0xFFFE)
+                if rp[RP_MAX] != 0 and elapsed >= maximum * 1000:
+                    rp[RP_PENDING] = True
+                elif value != last and elapsed >= (rp[RP_MIN] * pace >> 3) * 1000 and \
+                        (value - last >= rp[RP_CHANGE] or last - value >= rp[RP_CHANGE]):
+                    rp[RP_PENDING] = True
+            if rp[RP_PENDING]:
+                count += 1
+    return count
+
+
+def zcl_configure_reporting(endpoint, cluster, data, manufacturer=False):
+    # records: direction, AID, type, min, max, reportable change (analog only)
+    # returns the status records of the failed ones, or success
+    response = b""
+    n = 3
+    while n + 3 <= len(data):
+        direction = data[n]
+        attribute = data[n + 1] | (data[n + 2] << 8)
+        if direction != 0:
+            # we do not receive reports, skip the timeout
+            response = response + b"\x86\x01" + attribute.to_bytes(2, 'little')
+            n += 5
+            continue
+        dtype = data[n + 3]
+        if dtype not in TYPE_SIZE:
+            response = response + b"\x8d\x00" + attribute.to_bytes(2, 'little')
+            break
+        size = TYPE_SIZE[dtype] if 0x20 <= dtype <= 0x2f else 0
+        minimum = int.from_bytes(data[n + 4:n + 6], 'little')
+        maximum = int.from_bytes(data[n + 6:n + 8], 'little')
+        change = int.from_bytes(data[n + 8:n + 8 + size], 'little')
+        if dtype >= 0x28 and size and change >= 1 << (size * 8 - 1):
+            change = (1 << (size * 8)) - change
+        n += 8 + size
+
+        rp = report_attribute(endpoint, cluster, attribute, manufacturer)
+        status = 0
+        if rp is None:
+            status = 0x86 # unsupported attribute
+        elif rp[2] != dtype:
+            status = 0x8d # invalid data type
+        elif maximum != 0 and maximum != 0xFFFF and minimum > maximum:
+            status = 0x87 # invalid value
+        else:
+            rp[RP_MIN] = minimum
+            rp[RP_MAX] = maximum
+            rp[RP_CHANGE] = change
+            if DEBUG:
+                debug("Reporting %04X/%04X min %d max %d change %d" % (cluster, attribute, minimum, maximum, change))
+        if status:
+            response = response + status.to_bytes(1, 'little') + b"\x00" + attribute.to_bytes(2, 'little')
+    if len(response) == 0:
+        response = b"\x00"
+    return response
+
+
+def zcl_read_reporting(endpoint, cluster, data, manufacturer=False):
+    # records: direction, AID, returns status, direction, AID, [type, min, max, change]
+    response = b""
+    for n in range(3, len(data) - 2, 3):
+        direction = data[n]
+        attribute = data[n + 1] | (data[n + 2] << 8)
+        rp = report_attribute(endpoint, cluster, attribute, manufacturer)
+        if rp is None or direction != 0:
+            response = response + b"\x86" + data[n:n + 3]
+            continue
+        response = response + b"\x00" + data[n:n + 3] + rp[2].to_bytes(1, 'little') + \
+            rp[RP_MIN].to_bytes(2, 'little') + rp[RP_MAX].to_bytes(2, 'little')
+        if 0x20 <= rp[2] <= 0x2f:
+            response = response + (rp[RP_CHANGE] & ((1 << rp[RP_SIZE] * 8) - 1)).to_bytes(rp[RP_SIZE], 'little')
+    return response
+
+
+def debug(*args, **kwargs):
+    if DEBUG:
+        print(*args, **kwargs)
+
 
 def blink():
     led(led.value() ^ 1)
 
 def process_zdo(cluster, data, sender):
-    if cluster == 0x0004:
-        debug("Request simple descriptor")
-        transaction = data[0:1]
-        nwk_address = data[1:3]
-        ep = data[3]
-        descriptor = simple_descriptor(ENDPOINTS['%d' % ep])
-        debug("Request simple descriptor %d" % (ep))
-        response = transaction + "\x00" + nwk_address + len(descriptor).to_bytes(1, 'little') + descriptor
-        debug("EP response: %s" % (hexlify(response).decode()))
-        xbee.transmit(sender, response, source_ep=0, dest_ep=0, cluster=0x8004, profile=0)
-
-    elif cluster == 0x0005:  # req active endpoints
-        # 2 octets with network address, we ignore these as we are the endpoint already
-        # respond with ep_rsp 0x8005
-        debug("EP Req")
-        transaction = data[0:1]
-        nwk_address = data[1:3]  # collect network address
-        response = transaction + b"\x00" + nwk_address + len(ENDPOINTS).to_bytes(1, 'little') + bytes([ENDPOINTS[i]['endpoint'] for i in ENDPOINTS])
-        nwk_address_int = int.from_bytes(nwk_address, 'little')
-        debug("EP response nwk %d: %s" % (nwk_address_int, hexlify(response).decode()))
-        xbee.transmit(sender, response, source_ep=0, dest_ep=0, cluster=0x8005, profile=0)
+    if cluster == 0x0001 or cluster == 0x0002 or cluster == 0x0004 or cluster == 0x0005:
+        # ieee address, node descriptor, simple descriptor and active endpoints
+        # requests, answered from DISCOVERY
+        ep = data[3] if cluster == 0x0004 else 0
+        if DEBUG:
+            debug("ZDO request %04X ep %d" % (cluster, ep))
+        response = DISCOVERY[0x0000].get((cluster << 8) | ep, ZDO_INVALID_EP)
+        response[0] = data[0]
+        # the network address of interest, our own
+        at = 10 if cluster == 0x0001 else 2
+        response[at] = data[1]
+        response[at + 1] = data[2]
+        n = len(response)
+        if cluster == 0x0001 and data[3] == 0:
+            n -= 1 # single device response
+        if DEBUG:
+            debug("ZDO response: %s" % (hexlify(response[:n]).decode()))
+        xbee.transmit(sender, memoryview(response)[:n], source_ep=0, dest_ep=0, cluster=cluster | 0x8000, profile=0)
+        air_count(n)
     elif cluster == 0x0021: # bind request
         transaction = data[0:1]
         src = data[1:9]
@@ -216,16 +777,20 @@ def process_zdo(cluster, data, sender):
         addr_type = data[12]
         dst = data[13:21]
         dst_ep = data[21]
-        debug("Bind Req %d to %d" % (src_ep, dst_ep))
+        if DEBUG:
+            debug("Bind Req %d to %d" % (src_ep, dst_ep))
         # do nothing now
         response = transaction + b"\x00"
         xbee.transmit(sender, response, source_ep=0, dest_ep=0, cluster=0x8021, profile=0)
+        air_count(2)
     elif cluster == 0x0022: # unbind request
-        debug("Unbind Req")
+        if DEBUG:
+            debug("Unbind Req")
         transaction = data[0:1]
         # do nothing now
         response = transaction + b"\x00"
         xbee.transmit(sender, response, source_ep=0, dest_ep=0, cluster=0x8022, profile=0)
+        air_count(2)
     elif cluster == 0x8001:  # ZDP IEEE ADDR
         # 84 00 a096b626004b1200 0000
         global SERVER_ADDR
@@ -235,16 +800,27 @@ def process_zdo(cluster, data, sender):
     elif cluster == 0x8002:  # ZDP Node Desc
         pass # aka ignore
     else:
-        debug("cluster: %04X, data: %s" % (cluster, hexlify(data).decode()))
+        if DEBUG:
+            debug("cluster: %04X, data: %s" % (cluster, hexlify(data).decode()))
+
+
+def zcl_respond(sender, response, cluster, profile, src_ep, dst_ep, manufacturer=False):
+    # send a response (FC, TSQ, CID, payload), manufacturer specific
+    # responses get the manufacturer code after the FC
+    if manufacturer:
+        response = bytes((response[0] | 0x04, MANUFACTURER_CODE & 0xFF, MANUFACTURER_CODE >> 8)) + bytes(response[1:])
+    if DEBUG:
+        debug("Response: %s" % (hexlify(response).decode()))
+    xbee.transmit(sender, response, source_ep=src_ep, dest_ep=dst_ep, cluster=cluster, profile=profile)
+    air_count(len(response))
 
 
 def process_zcl(cluster, profile, data, sender, src_ep=0, dst_ep=0):
     # FC, TSQ, CID, payload
     if len(data) < 3:
         print("No ZCL Frame")
+        return
     frame_control = data[0]
-    sequence = data[1]
-    cid = data[2]
 
     # decode FC
     fc_type =       (frame_control & 0x03)
@@ -252,37 +828,59 @@ def process_zcl(cluster, profile, data, sender, src_ep=0, dst_ep=0):
     fc_direction =  (frame_control & 0x08) >> 3
     fc_ddr =        (frame_control & 0x10) >> 4
 
-    if cid == 0x00:
+    if fc_ms:
+        # FC, manufacturer, TSQ, CID, payload: the code is dropped so the
+        # rest of the frame is read like any other
+        if len(data) < 5 or data[1] | data[2] << 8 != MANUFACTURER_CODE:
+            if DEBUG:
+                debug("Manufacturer specific frame ignored: %s" % (hexlify(data).decode()))
+            return
+        data = data[2:]
+    sequence = data[1]
+    cid = data[2]
+
+    if fc_type == 1:
+        # cluster specific commands
+        if cluster == CLUSTER_P1 and fc_ms and cid == 0x02:
+            history_request(sender, data)
+        elif DEBUG:
+            debug("Command %02X of cluster %04X ignored" % (cid, cluster))
+    elif cid == 0x00:
         # read attributes
-        attributes = [int.from_bytes(data[n:n+2], 'little') for n in range(3, len(data), 2)]
-        header = b"\x10" + sequence.to_bytes(1, 'little') + "\x01"
-        response = b""
-        for item in attributes:
-            debug("Reading attribute %d %04X" % (item, item))
-            astring = '%d' % (item)
-            if astring in ATTRIBUTES:
-                response = response + item.to_bytes(2, 'little') + "\x00" + attribute_value(ATTRIBUTES[astring])
-            else:
-                response = response + item.to_bytes(2, 'little') + "\x86"
-        # 109801 0400 00 05 636f6e7370
-        response = header + response
-        debug("Response: %s" % (hexlify(response).decode()))
-        xbee.transmit(sender, response, source_ep=src_ep, dest_ep=dst_ep, cluster=cluster, profile=profile)
+        n = zcl_read_attributes(src_ep, cluster, sequence, data, fc_ms)
+        zcl_respond(sender, memoryview(ZCL_BUFFER)[:n], cluster, profile, src_ep, dst_ep, fc_ms)
+    elif cid == 0x06:
+        # configure reporting
+        response = b"\x18" + sequence.to_bytes(1, 'little') + b"\x07" + zcl_configure_reporting(src_ep, cluster, data, fc_ms)
+        zcl_respond(sender, response, cluster, profile, src_ep, dst_ep, fc_ms)
+    elif cid == 0x08:
+        # read reporting configuration
+        response = b"\x18" + sequence.to_bytes(1, 'little') + b"\x09" + zcl_read_reporting(src_ep, cluster, data, fc_ms)
+        zcl_respond(sender, response, cluster, profile, src_ep, dst_ep, fc_ms)
+    elif cid == 0x0c:
+        # discover attributes
+        n = zcl_discover_attributes(src_ep, cluster, sequence, data, fc_ms)
+        zcl_respond(sender, memoryview(ZCL_BUFFER)[:n], cluster, profile, src_ep, dst_ep, fc_ms)
     elif cid == 0x0b:
-        debug("Received response to command %02X status %02X" % (data[3], data[4]))
-        # after first respose only send updates
-        global first
-        first = False
+        if DEBUG:
+            debug("Received response to command %02X status %02X" % (data[3], data[4]))
+        link_ack(sequence, utime.ticks_ms())
     else:
-        debug("c/p %04X %04X" % (cluster, profile))
-        debug("FC: %02X SQ: %02X CID: %02X" % (frame_control, sequence, cid))
-        debug("UNKNOWN CID: %02X" % (cid))
+        if DEBUG:
+            debug("c/p %04X %04X" % (cluster, profile))
+            debug("FC: %02X SQ: %02X CID: %02X" % (frame_control, sequence, cid))
+            debug("UNKNOWN CID: %02X" % (cid))
 
 # callbacks
 def callback_status(status):
-    global STATUS
+    global STATUS, JOINS
     print("Received status: {:02X}".format(status))
+    if status == 2 and STATUS != 2:
+        JOINS += 1
     STATUS = status
+    if TRACE:
+        trace(T_STATUS, status)
+    event_set(EV_STATUS)
 
 def callback_receive(data):
     sender = data['sender_eui64']
@@ -294,51 +892,239 @@ def callback_receive(data):
     d_ep = data['dest_ep']
 
     if profile == 0x0000: # zdo
-        debug("ZDO Message")
+        if DEBUG:
+            debug("ZDO Message")
+        if TRACE:
+            trace(T_RECEIVE_ZDO, cluster)
         process_zdo(cluster, payload, sender)
     elif profile == 0x0104:
+        if TRACE:
+            trace(T_RECEIVE_ZCL, cluster)
         process_zcl(cluster, profile, payload, sender, src_ep=d_ep, dst_ep=s_ep)
     else:
-        debug("UNKNOWN profile: %04X" % (profile))
-        debug("sender: %s, %d/%04X" % (hexlify(sender).decode(), nwk, nwk))
-        debug("payload: %s" % (hexlify(payload).decode()))
-        debug("c/p: 0x%04X, %d // 0x%04X, %d" % (cluster, cluster, profile, profile))
-        debug("ep: %d, %d" % (s_ep, d_ep))
+        if DEBUG:
+            debug("UNKNOWN profile: %04X" % (profile))
+            debug("sender: %s, %d/%04X" % (hexlify(sender).decode(), nwk, nwk))
+            debug("payload: %s" % (hexlify(payload).decode()))
+            debug("c/p: 0x%04X, %d // 0x%04X, %d" % (cluster, cluster, profile, profile))
+            debug("ep: %d, %d" % (s_ep, d_ep))
         #debug(data)
 
 
-# register callbacks
-xbee.modem_status.callback(callback_status)
-xbee.receive_callback(callback_receive)
+###############################################################
+# Link quality, acknowledged reports and the reporting pace.  #
+###############################################################
+
+# reports waiting for their default response, by sequence number modulo
+# INFLIGHT_SIZE: the sequence number (-1 when free) and ticks_ms when sent
+INFLIGHT_SIZE = const(16)
+INFLIGHT_SEQUENCE = array('h', [-1] * INFLIGHT_SIZE)
+INFLIGHT_SENT = array('l', [0] * INFLIGHT_SIZE)
+# reports sent, acknowledged and lost, average round trip in ms, average
+# loss in 1/1024, pace in 1/8 of the reporting intervals and the number of
+# reports acknowledged or lost since the last link_check()
+LINK_SENT = 0
+LINK_ACKED = 1
+LINK_LOST = 2
+LINK_RTT_AVG = 3
+LINK_LOSS_AVG = 4
+LINK_PACE = 5
+LINK_DONE = 6
+LINK = array('l', [0, 0, 0, 0, 0, 8, 0])
+
+
+def link_sent(sequence, now):
+    i = sequence & (INFLIGHT_SIZE - 1)
+    if INFLIGHT_SEQUENCE[i] >= 0:
+        # not acknowledged in 16 reports
+        link_lost(i)
+    INFLIGHT_SEQUENCE[i] = sequence
+    INFLIGHT_SENT[i] = now
+    LINK[LINK_SENT] += 1
+
+
+def link_lost(i):
+    if TRACE:
+        trace(T_REPORT_LOST, INFLIGHT_SEQUENCE[i])
+    INFLIGHT_SEQUENCE[i] = -1
+    LINK[LINK_LOST] += 1
+    LINK[LINK_LOSS_AVG] += (1024 - LINK[LINK_LOSS_AVG]) >> 3
+    LINK[LINK_DONE] += 1
+
+
+def link_ack(sequence, now):
+    # default response to one of our reports
+    i = sequence & (INFLIGHT_SIZE - 1)
+    if INFLIGHT_SEQUENCE[i] != sequence:
+        return
+    INFLIGHT_SEQUENCE[i] = -1
+    rtt = utime.ticks_diff(now, INFLIGHT_SENT[i])
+    LINK[LINK_ACKED] += 1
+    if LINK[LINK_ACKED] == 1:
+        LINK[LINK_RTT_AVG] = rtt
+    else:
+        LINK[LINK_RTT_AVG] += (rtt - LINK[LINK_RTT_AVG]) >> 3
+    LINK[LINK_LOSS_AVG] -= LINK[LINK_LOSS_AVG] >> 3
+    LINK[LINK_DONE] += 1
+
+
+def link_check(now):
+    # reports without a response in LINK_TIMEOUT are lost, then the pace
+    # doubles on a bad link and shrinks by 1/8 on a good one, once per
+    # check that saw reports acknowledged or lost
+    for i in range(INFLIGHT_SIZE):
+        if INFLIGHT_SEQUENCE[i] >= 0 and utime.ticks_diff(now, INFLIGHT_SENT[i]) > LINK_TIMEOUT:
+            link_lost(i)
+    if LINK[LINK_DONE] == 0:
+        return
+    LINK[LINK_DONE] = 0
+    pace = LINK[LINK_PACE]
+    if LINK[LINK_LOSS_AVG] * 100 > LINK_LOSS * 1024 or LINK[LINK_RTT_AVG] > LINK_RTT:
+        pace = min(pace * 2, LINK_BACKOFF * 8)
+    elif pace > 8:
+        pace = max(pace - max(pace >> 3, 1), 8)
+    if DEBUG and pace != LINK[LINK_PACE]:
+        debug("Link rtt %d ms loss %d/1024, pace %d/8" % (LINK[LINK_RTT_AVG], LINK[LINK_LOSS_AVG], pace))
+    LINK[LINK_PACE] = pace
+    report_set(RP_DIAG_RTT, min(LINK[LINK_RTT_AVG], 0xFFFE))
+    report_set(RP_DIAG_LOSS, LINK[LINK_LOSS_AVG] * 100 >> 10)
+    report_set(RP_DIAG_PACE, pace)
+
+
+###############################################################
+# Airtime, frames and bytes sent per cycle and since boot.    #
+###############################################################
+
+# frames and payload bytes sent in this cycle, the last cycle and since boot
+# (wrapping at 2^30), a cycle ends after the reports of send_data()
+AIR_FRAMES = 0
+AIR_BYTES = 1
+AIR_LAST_FRAMES = 2
+AIR_LAST_BYTES = 3
+AIR_TOTAL_FRAMES = 4
+AIR_TOTAL_BYTES = 5
+AIR = array('l', [0] * 6)
+# bytes a frame takes on air besides the payload: PHY, MAC, NWK and APS headers
+AIR_OVERHEAD = const(31)
+
+
+def air_count(size):
+    AIR[AIR_FRAMES] += 1
+    AIR[AIR_BYTES] += size
+
+
+def air_cycle():
+    frames = AIR[AIR_FRAMES]
+    size = AIR[AIR_BYTES]
+    AIR[AIR_FRAMES] = 0
+    AIR[AIR_BYTES] = 0
+    AIR[AIR_LAST_FRAMES] = frames
+    AIR[AIR_LAST_BYTES] = size
+    AIR[AIR_TOTAL_FRAMES] = (AIR[AIR_TOTAL_FRAMES] + frames) & 0x3FFFFFFF
+    AIR[AIR_TOTAL_BYTES] = (AIR[AIR_TOTAL_BYTES] + size) & 0x3FFFFFFF
+    report_set(RP_DIAG_AIR_FRAMES, min(frames, 0xFFFE))
+    report_set(RP_DIAG_AIR_BYTES, min(size, 0xFFFE))
+    report_set(RP_DIAG_TX_FRAMES, AIR[AIR_TOTAL_FRAMES])
+    report_set(RP_DIAG_TX_BYTES, AIR[AIR_TOTAL_BYTES])
+
+
+def air_dump():
+    # frames, bytes and time on air at 250 kbit/s (32 us a byte, with the
+    # headers) of the last cycle and since boot, from the REPL
+    for name, frames, size in (("cycle", AIR[AIR_LAST_FRAMES], AIR[AIR_LAST_BYTES]),
+                               ("total", AIR[AIR_TOTAL_FRAMES], AIR[AIR_TOTAL_BYTES])):
+        print("%-6s %9d frames %11d bytes %9d ms on air" % (
+            name, frames, size, (size + frames * AIR_OVERHEAD) // 125 * 4))
+
 
 SEQUENCE_NR = 0
 # Processing of data and sending
-def zcl_send_report(sink, endpoint, profile, attributes):
-    # construct header, sequence is global
-    if len(attributes) == 0:
-        return
+def zcl_transmit(sink, endpoint, cluster, profile, payload, sequence_at=1):
+    # send one frame with the next sequence number, returns success,
+    # manufacturer specific frames have the sequence number at 3
     global SEQUENCE_NR
-    header = b"\x00" + SEQUENCE_NR.to_bytes(1, 'little') + "\x0a"
-
-    # data [2xAID, DATA_TYPE, DATA]
-    response = b""
-    clusters = []
-    for att in attributes:
-        if att[0] not in clusters:
-            clusters.append(att[0])
-
-    for cluster in clusters:
-        for item in attributes:
-            if item[0] != 0 and item[0] == cluster: # skip illigal values and not in cluster
-                response = response + item[1].to_bytes(2, 'little') + item[2].to_bytes(1, 'little') + item[3]
-        try:
-            debug("Transmitting to ep %d cluster %04X %s" % (endpoint, cluster, hexlify(header + response).decode()))
-            xbee.transmit(sink, header + response, source_ep=endpoint, dest_ep=1, cluster=cluster, profile=profile)
-            SEQUENCE_NR += 1
-            if SEQUENCE_NR > 255:
-                SEQUENCE_NR = 0
-        except:
-            pass
+    payload[sequence_at] = SEQUENCE_NR
+    if TRACE:
+        start = utime.ticks_us()
+    try:
+        if DEBUG:
+            debug("Transmitting to ep %d cluster %04X %s" % (endpoint, cluster, hexlify(payload).decode()))
+        xbee.transmit(sink, payload, source_ep=endpoint, dest_ep=1, cluster=cluster, profile=profile)
+    except Exception as e:
+        if DEBUG:
+            debug("Transmit to ep %d cluster %04X failed: %s" % (endpoint, cluster, e))
+        if TRACE:
+            trace(T_TRANSMIT_FAIL, cluster)
+        return False
+    if TRACE:
+        TIMES[TIME_TRANSMIT] += utime.ticks_diff(utime.ticks_us(), start)
+        trace(T_TRANSMIT, cluster)
+    air_count(len(payload))
+    if not payload[0] & 0x10:
+        # a default response is expected
+        link_sent(SEQUENCE_NR, utime.ticks_ms())
+    SEQUENCE_NR += 1
+    if SEQUENCE_NR > 255:
+        SEQUENCE_NR = 0
+    return True
+
+
+def zcl_send_report(sink, endpoint, profile):
+    # send the pending attributes of the endpoint, the values are already in
+    # the precompiled frames, attributes that are not pending are left out and
+    # reports larger than MAX_PAYLOAD are split over several transmits,
+    # returns the success of each transmit
+    report_encode()
+    results = []
+    for report in REPORT_FRAMES:
+        if report[0] != endpoint:
+            continue
+        members = report[3]
+        count = 0
+        for rp in members:
+            if rp[RP_PENDING]:
+                count += 1
+        if count == 0:
+            continue
+
+        frame = report[2]
+        header = report[4]
+        # manufacturer specific frames have the sequence number at 3
+        sequence_at = header - 2
+        if count == len(members) and len(frame) <= MAX_PAYLOAD:
+            for rp in members:
+                rp[RP_PENDING] = 2 # in this transmit
+            results.append(zcl_report_done(members, zcl_transmit(sink, endpoint, report[1], profile, frame, sequence_at)))
+            continue
+        # copy the pending attributes behind the header, as many as fit
+        payload = TX_BUFFER
+        for i in range(header):
+            payload[i] = frame[i]
+        n = header
+        for rp in members:
+            if not rp[RP_PENDING]:
+                continue
+            if n > header and n + 3 + rp[RP_SIZE] > MAX_PAYLOAD:
+                results.append(zcl_report_done(members, zcl_transmit(sink, endpoint, report[1], profile, TX_VIEW[:n], sequence_at)))
+                n = header
+            for i in range(rp[RP_OFFSET] - 3, rp[RP_OFFSET] + rp[RP_SIZE]):
+                payload[n] = frame[i]
+                n += 1
+            rp[RP_PENDING] = 2 # in this transmit
+        results.append(zcl_report_done(members, zcl_transmit(sink, endpoint, report[1], profile, TX_VIEW[:n], sequence_at)))
+    return results
+
+
+def zcl_report_done(members, ok):
+    # clear the attributes of a transmit, remember what was reported when it succeeded
+    now = utime.ticks_ms()
+    for rp in members:
+        if rp[RP_PENDING] == 2:
+            if ok:
+                rp[RP_LAST] = rp[3]
+                rp[RP_LAST_AT] = now
+            rp[RP_PENDING] = False
+    return ok
 
 
 # CRC16 with A001 poly
@@ -348,271 +1134,1198 @@ def crc16(data):
         crc = CRC_TABLE[(crc ^ c) & 0xFF] ^ ((crc >> 8) & 0xFF);
     return crc
 
-# setup
-xbee.atcmd("NI", NAME)
-# xbee.atcmd("CE", 0) # join cannot be set
-xbee.atcmd("AO", 0b00001110)
-xbee.atcmd("ID", 0) # broadcast
-xbee.atcmd("ZS", 2) # zigbee pro
-xbee.atcmd("NJ", 255) # join time
-xbee.atcmd("JN", 1) # join network enabled
-xbee.atcmd("EO", 0x1B) # make sure we can rejoin
+def send_data():
+    agg_publish()
+    report_due(utime.ticks_ms())
+    # a new window starts when this one is reported
+    window = False
+    for phase in AGG_PHASES:
+        for rp in phase[2:]:
+            if rp[RP_PENDING]:
+                window = True
+    results = zcl_send_report(xbee.ADDR_COORDINATOR, 1, 0x0104)
+    results.extend(zcl_send_report(xbee.ADDR_COORDINATOR, 2, 0x0104))
+    if PASSTHROUGH and PT_LENGTH:
+        results.extend(passthrough_send(xbee.ADDR_COORDINATOR))
+    if window:
+        agg_reset()
+    air_cycle()
+    return results
+
+
+# P1 telegram framing, bytes are collected in a fixed buffer and the crc is
+# updated as they arrive so a telegram is validated when the last crc digit lands
+P1_BUFFER = bytearray(P1_BUFFER_SIZE)
+P1_VIEW = memoryview(P1_BUFFER)
+P1_LENGTH = 0
+P1_STATE = 0 # 0: waiting for /, 1: waiting for !, 2-5: reading crc digits
+P1_CRC = 0
+P1_LINES = array('H', [0] * P1_MAX_LINES) # start offset of each line
+P1_LINE_COUNT = 0
+P1_NEXT = 0 # after a complete telegram, where the rest of the chunk starts
+# lines that are the same as in the previous parsed telegram: while a
+# telegram is stored every byte is compared with what the buffer held, a line
+# is unchanged when its bytes and its place are, process_p1() skips it
+P1_SAME = bytearray(P1_MAX_LINES)
+P1_LINE_SAME = 0 # no byte of the current line differed so far
+P1_MEMO_LINES = 0 # lines of the previous telegram, 0 when the buffer holds no parsed telegram
+P1_PARSED = False # the buffer holds the telegram that was parsed last
+
+
+def p1_store(chars, start, stop):
+    # copy chars[start:stop] into the telegram buffer and update the crc,
+    # remember where each line starts and which lines changed
+    global P1_LENGTH, P1_CRC, P1_LINE_COUNT, P1_LINE_SAME
+    n = P1_LENGTH
+    if n + stop - start > P1_BUFFER_SIZE - 4:
+        # no room left for the 4 crc digits after the !
+        return False
+    table = CRC_TABLE
+    crc = P1_CRC
+    for i in range(start, stop):
+        crc = table[(crc ^ chars[i]) & 0xFF] ^ (crc >> 8)
+    # a line is the same when its bytes are and it starts and ends where it
+    # did in the previous telegram, the bytes are compared a line at a time
+    # before the chunk is copied over them
+    view = P1_VIEW
+    src = memoryview(chars)
+    lines = P1_LINES
+    nl = P1_LINE_COUNT
+    same = P1_LINE_SAME
+    memo = P1_MEMO_LINES
+    i = start
+    m = n
+    while i < stop:
+        j = chars.find(b"\n", i, stop)
+        e = stop if j < 0 else j + 1
+        k = m + e - i
+        if same and (nl >= memo or view[m:k] != src[i:e]):
+            same = 0
+        m = k
+        i = e
+        if j >= 0 and nl < P1_MAX_LINES:
+            moved = nl >= memo or lines[nl] != m
+            P1_SAME[nl - 1] = 0 if moved else same
+            lines[nl] = m
+            P1_SAME[nl] = 0
+            nl += 1
+            same = 0 if moved else 1
+    view[n:m] = src[start:stop]
+    P1_LENGTH = m
+    P1_CRC = crc
+    P1_LINE_COUNT = nl
+    P1_LINE_SAME = same
+    return True
+
+
+def p1_feed(chars):
+    # feed a chunk of p1 data to the framer, returns True when a complete
+    # telegram with a valid crc is in P1_BUFFER[:P1_LENGTH], chars[P1_NEXT:]
+    # is not used yet and has to be fed again after the telegram is parsed
+    global P1_LENGTH, P1_STATE, P1_CRC, P1_LINE_COUNT, P1_NEXT, P1_LINE_SAME, P1_MEMO_LINES, P1_PARSED
+    start = 0
+    end = len(chars)
+    while start < end:
+        if P1_STATE == 0:
+            start = chars.find(b"/", start)
+            if start < 0:
+                return False
+            P1_LENGTH = 0
+            P1_CRC = 0
+            P1_LINES[0] = 0
+            P1_LINE_COUNT = 1
+            P1_SAME[0] = 0
+            # compare with the previous telegram only when it is still in the buffer
+            P1_MEMO_LINES = P1_MEMO_LINES if P1_PARSED else 0
+            P1_PARSED = False
+            P1_LINE_SAME = 1
+            P1_STATE = 1
+            p1_store(chars, start, start + 1)
+            start += 1
+        elif P1_STATE == 1:
+            stop = chars.find(b"!", start)
+            restart = chars.find(b"/", start)
+            if restart >= 0 and (stop < 0 or restart < stop):
+                # start of a new telegram, the current one was cut short
+                if DEBUG:
+                    debug("P1 telegram truncated at %d bytes" % (P1_LENGTH))
+                P1_STATE = 0
+                start = restart
+                continue
+            if stop < 0:
+                stop = end
+            else:
+                stop += 1
+                P1_STATE = 2
+            if not p1_store(chars, start, stop):
+                if DEBUG:
+                    debug("P1 telegram too large")
+                P1_STATE = 0
+            start = stop
+        else:
+            # crc digits, stored but not part of the crc, anything else
+            # means the telegram was cut short and framing starts again
+            n = P1_LENGTH
+            while start < end and P1_STATE < 6:
+                c = chars[start]
+                if not (48 <= c <= 57 or 65 <= c <= 70 or 97 <= c <= 102):
+                    break
+                P1_BUFFER[n] = chars[start]
+                n += 1
+                start += 1
+                P1_STATE += 1
+            P1_LENGTH = n
+            if P1_STATE < 6:
+                if start == end:
+                    return False
+                if DEBUG:
+                    debug("P1 crc cut short")
+                P1_STATE = 0
+                continue
+            P1_STATE = 0
+            crc = 0
+            for i in range(n - 4, n):
+                c = P1_BUFFER[i]
+                crc = (crc << 4) | (c - 48 if c < 58 else (c | 0x20) - 87)
+            if crc == P1_CRC:
+                P1_NEXT = start
+                return True
+            if DEBUG:
+                debug("Failed crc: %04X calculated %04X" % (crc, P1_CRC))
+            if TRACE:
+                trace(T_CRC_FAIL)
+    return False
+
+
+def p1_frame(data):
+    # frame a complete capture (e.g. TESTDATA), returns the telegram or None
+    global P1_STATE
+    P1_STATE = 0
+    if p1_feed(data):
+        return P1_VIEW[:P1_LENGTH]
+    return None
+
+
+def process_p1(data):
+    global P1_MEMO_LINES, P1_PARSED
+    if data is None:
+        return
 
-micropython.kbd_intr(-1) # disable ctrl-c
-# clear rts
-RTS(0)
+    # crc is validated by the framer, lines are indexed in P1_LINES
+    if DEBUG:
+        print(bytes(data).decode())
+    # lines that did not change since the previous telegram keep their values,
+    # when the lines moved or it is the first telegram everything is parsed
+    memo = P1_MEMO_LINES == P1_LINE_COUNT
+    phases = RP_PHASES[3] if memo else 0b001001
+    end = len(data)
+    obis = OBIS
+    mul = OBIS_MUL
+    same = P1_SAME
+    # process data, we only look for specific types and ignore the rest
+    for n in range(P1_LINE_COUNT):
+        if memo and same[n]:
+            continue
+        # pack the OBIS code up to ( into a key
+        i = P1_LINES[n]
+        key = 0
+        val = 0
+        group = 0
+        while i < end:
+            c = data[i]
+            if 48 <= c <= 57:
+                val = val * 10 + c - 48
+            elif c == 40: # (
+                break
+            elif (c == 45 or c == 58 or c == 46) and group < 4: # - : .
+                key = key * mul[group] + val
+                val = 0
+                group += 1
+            else:
+                break
+            i += 1
+        if i >= end or c != 40 or group != 4:
+            continue
+        entry = obis.get(key * 256 + val)
+        if entry is None:
+            continue
+
+        # skip to the value group, e.g. the gas value is after its timestamp,
+        # a line with fewer groups is ignored
+        skip = entry[3]
+        while skip > 0 and i + 1 < end:
+            i += 1
+            c = data[i]
+            if c == 40:
+                skip -= 1
+            elif c == 13 or c == 10:
+                break
+        if skip:
+            continue
+        # fixed point value up to * or ), scaled to the wanted decimals
+        val = 0
+        decimals = -1
+        i += 1
+        while i < end:
+            c = data[i]
+            if 48 <= c <= 57:
+                val = val * 10 + c - 48
+                if decimals >= 0:
+                    decimals += 1
+            elif c == 46:
+                decimals = 0
+            else:
+                break
+            i += 1
+        if decimals < 0:
+            decimals = 0
+        while decimals < entry[1]:
+            val *= 10
+            decimals += 1
+        while decimals > entry[1]:
+            val //= 10
+            decimals -= 1
+
+        phases |= entry[2]
+        rp = entry[0]
+        if val != rp[3]:
+            if rp[0] == 0:
+                rp[3] = val
+            else:
+                report_set(rp, val)
 
-cntr = 0
+    # the next telegram is compared with this one
+    P1_MEMO_LINES = P1_LINE_COUNT
+    P1_PARSED = True
 
-# wait for network to wake up
-print("Connecting to network ", end="")
-while STATUS != 2:
-    print("%d" % STATUS, end="")
-    utime.sleep_ms(1000)
+    # what is reported is decided by the reporting rules in send_data()
+    if phases != RP_PHASES[3]:
+        report_set(RP_PHASES, phases)
 
+    if RP_L1_P[3] is not None or RP_L2_P[3] is not None or RP_L3_P[3] is not None:
+        p1 = RP_L1_P[3] if RP_L1_P[3] is not None else 0
+        p2 = RP_L2_P[3] if RP_L2_P[3] is not None else 0
+        p3 = RP_L3_P[3] if RP_L3_P[3] is not None else 0
+        report_set(RP_POWER_SUM, p1 + p2 + p3)
 
-def send_data():
-    zcl_send_report(xbee.ADDR_COORDINATOR, 1, 0x0104, REPORTING_ATTRIBUTES)
-    zcl_send_report(xbee.ADDR_COORDINATOR, 2, 0x0104, REPORTING_ATTRIBUTES2)
+    if RP_POWER_IN[3] is not None or RP_POWER_OUT[3] is not None:
+        p1 = RP_POWER_IN[3] if RP_POWER_IN[3] is not None else 0
+        p2 = RP_POWER_OUT[3] if RP_POWER_OUT[3] is not None else 0
+        report_set(RP_DEMAND, p1 - p2)
 
+    if RP_ENERGY_T1[3] is not None or RP_ENERGY_T2[3] is not None:
+        e1 = RP_ENERGY_T1[3] if RP_ENERGY_T1[3] is not None else 0
+        e2 = RP_ENERGY_T2[3] if RP_ENERGY_T2[3] is not None else 0
+        report_set(RP_ENERGY_SUM, e1 + e2)
 
-def read_p1():
-    # read the p1 port by raising RTS
-    RTS(1)
-    data = None
-    timeout = 0
-    finished = False
-    # stdin since we cannot control the primary uart
-    while timeout < 10 and not finished:
-        chars = sys.stdin.buffer.read()
-        if chars is not None and len(chars) > 0 and b"/" in chars:
-            # start found, collect until ! and then 4 more and dump data to process_zcl
-            data = chars[chars.index(b"/"):] # strip !
-            timeout2 = 0
-            while True and timeout2 < 100:
-                chars = sys.stdin.buffer.read()
-                if chars is not None:
-                    data = data + chars
-                    if b'!' in chars:
-                        break
-                timeout2 = timeout2 + 1
-                utime.sleep_ms(10)
-            # ! found, we think
-            timeout3 = 0
-            while data.index(b"!") < len(data) - 4 and timeout3 < 10:
-                utime.sleep_ms(10) # more thant enough to fill buffer
-                chars = sys.stdin.buffer.read()
-                if chars is not None:
-                    data = data + chars
-                timeout3 = timeout3 + 1
-            data = data[:data.index(b'!') + 5]
-            finished = True
-        utime.sleep_ms(50)
-        timeout = timeout + 1
-    if timeout >= 10 and DEBUG:
-        print("P1 Read timeout, skipping cycle")
-        print("Read %s" % (str(data)))
-        return None
+    agg_sample(phases, utime.ticks_ms())
+    history_sample(utime.time())
+    if PASSTHROUGH:
+        passthrough_encode(data, utime.ticks_ms())
 
-    RTS(0)
 
-    return data
+###############################################################
+# Aggregation, every telegram is added to the window that is  #
+# reported next.                                              #
+###############################################################
 
-def process_p1(data, first=False):
-    if data is None:
+# per phase: telegrams, sum, min, max, energy in Ws, time in ms
+AGG = array('l', [0] * 18)
+AGG_TICKS = None # time of the previous telegram
+# ms, a window that is not reported (e.g. while not joined) starts again
+# after this long, before its sums overflow
+AGG_LIMIT = const(3600000)
+# phase bit in RP_PHASES, sampled value, window attributes
+AGG_PHASES = (
+    (0b001000, RP_L1_P, RP_L1_P_MIN, RP_L1_P_MAX, RP_L1_P_MEAN, RP_L1_P_AVG),
+    (0b010000, RP_L2_P, RP_L2_P_MIN, RP_L2_P_MAX, RP_L2_P_MEAN, RP_L2_P_AVG),
+    (0b100000, RP_L3_P, RP_L3_P_MIN, RP_L3_P_MAX, RP_L3_P_MEAN, RP_L3_P_AVG),
+)
+
+
+def agg_sample(phases, now):
+    # add the phases present in this telegram, a value holds since the previous telegram
+    global AGG_TICKS
+    dt = 0 if AGG_TICKS is None else min(utime.ticks_diff(now, AGG_TICKS), AGG_LIMIT)
+    AGG_TICKS = now
+    agg = AGG
+    n = 0
+    for phase in AGG_PHASES:
+        if agg[n + 5] >= AGG_LIMIT:
+            for i in range(n, n + 6):
+                agg[i] = 0
+        p = phase[1][3]
+        if phases & phase[0] and p is not None:
+            if agg[n] == 0 or p < agg[n + 2]:
+                agg[n + 2] = p
+            if agg[n] == 0 or p > agg[n + 3]:
+                agg[n + 3] = p
+            agg[n] += 1
+            agg[n + 1] += p
+            agg[n + 4] += p * dt // 1000
+            agg[n + 5] += dt
+        n += 6
+
+
+def agg_publish():
+    # write the window so far into its attributes, returns True when there is one
+    agg = AGG
+    n = 0
+    for phase in AGG_PHASES:
+        count = agg[n]
+        if count:
+            report_set(phase[2], agg[n + 2])
+            report_set(phase[3], agg[n + 3])
+            report_set(phase[4], agg[n + 1] // count)
+            report_set(phase[5], agg[n + 4] * 1000 // agg[n + 5] if agg[n + 5] else agg[n + 1] // count)
+        n += 6
+
+
+def agg_reset():
+    for n in range(len(AGG)):
+        AGG[n] = 0
+
+
+###############################################################
+# Backlog, the energy and gas counters are kept while they    #
+# cannot be reported and sent in small batches after a rejoin.#
+###############################################################
+
+# per record: utime.time(), energy t1, t2, delivered t1, t2, gas, -1 if unknown
+BACKLOG_FIELDS = (RP_ENERGY_T1, RP_ENERGY_T2, RP_ENERGY_D_T1, RP_ENERGY_D_T2, RP_GAS)
+BACKLOG_RECORD = 1 + len(BACKLOG_FIELDS)
+BACKLOG = array('l', [0] * (BACKLOG_SIZE * BACKLOG_RECORD))
+# first record, number of records, time of the last one, records added since the last save
+BACKLOG_STATE = array('l', [0, 0, 0, 0])
+# time of a record loaded from BACKLOG_FILE, the clock started again after the reset
+BACKLOG_UNKNOWN = const(-0x40000000)
+# P1 data cluster command 0x00: FC, manufacturer, TSQ, 0x00, then per record
+# age in seconds (uint32, 0xffffffff unknown), the counters (uint48) oldest first
+BACKLOG_FRAME = bytearray(5 + 34 * 4)
+BACKLOG_FRAME[0] = 0x1d # cluster specific, manufacturer specific, to client, no default response
+BACKLOG_FRAME[1] = MANUFACTURER_CODE & 0xFF
+BACKLOG_FRAME[2] = MANUFACTURER_CODE >> 8
+BACKLOG_FRAME[4] = 0x00 # backlog records
+
+
+def backlog_add(now):
+    # keep the counters, at most every BACKLOG_INTERVAL, the oldest record
+    # is dropped when the backlog is full
+    first, count, last, added = BACKLOG_STATE
+    if count and now - last < BACKLOG_INTERVAL:
+        return False
+    if count == BACKLOG_SIZE:
+        first = (first + 1) % BACKLOG_SIZE
+        count -= 1
+    i = ((first + count) % BACKLOG_SIZE) * BACKLOG_RECORD
+    BACKLOG[i] = now
+    for rp in BACKLOG_FIELDS:
+        i += 1
+        BACKLOG[i] = rp[3] if rp[3] is not None else -1
+    BACKLOG_STATE[0] = first
+    BACKLOG_STATE[1] = count + 1
+    BACKLOG_STATE[2] = now
+    BACKLOG_STATE[3] = added + 1
+    if added + 1 >= BACKLOG_SAVE:
+        backlog_save()
+    return True
+
+
+def backlog_frame(now):
+    # fill BACKLOG_FRAME with the oldest records that fit, returns the number of records
+    first, count = BACKLOG_STATE[0], BACKLOG_STATE[1]
+    frame = BACKLOG_FRAME
+    n = 5
+    records = 0
+    while records < count and n + 34 <= min(len(frame), MAX_PAYLOAD):
+        i = ((first + records) % BACKLOG_SIZE) * BACKLOG_RECORD
+        age = now - BACKLOG[i]
+        if BACKLOG[i] == BACKLOG_UNKNOWN or age < 0:
+            age = -1 # recorded before a reset, the clock started again
+        for j in range(4):
+            frame[n] = age & 0xFF
+            age >>= 8
+            n += 1
+        for k in range(i + 1, i + BACKLOG_RECORD):
+            value = BACKLOG[k]
+            for j in range(6):
+                frame[n] = value & 0xFF
+                value >>= 8
+                n += 1
+        records += 1
+    return records
+
+
+def backlog_drop(records):
+    # the file is rewritten once the backlog is sent, a reset before that
+    # sends the records again
+    BACKLOG_STATE[0] = (BACKLOG_STATE[0] + records) % BACKLOG_SIZE
+    BACKLOG_STATE[1] -= records
+    if BACKLOG_STATE[1] == 0:
+        backlog_save()
+
+
+def backlog_save():
+    BACKLOG_STATE[3] = 0
+    if BACKLOG_FILE is None:
         return
+    try:
+        with open(BACKLOG_FILE, "wb") as f:
+            f.write(BACKLOG_STATE)
+            f.write(BACKLOG)
+    except Exception as e:
+        if DEBUG:
+            debug("Backlog not saved: %s" % (e))
 
-    crc = int(data[-4:], 16)
 
-    md = memoryview(data)
-    calc_crc = crc16(md[:-4])
+def backlog_load():
+    if BACKLOG_FILE is None:
+        return
+    try:
+        with open(BACKLOG_FILE, "rb") as f:
+            state = array('l', [0] * len(BACKLOG_STATE))
+            if f.readinto(state) == len(state) * state.itemsize and \
+                    f.readinto(BACKLOG) == len(BACKLOG) * BACKLOG.itemsize and \
+                    0 <= state[1] <= BACKLOG_SIZE:
+                BACKLOG_STATE[0] = state[0] % BACKLOG_SIZE
+                BACKLOG_STATE[1] = state[1]
+                BACKLOG_STATE[2] = 0
+                # the clock started again, the age of these records is unknown
+                for k in range(0, len(BACKLOG), BACKLOG_RECORD):
+                    BACKLOG[k] = BACKLOG_UNKNOWN
+    except Exception:
+        pass
 
-    if DEBUG:
-        print(data.decode())
-    if ALWAYS_PUBLISH:
-        first = True
 
-    if crc != calc_crc:
-        debug("Failed crc: %04X calculated %04X" % (crc, calc_crc))
+###############################################################
+# History, a sample every HISTORY_INTERVAL that the           #
+# coordinator can download to fill a gap in its data.         #
+###############################################################
+
+# per sample: average power L1, L2, L3 in W, energy used, energy delivered in
+# Wh and gas in dm3 since the previous sample, 0xffff if unknown
+HISTORY_PHASES = (RP_L1_P, RP_L2_P, RP_L3_P)
+HISTORY_COUNTERS = ((RP_ENERGY_T1, RP_ENERGY_T2), (RP_ENERGY_D_T1, RP_ENERGY_D_T2), (RP_GAS,))
+HISTORY_RECORD = len(HISTORY_PHASES) + len(HISTORY_COUNTERS)
+HISTORY = array('H', [0] * (HISTORY_SIZE * HISTORY_RECORD))
+HISTORY_TIME = array('l', [0] * HISTORY_SIZE) # utime.time() of every sample
+# first sample, number of samples, time saved, counters at the last sample
+# (-1 unknown), samples not saved yet
+HISTORY_STATE = array('l', [0, 0, 0, -1, -1, -1, 0])
+# per phase: telegrams and the sum of their power since the last sample
+HISTORY_SUM = array('l', [0] * (2 * len(HISTORY_PHASES)))
+HISTORY_START = None # time the current sample started
+# the download in progress: destination, request TSQ, fragment number and the
+# time range still to send
+HISTORY_SINK = None
+HISTORY_TSQ = 0
+HISTORY_INDEX = 0
+HISTORY_FROM = 0
+HISTORY_TO = 0
+# P1 data cluster command 0x02: FC, manufacturer, TSQ, 0x02, request TSQ,
+# fragment number (0x80 set on the last), age of the first sample in seconds
+# (uint32), then per sample, oldest first, the seconds since the previous one
+# (uint16) and the values (uint16)
+HISTORY_FRAME = bytearray(128)
+HISTORY_FRAME[0] = 0x1d
+HISTORY_FRAME[1] = MANUFACTURER_CODE & 0xFF
+HISTORY_FRAME[2] = MANUFACTURER_CODE >> 8
+HISTORY_FRAME[4] = 0x02 # history samples
+
+
+def history_sample(now):
+    # add the phase powers of this telegram, a sample is kept every HISTORY_INTERVAL
+    global HISTORY_START
+    sums = HISTORY_SUM
+    n = 0
+    for rp in HISTORY_PHASES:
+        if rp[3] is not None:
+            sums[n] += 1
+            sums[n + 1] += rp[3]
+        n += 2
+    if HISTORY_START is None:
+        HISTORY_START = now
+    elif now - HISTORY_START >= HISTORY_INTERVAL:
+        HISTORY_START = now
+        history_add(now)
+
+
+def history_add(now):
+    # keep the averages and the counter deltas, the oldest sample is dropped
+    # when the history is full
+    state = HISTORY_STATE
+    first = state[0]
+    count = state[1]
+    if count == HISTORY_SIZE:
+        first = (first + 1) % HISTORY_SIZE
+        count -= 1
+    k = (first + count) % HISTORY_SIZE
+    HISTORY_TIME[k] = now
+    i = k * HISTORY_RECORD
+    sums = HISTORY_SUM
+    for n in range(0, len(sums), 2):
+        HISTORY[i] = min(sums[n + 1] // sums[n], 0xfffe) if sums[n] else 0xffff
+        sums[n] = 0
+        sums[n + 1] = 0
+        i += 1
+    n = 3
+    for group in HISTORY_COUNTERS:
+        value = -1
+        for rp in group:
+            if rp[3] is not None:
+                value = rp[3] if value < 0 else value + rp[3]
+        last = state[n]
+        HISTORY[i] = value - last if value >= 0 and last >= 0 and 0 <= value - last < 0xffff else 0xffff
+        state[n] = value
+        n += 1
+        i += 1
+    state[0] = first
+    state[1] = count + 1
+    state[6] += 1
+    if state[6] >= HISTORY_SAVE:
+        history_save(now)
+
+
+def history_request(sender, data):
+    # command 0x02 from the coordinator: FC, manufacturer, TSQ, 0x02, oldest
+    # and newest age in seconds (uint32), the samples between them are sent
+    # by task_history(), a new request replaces the one in progress. data
+    # starts 2 bytes before the TSQ, process_zcl() dropped the manufacturer
+    global HISTORY_SINK, HISTORY_TSQ, HISTORY_INDEX, HISTORY_FROM, HISTORY_TO
+    if len(data) < 11:
         return
+    now = utime.time()
+    HISTORY_FROM = now - int.from_bytes(data[3:7], 'little')
+    HISTORY_TO = now - int.from_bytes(data[7:11], 'little')
+    HISTORY_TSQ = data[1]
+    HISTORY_INDEX = 0
+    HISTORY_SINK = sender
+    event_set(EV_HISTORY)
+
+
+def history_frame(now):
+    # fill HISTORY_FRAME with the next samples of the request, returns the
+    # frame length and whether no samples are left
+    global HISTORY_FROM, HISTORY_INDEX
+    frame = HISTORY_FRAME
+    size = min(len(frame), MAX_PAYLOAD)
+    first = HISTORY_STATE[0]
+    n = 11
+    previous = None
+    done = True
+    for j in range(HISTORY_STATE[1]):
+        k = (first + j) % HISTORY_SIZE
+        t = HISTORY_TIME[k]
+        if t < HISTORY_FROM:
+            continue
+        if t > HISTORY_TO:
+            break
+        if n + 2 + 2 * HISTORY_RECORD > size:
+            done = False
+            break
+        if previous is None:
+            age = max(now - t, 0)
+            for i in range(7, 11):
+                frame[i] = age & 0xFF
+                age >>= 8
+            gap = 0
+        else:
+            gap = min(t - previous, 0xffff)
+        previous = t
+        frame[n] = gap & 0xFF
+        frame[n + 1] = gap >> 8
+        n += 2
+        for i in range(k * HISTORY_RECORD, (k + 1) * HISTORY_RECORD):
+            value = HISTORY[i]
+            frame[n] = value & 0xFF
+            frame[n + 1] = value >> 8
+            n += 2
+    if previous is None:
+        for i in range(7, 11):
+            frame[i] = 0
+    else:
+        HISTORY_FROM = previous + 1
+    frame[5] = HISTORY_TSQ
+    frame[6] = (HISTORY_INDEX & 0x7F) | (0x80 if done else 0)
+    HISTORY_INDEX += 1
+    return n, done
 
-    global REPORTING_ATTRIBUTES
-    global REPORTING_ATTRIBUTES2
-    global RP_ENERGY_T1
-    global RP_ENERGY_T2
-    global RP_ENERGY_D_T1
-    global RP_ENERGY_D_T2
-    global RP_L1_A
-    global RP_L1_V
-    global RP_L1_P
-    global RP_L2_A
-    global RP_L2_V
-    global RP_L2_P
-    global RP_L3_A
-    global RP_L3_V
-    global RP_L3_P
-    global RP_V_MUL
-    global RP_V_DIV
-    global RP_A_MUL
-    global RP_A_DIV
-    global RP_P_MUL
-    global RP_P_DIV
-    global RP_PHASES
-    global RP_GAS
-    REPORTING_ATTRIBUTES = []
-    REPORTING_ATTRIBUTES2 = []
-
-    phases = 0b001001
-    # process data, we only look for specific types and ignore the rest
-    for line in data.split(b"\r\n"):
-        if b"1-0:1.8.1" in line: # energy in t1
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(6, 'little')
-            if val != RP_ENERGY_T1[3] or first:
-                RP_ENERGY_T1[3] = val
-                REPORTING_ATTRIBUTES.append(RP_ENERGY_T1)
-        elif b"1-0:1.8.2" in line: # energy in t2
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(6, 'little')
-            if val != RP_ENERGY_T2[3] or first:
-                RP_ENERGY_T2[3] = val
-                REPORTING_ATTRIBUTES.append(RP_ENERGY_T2)
-        elif b"1-0:2.8.1" in line: # energy from t1
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(6, 'little')
-            if val != RP_ENERGY_D_T1[3] or first:
-                RP_ENERGY_D_T1[3] = val
-                REPORTING_ATTRIBUTES.append(RP_ENERGY_D_T1)
-        elif b"1-0:2.8.2" in line: # energy from t2
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(6, 'little')
-            if val != RP_ENERGY_D_T2[3] or first:
-                RP_ENERGY_D_T2[3] = val
-                REPORTING_ATTRIBUTES.append(RP_ENERGY_D_T2)
-        elif b"1-0:1.7.0" in line: # Actual total power received from net
-            pass
-        elif b"1-0:2.7.0" in line: # Actual total power delivered to net
-            pass
-        elif b"1-0:31.7.0" in line: # amps from L1
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            if val != RP_L1_A[3] or first:
-                RP_L1_A[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L1_A)
-        elif b"1-0:51.7.0" in line: # amps from L2
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b010000
-            if val != RP_L2_A[3] or first:
-                RP_L2_A[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L2_A)
-        elif b"1-0:71.7.0" in line: # amps from L3
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b100000
-            if val != RP_L3_A[3] or first:
-                RP_L3_A[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L3_A)
-        elif b"1-0:32.7.0" in line: # volts from L1
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            if val != RP_L1_V[3] or first:
-                RP_L1_V[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L1_V)
-        elif b"1-0:52.7.0" in line: # volts from L2
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b010000
-            if val != RP_L2_V[3] or first:
-                RP_L2_V[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L2_V)
-        elif b"1-0:72.7.0" in line: # volts from L3
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b100000
-            if val != RP_L3_V[3] or first:
-                RP_L3_V[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L3_V)
-        elif b"1-0:21.7.0" in line: # POWER from L1
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            if val != RP_L1_P[3] or first:
-                RP_L1_P[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L1_P)
-        elif b"1-0:41.7.0" in line: # POWER from L2
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b010000
-            if val != RP_L2_P[3] or first:
-                RP_L2_P[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L2_P)
-        elif b"1-0:61.7.0" in line: # POWER from L3
-            val = int(line[line.index(b"(") + 1: line.index(b"*")].replace(b".", b"")).to_bytes(2, 'little')
-            phases |= 0b100000
-            if val != RP_L3_P[3] or first:
-                RP_L3_P[3] = val
-                REPORTING_ATTRIBUTES.append(RP_L3_P)
-        elif b"0-1:24.2.1" in line: # gas meter
-            line2 = line[line.index(b"(") + 1:]
-            val = int(line2[line2.index(b"(") + 1: line2.index(b"*")].replace(b".", b"")).to_bytes(6, 'little')
-            if val != RP_GAS[3] or first:
-                RP_GAS[3] = val
-                REPORTING_ATTRIBUTES2.append(RP_GAS)
-
-    phases = phases.to_bytes(4, 'little')
-    if phases != RP_PHASES[3] or first or ALWAYS_PUBLISH:
-        RP_PHASES[3] = phases
-        REPORTING_ATTRIBUTES.append(RP_PHASES)
-        REPORTING_ATTRIBUTES.append(RP_V_MUL)
-        REPORTING_ATTRIBUTES.append(RP_V_DIV)
-        REPORTING_ATTRIBUTES.append(RP_A_MUL)
-        REPORTING_ATTRIBUTES.append(RP_A_DIV)
-        REPORTING_ATTRIBUTES.append(RP_P_MUL)
-        REPORTING_ATTRIBUTES.append(RP_P_DIV)
 
-    if RP_L1_P[3] is not None or RP_L2_P[3] is not None or RP_L3_P[3] is not None:
-        p1 = int.from_bytes(RP_L1_P[3], 'little') if RP_L1_P[3] is not None else 0
-        p2 = int.from_bytes(RP_L2_P[3], 'little') if RP_L2_P[3] is not None else 0
-        p3 = int.from_bytes(RP_L3_P[3], 'little') if RP_L3_P[3] is not None else 0
-        RP_POWER_SUM[3] = int(p1 + p2 + p3).to_bytes(4, 'little')
-        REPORTING_ATTRIBUTES.append(RP_POWER_SUM)
+def history_save(now):
+    HISTORY_STATE[6] = 0
+    if HISTORY_FILE is None:
+        return
+    HISTORY_STATE[2] = now
+    try:
+        with open(HISTORY_FILE, "wb") as f:
+            f.write(HISTORY_STATE)
+            f.write(HISTORY_TIME)
+            f.write(HISTORY)
+    except Exception as e:
+        if DEBUG:
+            debug("History not saved: %s" % (e))
 
-    if RP_ENERGY_T1[3] is not None or RP_ENERGY_T2[3] is not None:
-        e1 = int.from_bytes(RP_ENERGY_T1[3], 'little') if RP_ENERGY_T1[3] is not None else 0
-        e2 = int.from_bytes(RP_ENERGY_T2[3], 'little') if RP_ENERGY_T2[3] is not None else 0
-        RP_ENERGY_SUM[3] = int(e1 + e2).to_bytes(6, 'little')
-        REPORTING_ATTRIBUTES.append(RP_ENERGY_SUM)
-
-    if first or ALWAYS_PUBLISH:
-        REPORTING_ATTRIBUTES.append(RP_ENERGY_STATUS)
-        REPORTING_ATTRIBUTES.append(RP_ENERGY_MUL)
-        REPORTING_ATTRIBUTES.append(RP_ENERGY_DIV)
-        REPORTING_ATTRIBUTES.append(RP_ENERGY_UOM)
-        REPORTING_ATTRIBUTES2.append(RP_GAS_STATUS)
-        REPORTING_ATTRIBUTES2.append(RP_GAS_MUL)
-        REPORTING_ATTRIBUTES2.append(RP_GAS_DIV)
-        REPORTING_ATTRIBUTES2.append(RP_GAS_UOM)
-
-    if len(REPORTING_ATTRIBUTES) > 0:
-        send_data()
-
-timeout_counter = 0
-
-while True:
+
+def history_load():
+    # the clock starts again after a reset, the samples are moved as if the
+    # history was saved right before it, the time the device was off is lost
+    if HISTORY_FILE is None:
+        return
     try:
+        with open(HISTORY_FILE, "rb") as f:
+            state = array('l', [0] * len(HISTORY_STATE))
+            if f.readinto(state) == len(state) * state.itemsize and \
+                    f.readinto(HISTORY_TIME) == len(HISTORY_TIME) * HISTORY_TIME.itemsize and \
+                    f.readinto(HISTORY) == len(HISTORY) * HISTORY.itemsize and \
+                    0 <= state[1] <= HISTORY_SIZE:
+                shift = utime.time() - state[2]
+                for k in range(HISTORY_SIZE):
+                    HISTORY_TIME[k] += shift
+                HISTORY_STATE[0] = state[0] % HISTORY_SIZE
+                HISTORY_STATE[1] = state[1]
+    except Exception:
+        pass
+
+
+###############################################################
+# Passthrough, the complete telegram is encoded as changes to #
+# the previously sent one and sent in fragments.              #
+###############################################################
+
+# encoded telegram: type (0 full, 1 changes), sequence number, number of lines,
+# full: the telegram, changes: a bit per line that changed (lsb first) and per
+# changed line the length of the unchanged start and end and the new middle:
+# start, end, length, bytes
+PT_PREV = None # the last encoded telegram and its lines
+PT_PREV_LINES = None
+PT_PREV_LENGTH = 0
+PT_PREV_COUNT = 0
+PT_BUFFER = None
+PT_VIEW = None
+PT_LENGTH = 0 # encoded and not sent yet
+PT_SEQUENCE = 0
+PT_LAST = 0 # time of the last one
+PT_KEYFRAME = 0 # telegrams until the next full one
+# P1 data cluster command 0x01: FC, manufacturer, TSQ, 0x01, sequence number,
+# fragment number (0x80 set on the last), part of the encoded telegram
+PT_FRAME = None
+
+
+def passthrough_encode(data, now):
+    global PT_PREV, PT_PREV_LINES, PT_PREV_LENGTH, PT_PREV_COUNT, PT_BUFFER, PT_LENGTH
+    global PT_SEQUENCE, PT_LAST, PT_KEYFRAME, PT_FRAME, PT_VIEW
+    if PT_BUFFER is None:
+        # only allocated when used
+        PT_PREV = bytearray(P1_BUFFER_SIZE)
+        PT_PREV_LINES = array('H', [0] * (P1_MAX_LINES + 1))
+        PT_BUFFER = bytearray(P1_BUFFER_SIZE + 3)
+        PT_VIEW = memoryview(PT_BUFFER)
+        PT_FRAME = bytearray(128)
+        PT_FRAME[0] = 0x1d
+        PT_FRAME[1] = MANUFACTURER_CODE & 0xFF
+        PT_FRAME[2] = MANUFACTURER_CODE >> 8
+        PT_FRAME[4] = 0x01 # telegram
+    elif PT_PREV_COUNT and utime.ticks_diff(now, PT_LAST) < PASSTHROUGH_INTERVAL * 1000:
+        return
+    length = len(data)
+    count = P1_LINE_COUNT
+    lines = P1_LINES
+    prev = PT_PREV
+    out = PT_BUFFER
+    PT_SEQUENCE = (PT_SEQUENCE + 1) & 0xFF
+    out[1] = PT_SEQUENCE
+    out[2] = count
+    n = 0
+    # a full telegram when the receiver may not have the previous one
+    if PT_KEYFRAME > 0 and PT_LENGTH == 0 and count == PT_PREV_COUNT:
+        bits = (count + 7) // 8
+        for i in range(3, 3 + bits):
+            out[i] = 0
+        n = 3 + bits
+        for k in range(count):
+            a = lines[k]
+            b = lines[k + 1] if k + 1 < count else length
+            pa = PT_PREV_LINES[k]
+            pb = PT_PREV_LINES[k + 1] if k + 1 < count else PT_PREV_LENGTH
+            same = 0
+            limit = min(b - a, pb - pa, 255)
+            while same < limit and data[a + same] == prev[pa + same]:
+                same += 1
+            if same == b - a and same == pb - pa:
+                continue
+            end = 0
+            limit = min(b - a, pb - pa, 255) - same
+            while end < limit and data[b - 1 - end] == prev[pb - 1 - end]:
+                end += 1
+            middle = b - a - same - end
+            if middle > 255 or n + 3 + middle > length:
+                n = 0
+                break
+            out[3 + (k >> 3)] |= 1 << (k & 7)
+            out[n] = same
+            out[n + 1] = end
+            out[n + 2] = middle
+            n += 3
+            for i in range(a + same, b - end):
+                out[n] = data[i]
+                n += 1
+    if n:
+        out[0] = 1
+        PT_KEYFRAME -= 1
+    else:
+        out[0] = 0
+        out[3:3 + length] = data
+        n = 3 + length
+        PT_KEYFRAME = PASSTHROUGH_KEYFRAME
+    PT_LENGTH = n
+    prev[:length] = data
+    for k in range(count):
+        PT_PREV_LINES[k] = lines[k]
+    PT_PREV_LENGTH = length
+    PT_PREV_COUNT = count
+    PT_LAST = now
+
+
+def passthrough_send(sink):
+    # send the encoded telegram in fragments, returns the success of each transmit
+    global PT_LENGTH, PT_KEYFRAME
+    results = []
+    frame = PT_FRAME
+    view = memoryview(frame)
+    size = min(len(frame), MAX_PAYLOAD) - 7
+    start = 0
+    index = 0
+    frame[5] = PT_BUFFER[1]
+    while start < PT_LENGTH:
+        stop = min(start + size, PT_LENGTH)
+        frame[6] = index | (0x80 if stop == PT_LENGTH else 0)
+        view[7:7 + stop - start] = PT_VIEW[start:stop]
+        if not zcl_transmit(sink, 1, CLUSTER_P1, 0x0104, view[:7 + stop - start], 3):
+            # the receiver misses this one, the next is sent in full
+            PT_KEYFRAME = 0
+            results.append(False)
+            break
+        results.append(True)
+        start = stop
+        index += 1
+    PT_LENGTH = 0
+    return results
+
+
+###############################################################
+# Tracing, events go into a ring buffer of (ticks_us, event   #
+# << 16 | argument) pairs. Calls are behind "if TRACE:" so    #
+# they are not compiled in when TRACE is 0, and the buffers   #
+# are only allocated with TRACE.                              #
+###############################################################
+
+T_TELEGRAM = const(1) # argument: length
+T_CRC_FAIL = const(2)
+T_P1_TIMEOUT = const(3) # argument: bytes received
+T_PARSED = const(4) # argument: number of lines
+T_TRANSMIT = const(5) # argument: cluster
+T_TRANSMIT_FAIL = const(6) # argument: cluster
+T_RECEIVE_ZDO = const(7) # argument: cluster
+T_RECEIVE_ZCL = const(8) # argument: cluster
+T_STATUS = const(9) # argument: modem status
+T_COLLECT = const(10) # argument: free heap / 16
+T_REPORT_LOST = const(11) # argument: sequence number
+TRACE_NAMES = None
+TRACE_EVENTS = None
+TRACE_INDEX = 0
+
+TIME_UART = const(0) # from the first byte of a telegram to its crc
+TIME_CRC = const(1) # framing and crc
+TIME_PARSE = const(2)
+TIME_ENCODE = const(3) # sending reports except the transmits
+TIME_TRANSMIT = const(4)
+TIMES = None # us per phase in this cycle
+TIME_NAMES = None
+
+
+def trace_setup():
+    # allocate the trace buffers, at import when TRACE is 1
+    global TRACE_NAMES, TRACE_EVENTS, TIMES, TIME_NAMES
+    TRACE_NAMES = (None, "telegram", "crc fail", "p1 timeout", "parsed", "transmit", "transmit fail",
+                   "receive zdo", "receive zcl", "status", "collect", "report lost")
+    TRACE_EVENTS = array('l', [0] * (TRACE_SIZE * 2))
+    TIMES = array('l', [0] * 5)
+    TIME_NAMES = ("uart", "crc", "parse", "encode", "transmit")
+
+if TRACE:
+    trace_setup()
+
+
+def trace(event, argument=0):
+    global TRACE_INDEX
+    i = TRACE_INDEX
+    TRACE_EVENTS[i] = utime.ticks_us()
+    TRACE_EVENTS[i + 1] = (event << 16) | (argument & 0xFFFF)
+    i += 2
+    if i >= len(TRACE_EVENTS):
+        i = 0
+    TRACE_INDEX = i
+
+
+def trace_publish():
+    # the times of this cycle become readable attributes
+    for i in range(len(TIMES)):
+        report_set(RP_DIAG_TIMES[i], TIMES[i] & 0x3FFFFFFF)
+        TIMES[i] = 0
+
+
+def trace_dump():
+    # print the events oldest first and the times of the last cycle, from the REPL
+    n = len(TRACE_EVENTS)
+    for j in range(0, n, 2):
+        i = (TRACE_INDEX + j) % n
+        event = TRACE_EVENTS[i + 1] >> 16
+        if event:
+            print("%10d %-14s %d" % (TRACE_EVENTS[i], TRACE_NAMES[event], TRACE_EVENTS[i + 1] & 0xFFFF))
+    for i in range(len(TIMES)):
+        print("%-8s %d us" % (TIME_NAMES[i], RP_DIAG_TIMES[i][3] or 0))
+
+
+###############################################################
+# Memory, the heap is collected at a quiet point right after  #
+# the reports are sent instead of while the uart is read.     #
+###############################################################
+
+MEM_READ = 0
+MEM_PARSE = 1
+MEM_SEND = 2
+MEM_ALLOC = array('l', [0, 0, 0]) # bytes allocated in this cycle per phase
+
+
+def mem_count(phase, start):
+    # add what was allocated since gc.mem_alloc() was start, a collection
+    # in between makes it negative and is not counted
+    allocated = gc.mem_alloc() - start
+    if allocated > 0:
+        MEM_ALLOC[phase] += allocated
+    free = gc.mem_free()
+    if RP_DIAG_MEM_LOW[3] is None or free < RP_DIAG_MEM_LOW[3]:
+        report_set(RP_DIAG_MEM_LOW, free)
+
+
+def mem_collect():
+    # publish the counters of this cycle and collect
+    report_set(RP_DIAG_ALLOC_READ, MEM_ALLOC[MEM_READ])
+    report_set(RP_DIAG_ALLOC_PARSE, MEM_ALLOC[MEM_PARSE])
+    report_set(RP_DIAG_ALLOC_SEND, MEM_ALLOC[MEM_SEND])
+    MEM_ALLOC[MEM_READ] = 0
+    MEM_ALLOC[MEM_PARSE] = 0
+    MEM_ALLOC[MEM_SEND] = 0
+    gc.collect()
+    report_set(RP_DIAG_MEM_FREE, gc.mem_free())
+    report_set(RP_DIAG_COLLECTS, (RP_DIAG_COLLECTS[3] + 1) & 0xFFFFFF)
+    if TRACE:
+        trace_publish()
+        trace(T_COLLECT, RP_DIAG_MEM_FREE[3] >> 4)
+
+
+def mem_setup():
+    # automatic collection only as a safety net
+    gc.collect()
+    # the threshold counts the bytes allocated since the last collection
+    gc.threshold(gc.mem_free() // GC_FRACTION)
+    report_set(RP_DIAG_MEM_FREE, gc.mem_free())
+
+
+def fault_load():
+    # the fault that caused the last reset, if any
+    try:
+        with open(FAULT_FILE) as f:
+            resets, fault = f.read().split()
+        report_set(RP_DIAG_RESETS, int(resets))
+        report_set(RP_DIAG_FAULT, int(fault))
+    except Exception:
+        pass
+
+
+def fault_save(e):
+    try:
+        with open(FAULT_FILE, "w") as f:
+            f.write("%d %d" % (min(RP_DIAG_RESETS[3] + 1, 0xFFFF), 1 if isinstance(e, MemoryError) else 2))
+    except Exception:
+        pass
+
+
+###############################################################
+# Tasks, a small cooperative scheduler (there is no uasyncio  #
+# on the XBee3). Tasks are generators that yield the time in  #
+# ms to sleep, or an event to wait for.                       #
+###############################################################
+
+TASKS = [] # [wake time, generator, event waited for]
+EV_TELEGRAM = ["telegram"] # a validated telegram is in P1_BUFFER
+EV_PARSED = ["parsed"] # the telegram was parsed, P1_BUFFER is free again
+EV_STATUS = ["status"] # modem status changed
+EV_REPORT = ["report"] # values were updated
+EV_HISTORY = ["history"] # the coordinator requested history
+
+
+def task_start(gen):
+    TASKS.append([utime.ticks_ms(), gen, None])
+
+
+def event_set(event):
+    # wake all tasks waiting for the event
+    now = utime.ticks_ms()
+    for task in TASKS:
+        if task[2] is event:
+            task[0] = now
+            task[2] = None
+
+
+def run_once():
+    # run the tasks that are due, returns the time in ms until the next one is
+    now = utime.ticks_ms()
+    wait = 1000
+    for task in TASKS:
+        if task[2] is not None:
+            continue
+        delay = utime.ticks_diff(task[0], now)
+        if delay <= 0:
+            ret = next(task[1])
+            if isinstance(ret, int):
+                task[0] = utime.ticks_add(now, ret)
+            else:
+                task[2] = ret
+            # tasks may have set events, look again before sleeping
+            wait = 0
+        elif delay < wait:
+            wait = delay
+    return wait
+
+
+def run():
+    while True:
+        wait = run_once()
+        if wait > 0:
+            utime.sleep_ms(wait)
+
+
+def task_p1():
+    # read the p1 port whenever data is available, the telegram is framed
+    # and crc checked while it arrives
+    global P1_STATE
+    RTS(1)
+    P1_STATE = 0
+    started = 0
+    chars = None
+    while True:
+        mem = gc.mem_alloc()
+        if not chars:
+            # stdin since we cannot control the primary uart
+            chars = sys.stdin.buffer.read()
+            #chars = TESTDATA # switch out to do DEBUG test runs
+        if chars:
+            if P1_STATE == 0:
+                started = utime.ticks_ms()
+                if TRACE:
+                    started_us = utime.ticks_us()
+            if TRACE:
+                start = utime.ticks_us()
+            done = p1_feed(chars)
+            if TRACE:
+                TIMES[TIME_CRC] += utime.ticks_diff(utime.ticks_us(), start)
+            mem_count(MEM_READ, mem)
+            if done:
+                if TRACE:
+                    TIMES[TIME_UART] += utime.ticks_diff(utime.ticks_us(), started_us)
+                    trace(T_TELEGRAM, P1_LENGTH)
+                event_set(EV_TELEGRAM)
+                # the rest of the read can be the start of the next telegram
+                chars = chars[P1_NEXT:]
+                # wait for the parser before the buffer is reused
+                yield EV_PARSED
+                continue
+            chars = None
+        if P1_STATE != 0:
+            if utime.ticks_diff(utime.ticks_ms(), started) > P1_TIMEOUT:
+                if DEBUG:
+                    debug("P1 Read timeout at %d bytes" % (P1_LENGTH))
+                if TRACE:
+                    trace(T_P1_TIMEOUT, P1_LENGTH)
+                P1_STATE = 0
+            yield 10 # in a telegram, keep up with the uart
+        else:
+            yield 50
+
+
+def task_parse():
+    while True:
+        yield EV_TELEGRAM
+        mem = gc.mem_alloc()
+        if TRACE:
+            start = utime.ticks_us()
+        try:
+            process_p1(P1_VIEW[:P1_LENGTH])
+        finally:
+            event_set(EV_PARSED)
+        if TRACE:
+            TIMES[TIME_PARSE] += utime.ticks_diff(utime.ticks_us(), start)
+            trace(T_PARSED, P1_LINE_COUNT)
+        mem_count(MEM_PARSE, mem)
+        if STATUS == 2:
+            event_set(EV_REPORT)
+        else:
+            # nothing is sent, keep the counters and collect here
+            backlog_add(utime.time())
+            mem_collect()
+
+
+def task_report():
+    # report right after every parsed telegram, once joined
+    # the network can leave and rejoin while the task waits for EV_REPORT,
+    # JOINS tells a new join apart
+    global MAX_PAYLOAD
+    joins = 0
+    while True:
+        if STATUS != 2:
+            yield EV_STATUS
+            continue
+        if joins != JOINS:
+            # the maximum payload depends on the network (encryption, source routing)
+            np = xbee.atcmd("NP")
+            if np:
+                MAX_PAYLOAD = np
+                discovery_payload()
+            joins = JOINS
+            report_static()
+            # what was parsed before the join is reported right away
+        else:
+            yield EV_REPORT
+        if STATUS == 2:
+            mem = gc.mem_alloc()
+            if TRACE:
+                start = utime.ticks_us()
+                transmit = TIMES[TIME_TRANSMIT]
+            link_check(utime.ticks_ms())
+            results = send_data()
+            if False in results:
+                backlog_add(utime.time())
+            elif RP_DIAG_BOOT[3] is None and results:
+                report_set(RP_DIAG_BOOT, utime.ticks_diff(utime.ticks_ms(), BOOT_TICKS))
+            if TRACE:
+                TIMES[TIME_ENCODE] += utime.ticks_diff(utime.ticks_us(), start) - (TIMES[TIME_TRANSMIT] - transmit)
+            mem_count(MEM_SEND, mem)
+        mem_collect()
+
+
+def task_backlog():
+    # after a (re)join the backlog is sent a frame at a time, BACKLOG_DELAY apart
+    while True:
+        if STATUS != 2:
+            yield EV_STATUS
+            # give the network time to settle
+            yield BACKLOG_DELAY
+            continue
+        if BACKLOG_STATE[1] == 0:
+            yield BACKLOG_DELAY * 5
+            continue
+        records = backlog_frame(utime.time())
+        if records == 0:
+            # MAX_PAYLOAD too small for a record
+            yield BACKLOG_DELAY * 60
+            continue
+        if zcl_transmit(xbee.ADDR_COORDINATOR, 1, CLUSTER_P1, 0x0104,
+                        memoryview(BACKLOG_FRAME)[:5 + 34 * records], 3):
+            backlog_drop(records)
+            yield BACKLOG_DELAY
+        else:
+            yield BACKLOG_DELAY * 10
+
+
+def task_history():
+    # send the requested history a frame at a time, HISTORY_DELAY apart,
+    # a failed transmit ends the download
+    global HISTORY_SINK
+    while True:
+        if HISTORY_SINK is None or STATUS != 2:
+            HISTORY_SINK = None
+            yield EV_HISTORY
+            continue
+        n, done = history_frame(utime.time())
+        if not zcl_transmit(HISTORY_SINK, 1, CLUSTER_P1, 0x0104, memoryview(HISTORY_FRAME)[:n], 3) or done:
+            HISTORY_SINK = None
+        yield HISTORY_DELAY
+
+
+def task_led():
+    while True:
+        blink()
+        yield 1000
+
+
+def task_button():
+    while True:
         # If button 5 is pressed, drop to REPL
         if repl_button.value() == 0:
             led(0)
             print("Dropping to REPL")
             sys.exit()
-        # Do nothing
-
-        blink()
-        if timeout_counter == CYCLE_TIME:
-            try:
-                data = read_p1()
-            except Exception as e:
-                print(e)
-                print("Failed to read p1 port data")
-                raise
-            process_p1(data)
-
-            #process_p1(TESTDATA, first)
-            first = False
-            timeout_counter = 0
-
-        utime.sleep_ms(1000) # wait some time
-        timeout_counter = timeout_counter + 1
+        yield 100
+
+
+def at_set(command, value):
+    # write an AT parameter only when it differs, a write can make the modem
+    # leave the network and start joining again
+    if xbee.atcmd(command) != value:
+        xbee.atcmd(command, value)
+
+
+def setup():
+    # the responses are ready before a request can arrive
+    compile_discovery()
+    # register callbacks
+    xbee.modem_status.callback(callback_status)
+    xbee.receive_callback(callback_receive)
+
+    at_set("NI", NAME)
+    # xbee.atcmd("CE", 0) # join cannot be set
+    at_set("AO", 0b00001110)
+    at_set("ID", 0) # broadcast
+    at_set("ZS", 2) # zigbee pro
+    at_set("NJ", 255) # join time
+    at_set("JN", 1) # join network enabled
+    at_set("EO", 0x1B) # make sure we can rejoin
+
+    # after a reset the modem can still be joined, no status change will tell
+    if xbee.atcmd("AI") == 0:
+        callback_status(2)
+
+    micropython.kbd_intr(-1) # disable ctrl-c
+    fault_load()
+    backlog_load()
+    history_load()
+    mem_setup()
+
+    # the meter is read as it sends, reports wait for the network. The
+    # parser starts first so it waits for EV_TELEGRAM before one can be set
+    task_start(task_parse())
+    task_start(task_report())
+    task_start(task_p1())
+    task_start(task_backlog())
+    task_start(task_history())
+    task_start(task_led())
+    task_start(task_button())
+    print("Connecting to network")
+
+
+def main():
+    try:
+        setup()
+        run()
     except Exception as e:
         print("Caught %s" % (str(e)))
         print(e)
+        fault_save(e)
         import machine
         machine.reset()
+
+
+# main.py runs as __main__ on the device, importing it (e.g. from tools/) has no side effects
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the device harness lives in tools/
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools")
+if TOOLS not in sys.path:
+    sys.path.insert(0, TOOLS)
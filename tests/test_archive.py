@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+import archive
+import device
+import xbee
+
+np = pytest.importorskip("numpy")
+
+
+def test_missing_value_group_is_ignored(tmp_path):
+    dev = device.load(modem=xbee.Modem())
+    data = b""
+    # the gas line lacks the value after its timestamp, the next line has a value group
+    for body in (b"/ISK5\\2M550T-1012\r\n\r\n0-1:24.2.1(230101120000W)\r\n1-0:1.8.1(000123.456*kWh)\r\n",
+                 b"/ISK5\\2M550T-1012\r\n\r\n0-1:24.2.1(230101120000W)(00012.345*m3)\r\n1-0:1.8.1(000124.456*kWh)\r\n"):
+        data += body + b"!%04X\r\n" % dev.crc16(body + b"!")
+    path = tmp_path / "capture.p1"
+    path.write_bytes(data)
+
+    archive.process_file((str(path), str(tmp_path / "out")))
+    gas = np.load(os.path.join(str(tmp_path / "out"), "gas.npy"))
+    energy = np.load(os.path.join(str(tmp_path / "out"), "energy_t1.npy"))
+    assert np.isnan(gas[0]) and gas[1] == 12.345
+    assert list(energy) == [123.456, 124.456]
@@ -0,0 +1,65 @@
+import os
+
+import backlog
+import device
+import xbee
+
+
+def test_backlog_frame_round_trip():
+    dev = device.load(modem=xbee.Modem())
+    dev.MAX_PAYLOAD = 84
+    dev.RP_ENERGY_T1[3] = 1234567
+    dev.RP_ENERGY_T2[3] = 7654321
+    dev.RP_ENERGY_D_T1[3] = 0
+    dev.RP_GAS[3] = 4567
+    # RP_ENERGY_D_T2 stays unknown
+    for now in (1000, 1000 + dev.BACKLOG_INTERVAL, 1000 + 2 * dev.BACKLOG_INTERVAL):
+        assert dev.backlog_add(now)
+        dev.RP_ENERGY_T1[3] += 10
+    records = dev.backlog_frame(1000 + 3 * dev.BACKLOG_INTERVAL)
+    assert records == 2 # two records of 34 bytes fit in 84
+
+    decoder = backlog.Records(dev)
+    assert decoder.feed(bytes(dev.BACKLOG_FRAME[:5 + 34 * records]), 7) == 2
+    assert decoder.columns == ["energy_t1", "energy_t2", "energy_d_t1", "energy_d_t2", "gas"]
+    interval = dev.BACKLOG_INTERVAL
+    assert decoder.records == [
+        (7, 3 * interval, (1234.567, 7654.321, 0.0, None, 4.567)),
+        (7, 2 * interval, (1234.577, 7654.321, 0.0, None, 4.567)),
+    ]
+
+
+def test_backlog_file_across_reset(tmp_path):
+    path = str(tmp_path / "backlog.bin")
+    dev = device.load(modem=xbee.Modem())
+    dev.MAX_PAYLOAD = 84
+    dev.BACKLOG_FILE = path
+    dev.RP_ENERGY_T1[3] = 1234567
+    interval = dev.BACKLOG_INTERVAL
+    # the file is written every BACKLOG_SAVE records, not on every one
+    for k in range(dev.BACKLOG_SAVE):
+        assert not os.path.exists(path)
+        assert dev.backlog_add(36000 + k * interval)
+    # a record added after the save is lost with the reset
+    assert dev.backlog_add(36000 + dev.BACKLOG_SAVE * interval)
+
+    # after a reset the clock starts again, the age of the loaded records is unknown
+    dev = device.load(modem=xbee.Modem())
+    dev.MAX_PAYLOAD = 84
+    dev.BACKLOG_FILE = path
+    dev.backlog_load()
+    assert dev.BACKLOG_STATE[1] == dev.BACKLOG_SAVE
+    decoder = backlog.Records(dev)
+    now = 36000 + 3600
+    while dev.BACKLOG_STATE[1]:
+        records = dev.backlog_frame(now)
+        decoder.feed(bytes(dev.BACKLOG_FRAME[:5 + 34 * records]), now)
+        dev.backlog_drop(records)
+    assert [age for _, age, _ in decoder.records] == [None] * dev.BACKLOG_SAVE
+    assert all(values[0] == 1234.567 for _, _, values in decoder.records)
+
+    # the file is rewritten once the backlog is sent
+    dev = device.load(modem=xbee.Modem())
+    dev.BACKLOG_FILE = path
+    dev.backlog_load()
+    assert dev.BACKLOG_STATE[1] == 0
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import decode
+import device
+import xbee
+
+np = pytest.importorskip("numpy")
+
+
+def test_tshark_fields_decode_like_replay(tmp_path):
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    dev.MAX_PAYLOAD = 84
+    telegram = device.telegrams(os.path.join(device.HERE, "corpus", "dsmr42_3phase.p1"))[0]
+    dev.process_p1(dev.p1_frame(telegram))
+    dev.report_reset()
+    dev.send_data()
+    frames = modem.transmits
+    assert len(frames) > 1
+
+    replay = tmp_path / "frames.txt"
+    replay.write_text("".join("1 %d %04X %s\n" % (f.source_ep, f.cluster, f.payload.hex()) for f in frames))
+    # tshark prints an APS ack without cluster or data, and the data with colons
+    tshark = tmp_path / "frames.tsv"
+    tshark.write_text("1700000000.000000\t\t\t\n" + "".join(
+        "%.6f\t%d\t0x%04x\t%s\n" % (1700000000.01 + 0.002 * i, f.source_ep, f.cluster, f.payload.hex(":"))
+        for i, f in enumerate(frames)))
+
+    attributes = decode.AttributeMap(dev)
+    expected = decode.decode(list(decode.read_frames(str(replay))), attributes)
+    columns = decode.decode(list(decode.read_tshark(str(tshark))), attributes)
+    assert len(columns["time"]) == 1 and columns["skipped"] == 0
+    assert columns["energy_t1"][0] == pytest.approx(dev.RP_ENERGY_T1[3] / 1000)
+    for name in attributes.columns:
+        np.testing.assert_array_equal(columns[name], expected[name])
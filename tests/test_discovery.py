@@ -0,0 +1,26 @@
+import device
+import xbee
+
+
+def node_descriptor(modem):
+    modem.simulate_receive(b"\x05\x00\x00", 0x0002, 0x0000)
+    frame = modem.transmits.pop()
+    assert frame.cluster == 0x8002
+    return frame.payload
+
+
+def test_descriptors_are_built_in_setup_with_np():
+    modem = xbee.Modem({"AI": 0, "NP": 66})
+    dev = device.load(modem=modem, serial=device.Serial())
+    # importing main.py reads nothing from the modem
+    assert dev.DISCOVERY[0x0000] == {}
+
+    dev.setup()
+    payload = node_descriptor(modem)
+    assert payload[0] == 0x05
+    assert payload[9] == dev.MAX_PAYLOAD
+    # the first report reads NP and patches the maximum sizes
+    dev.run_once()
+    payload = node_descriptor(modem)
+    assert payload[9] == 66
+    assert payload[10:12] == payload[14:16] == (66).to_bytes(2, "little")
@@ -0,0 +1,119 @@
+import os
+
+import device
+import xbee
+from replay import Replay
+
+FAULTS = os.path.join(device.HERE, "corpus", "faults")
+
+BODY = b"/ISK5\\2M550T-1012\r\n\r\n1-0:1.8.1(001581.123*kWh)\r\n1-0:1.8.2(001435.706*kWh)\r\n"
+
+
+def telegram(dev, body=BODY, crc=None):
+    """A telegram with its CRC, a wrong one when crc is given."""
+    if crc is None:
+        crc = dev.crc16(body + b"!")
+    return body + b"!%04X\r\n" % crc
+
+
+def framed(dev):
+    return bytes(dev.P1_VIEW[:dev.P1_LENGTH])
+
+
+def test_telegram_in_chunks():
+    dev = device.load(modem=xbee.Modem())
+    data = b"noise" + telegram(dev)
+    for i in range(len(data) - 3):
+        assert not dev.p1_feed(data[i:i + 1])
+    # the framer is done with the last crc digit, the line end is not needed
+    assert dev.p1_feed(data[-3:])
+    assert framed(dev) == telegram(dev)[:-2]
+    assert dev.P1_NEXT == 1
+
+
+def test_crc_failure():
+    dev = device.load(modem=xbee.Modem())
+    good = telegram(dev)
+    bad = telegram(dev, crc=dev.crc16(BODY + b"!") ^ 1)
+    assert not dev.p1_feed(bad)
+    assert dev.P1_STATE == 0
+    assert dev.p1_feed(good)
+    assert framed(dev) == good[:-2]
+
+
+def test_restart_drops_truncated_telegram():
+    dev = device.load(modem=xbee.Modem())
+    good = telegram(dev)
+    # cut before the !, and cut in the crc digits
+    for cut in (len(BODY) - 10, len(BODY) + 3):
+        assert dev.p1_feed(good[:cut] + good)
+        assert framed(dev) == good[:-2]
+        assert dev.P1_NEXT == cut + len(good) - 2
+
+
+def test_truncated_mid_stream():
+    dev = device.load(modem=xbee.Modem())
+    good = telegram(dev)
+    # the rest of the telegram never arrives, the next one is framed
+    assert not dev.p1_feed(good[:len(BODY) + 3])
+    assert dev.P1_STATE == 4 # ! and two crc digits
+    assert dev.p1_feed(good)
+    assert framed(dev) == good[:-2]
+
+
+def test_two_telegrams_in_one_read():
+    dev = device.load(modem=xbee.Modem())
+    first = telegram(dev)
+    second = telegram(dev, BODY.replace(b"001581.123", b"001581.124"))
+    chars = first + second
+    assert dev.p1_feed(chars)
+    assert framed(dev) == first[:-2]
+    chars = chars[dev.P1_NEXT:]
+    assert dev.p1_feed(chars)
+    assert framed(dev) == second[:-2]
+    assert not dev.p1_feed(chars[dev.P1_NEXT:])
+
+
+def test_telegram_at_the_buffer_edge():
+    dev = device.load(modem=xbee.Modem())
+    size = dev.P1_BUFFER_SIZE
+    filler = b"0-0:96.13.0(" + b"4" * 100 + b")\r\n"
+    body = BODY
+    while len(body) < size + len(filler):
+        body += filler
+    # the ! in each of the last 4 bytes of the buffer and the byte after it
+    for length in range(size - 3, size + 2):
+        edge = body[:length - 3] + b"\r\n"
+        assert len(edge) + 1 == length
+        assert not dev.p1_feed(telegram(dev, edge))
+        assert dev.P1_STATE == 0
+    # the largest telegram that fits, its crc digits fill the buffer
+    edge = body[:size - 7] + b"\r\n"
+    assert dev.p1_feed(telegram(dev, edge))
+    assert dev.P1_LENGTH == size
+    # and the framer is fine afterwards
+    assert dev.p1_feed(telegram(dev))
+    assert framed(dev) == telegram(dev)[:-2]
+
+
+def replay_counters(data):
+    replay = Replay()
+    frames = []
+    replay.run(data, frames)
+    return replay.telegrams, replay.events["crc fail"], frames
+
+
+def test_capture_faults():
+    clean = device.telegrams(os.path.join(device.HERE, "corpus", "dsmr50_1phase.p1"))
+    # noise, a stray end, telegrams cut before the ! and in the crc, and a
+    # truncated last one: only the complete telegrams are framed
+    with open(os.path.join(FAULTS, "garbage.p1"), "rb") as f:
+        telegrams, failures, frames = replay_counters(f.read())
+    assert (telegrams, failures) == (3, 0)
+    assert frames == replay_counters(b"".join(clean[i] + b"\r\n" for i in (0, 2, 4)))[2]
+
+    # a changed value and a changed crc fail, a lower case crc is fine
+    with open(os.path.join(FAULTS, "badcrc.p1"), "rb") as f:
+        telegrams, failures, frames = replay_counters(f.read())
+    assert (telegrams, failures) == (4, 2)
+    assert frames == replay_counters(b"".join(clean[i] + b"\r\n" for i in (0, 2, 4, 5)))[2]
@@ -0,0 +1,114 @@
+import pytest
+
+import device
+import history
+import utime
+import xbee
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(utime, "CLOCK", 0)
+    return utime
+
+
+def load():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.receive_callback(dev.callback_receive)
+    dev.STATUS = 2
+    return modem, dev
+
+
+def download(modem, dev, oldest, newest=0):
+    """Request a range and run task_history() to its last frame, returns the Samples."""
+    modem.simulate_receive(history.request(dev, oldest, newest, 9), dev.CLUSTER_P1, 0x0104)
+    task = dev.task_history()
+    samples = history.Samples()
+    fragments = []
+    while next(task) == dev.HISTORY_DELAY:
+        for frame in modem.transmits:
+            assert frame.cluster == dev.CLUSTER_P1 and len(frame.payload) <= dev.MAX_PAYLOAD
+            assert frame.payload[5] == 9
+            fragments.append(frame.payload[6])
+            samples.feed(frame.payload)
+        del modem.transmits[:]
+    assert samples.done
+    assert fragments == list(range(len(fragments) - 1)) + [0x80 | len(fragments) - 1]
+    return samples
+
+
+def test_samples_and_download(clock):
+    modem, dev = load()
+    interval = dev.HISTORY_INTERVAL
+    dev.RP_ENERGY_T1[3] = 1000
+    dev.RP_ENERGY_T2[3] = 2000
+    for k in range(4):
+        # two telegrams per sample, L2 is not measured
+        for power in (100 * k, 100 * k + 50):
+            dev.RP_L1_P[3] = power
+            dev.RP_L3_P[3] = 2 * power
+            dev.history_sample(utime.time())
+            clock.CLOCK += interval * 500
+        dev.RP_ENERGY_T1[3] += 10 * k
+    clock.CLOCK += 5000
+
+    samples = download(modem, dev, 3600)
+    # a sample every interval, the last telegram waits for the next one.
+    # The counters of the first sample are unknown, there is none before it
+    assert samples.samples == [
+        (3 * interval + 5, (50, None, 100, None, None, None)),
+        (2 * interval + 5, (175, None, 350, 10, None, None)),
+        (1 * interval + 5, (275, None, 550, 20, None, None)),
+    ]
+    assert samples.samples == history.kept(dev, 3600, 0)
+
+    # a range
+    samples = download(modem, dev, 2 * interval + 5, interval + 5)
+    assert [age for age, values in samples.samples] == [2 * interval + 5, interval + 5]
+    # nothing in the range: one empty frame
+    samples = download(modem, dev, 1, 0)
+    assert samples.samples == [] and samples.frames == 1
+
+
+def test_download_in_fragments(clock):
+    modem, dev = load()
+    interval = dev.HISTORY_INTERVAL
+    for k in range(dev.HISTORY_SIZE + 10):
+        dev.RP_L1_P[3] = k
+        dev.history_sample(utime.time())
+        clock.CLOCK += interval * 1000
+    # the oldest samples were dropped
+    assert dev.HISTORY_STATE[1] == dev.HISTORY_SIZE
+
+    dev.MAX_PAYLOAD = 40
+    samples = download(modem, dev, 1 << 30)
+    assert samples.frames == (dev.HISTORY_SIZE + 1) // 2
+    assert samples.samples == history.kept(dev, 1 << 30, 0)
+    assert [values[0] for age, values in samples.samples] == list(range(10, dev.HISTORY_SIZE + 10))
+
+
+def test_saved_history_is_moved_to_the_new_clock(clock, tmp_path):
+    path = str(tmp_path / "history.bin")
+    modem, dev = load()
+    dev.HISTORY_FILE = path
+    interval = dev.HISTORY_INTERVAL
+    clock.CLOCK = 5000 * 1000
+    for k in range(dev.HISTORY_SAVE + 2):
+        dev.RP_L1_P[3] = k
+        dev.history_sample(utime.time())
+        clock.CLOCK += interval * 1000
+    # the sample after the save is lost with the reset, the history was
+    # saved two intervals ago
+    saved = history.kept(dev, 1 << 30, 0)[:dev.HISTORY_SAVE]
+    ages = [age - interval * 2 for age, values in saved]
+
+    # the clock starts at 0 again after the reset
+    clock.CLOCK = 0
+    modem, dev = load()
+    dev.HISTORY_FILE = path
+    dev.history_load()
+    assert dev.HISTORY_STATE[1] == dev.HISTORY_SAVE
+    samples = download(modem, dev, 1 << 30)
+    assert [age for age, values in samples.samples] == ages
+    assert [values for age, values in samples.samples] == [values for age, values in saved]
@@ -0,0 +1,119 @@
+import pytest
+
+import device
+import utime
+import xbee
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(utime, "CLOCK", 0)
+    return utime
+
+
+def load():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.receive_callback(dev.callback_receive)
+    return modem, dev
+
+
+def report(modem, dev, value):
+    """Send a report cycle, returns the frames sent."""
+    dev.report_set(dev.RP_DEMAND, value)
+    dev.send_data()
+    frames = modem.transmits[:]
+    del modem.transmits[:]
+    assert frames
+    return frames
+
+
+def acknowledge(modem, frames):
+    # the coordinator answers every report with a default response
+    for frame in frames:
+        if frame.payload[0] & 0x04:
+            header, sequence = frame.payload[:3], frame.payload[3]
+        else:
+            header, sequence = frame.payload[:1], frame.payload[1]
+        response = bytes([header[0] | 0x18]) + header[1:] + bytes([sequence, 0x0b, 0x0a, 0x00])
+        modem.simulate_receive(response, frame.cluster, 0x0104, source_ep=frame.dest_ep, dest_ep=frame.source_ep)
+    assert modem.transmits == []
+
+
+def in_flight(dev):
+    return sum(1 for sequence in dev.INFLIGHT_SEQUENCE if sequence >= 0)
+
+
+def test_reports_in_flight_until_acknowledged(clock):
+    modem, dev = load()
+    frames = report(modem, dev, 100)
+    assert in_flight(dev) == len(frames) == dev.LINK[dev.LINK_SENT]
+
+    clock.CLOCK = 200
+    acknowledge(modem, frames[:1])
+    assert in_flight(dev) == len(frames) - 1
+    # a response to a report that is not in flight is ignored
+    acknowledge(modem, frames[:1])
+    assert dev.LINK[dev.LINK_ACKED] == 1
+    acknowledge(modem, frames[1:])
+    assert in_flight(dev) == 0
+    assert dev.LINK[dev.LINK_ACKED] == len(frames)
+    assert dev.LINK[dev.LINK_RTT_AVG] == 200
+
+    dev.link_check(clock.CLOCK)
+    assert dev.LINK[dev.LINK_PACE] == 8
+    assert dev.RP_DIAG_RTT[3] == 200 and dev.RP_DIAG_LOSS[3] == 0
+
+
+def test_lost_reports_slow_the_pace(clock):
+    modem, dev = load()
+    frames = report(modem, dev, 100)
+    # not lost before the timeout
+    clock.CLOCK = dev.LINK_TIMEOUT
+    dev.link_check(clock.CLOCK)
+    assert dev.LINK[dev.LINK_LOST] == 0 and in_flight(dev) == len(frames)
+    clock.CLOCK += 1
+    dev.link_check(clock.CLOCK)
+    assert dev.LINK[dev.LINK_LOST] == len(frames) and in_flight(dev) == 0
+    assert dev.LINK[dev.LINK_PACE] == 16
+    # a late response does not count
+    acknowledge(modem, frames)
+    assert dev.LINK[dev.LINK_ACKED] == 0
+
+
+def test_pace_follows_the_round_trip(clock):
+    modem, dev = load()
+    maximum = dev.RP_DEMAND[9] * 1000
+    # slow responses double the pace on every check, up to LINK_BACKOFF
+    paces = []
+    for value in range(6):
+        clock.CLOCK += maximum * 8
+        frames = report(modem, dev, value * 100)
+        clock.CLOCK += dev.LINK_RTT + 500
+        acknowledge(modem, frames)
+        dev.link_check(clock.CLOCK)
+        paces.append(dev.LINK[dev.LINK_PACE])
+    assert paces == [16, 32, 64, 64, 64, 64]
+    assert dev.RP_DIAG_PACE[3] == 64
+
+    # the reporting intervals stretch with the pace, the max interval of the
+    # demand is 8 times as long
+    clock.CLOCK += maximum * 8 - dev.LINK_RTT - 501
+    dev.send_data()
+    assert not [f for f in modem.transmits if f.cluster == 0x0702]
+    del modem.transmits[:]
+    clock.CLOCK += 1
+    assert [f for f in report(modem, dev, 500) if f.cluster == 0x0702]
+
+    # fast responses shrink the pace step by step, once the average is low
+    paces = []
+    for value in range(40):
+        clock.CLOCK += maximum * 8
+        frames = report(modem, dev, value * 1000)
+        clock.CLOCK += 50
+        acknowledge(modem, frames)
+        dev.link_check(clock.CLOCK)
+        paces.append(dev.LINK[dev.LINK_PACE])
+    assert paces[-1] == 8
+    assert all(a >= b for a, b in zip(paces, paces[1:]))
+    assert 8 < max(paces) <= 64
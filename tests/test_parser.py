@@ -0,0 +1,107 @@
+import glob
+import os
+import re
+
+import pytest
+
+import device
+import xbee
+
+CORPUS = sorted(glob.glob(os.path.join(device.HERE, "corpus", "*.p1")))
+
+# OBIS code: attribute, decimals, value group
+EXPECTED = {
+    "1-0:1.8.1": ("RP_ENERGY_T1", 3, 0),
+    "1-0:1.8.2": ("RP_ENERGY_T2", 3, 0),
+    "1-0:2.8.1": ("RP_ENERGY_D_T1", 3, 0),
+    "1-0:2.8.2": ("RP_ENERGY_D_T2", 3, 0),
+    "1-0:1.7.0": ("RP_POWER_IN", 3, 0),
+    "1-0:2.7.0": ("RP_POWER_OUT", 3, 0),
+    "1-0:31.7.0": ("RP_L1_A", 2, 0),
+    "1-0:51.7.0": ("RP_L2_A", 2, 0),
+    "1-0:71.7.0": ("RP_L3_A", 2, 0),
+    "1-0:32.7.0": ("RP_L1_V", 1, 0),
+    "1-0:52.7.0": ("RP_L2_V", 1, 0),
+    "1-0:72.7.0": ("RP_L3_V", 1, 0),
+    "1-0:21.7.0": ("RP_L1_P", 3, 0),
+    "1-0:41.7.0": ("RP_L2_P", 3, 0),
+    "1-0:61.7.0": ("RP_L3_P", 3, 0),
+    "0-1:24.2.1": ("RP_GAS", 3, 1),
+    "0-1:24.2.3": ("RP_GAS", 3, 1),
+}
+LINE = re.compile(rb"^(\d+-\d+:\d+\.\d+\.\d+)((?:\([^)]*\))+)", re.M)
+GROUP = re.compile(rb"\(([^)]*)\)")
+
+
+def reference(telegram, values):
+    """Update values with what a regular expression reads from the telegram."""
+    for code, groups in LINE.findall(telegram):
+        entry = EXPECTED.get(code.decode())
+        if entry is None:
+            continue
+        name, decimals, group = entry
+        number = GROUP.findall(groups)[group].split(b"*")[0]
+        whole, _, fraction = number.partition(b".")
+        values[name] = int(whole + (fraction + b"000")[:decimals])
+
+
+@pytest.mark.parametrize("path", CORPUS, ids=os.path.basename)
+def test_corpus_values(path):
+    dev = device.load(modem=xbee.Modem())
+    values = {}
+    for telegram in device.telegrams(path) * 2:
+        view = dev.p1_frame(telegram)
+        assert view is not None
+        dev.process_p1(view)
+        reference(telegram, values)
+        assert values
+        for name, value in values.items():
+            assert getattr(dev, name)[3] == value, name
+        assert dev.RP_ENERGY_SUM[3] == values["RP_ENERGY_T1"] + values["RP_ENERGY_T2"]
+        assert dev.RP_DEMAND[3] == values["RP_POWER_IN"] - values["RP_POWER_OUT"]
+
+
+def frame(dev, lines):
+    body = b"/ISK5\\2M550T-1012\r\n\r\n" + b"".join(line + b"\r\n" for line in lines)
+    data = body + b"!%04X\r\n" % dev.crc16(body + b"!")
+    view = dev.p1_frame(data)
+    assert view is not None
+    return view
+
+
+def test_memo_skips_only_unchanged_lines():
+    dev = device.load(modem=xbee.Modem())
+    t1 = b"1-0:1.8.1(001581.123*kWh)"
+    t2 = b"1-0:1.8.2(001435.706*kWh)"
+    p1 = b"1-0:21.7.0(00.170*kW)"
+    stamp = b"0-0:1.0.0(161113205757W)"
+    dev.process_p1(frame(dev, [stamp, t1, t2, p1]))
+    assert not any(dev.P1_SAME[:dev.P1_LINE_COUNT])
+
+    # the same telegram again: every line is skipped, the values stay
+    dev.process_p1(frame(dev, [stamp, t1, t2, p1]))
+    assert all(dev.P1_SAME[1:dev.P1_LINE_COUNT - 1])
+    assert dev.RP_ENERGY_T1[3] == 1581123 and dev.RP_L1_P[3] == 170
+
+    # one value changes: only its line is parsed again
+    t1b = b"1-0:1.8.1(001581.124*kWh)"
+    dev.process_p1(frame(dev, [stamp, t1b, t2, p1]))
+    assert [dev.P1_SAME[n] for n in range(2, 6)] == [1, 0, 1, 1]
+    assert dev.RP_ENERGY_T1[3] == 1581124
+
+    # a value gets longer: the lines after it moved and are parsed again
+    p1b = b"1-0:21.7.0(00.171*kW)"
+    dev.process_p1(frame(dev, [stamp, b"1-0:1.8.1(0001581.125*kWh)", t2, p1b]))
+    assert [dev.P1_SAME[n] for n in range(2, 6)] == [1, 0, 0, 0]
+    assert dev.RP_ENERGY_T1[3] == 1581125 and dev.RP_L1_P[3] == 171
+
+    # two lines of the same length swap their values: both are parsed again
+    dev.P1_MEMO_LINES = 0
+    dev.process_p1(frame(dev, [stamp, t1, t2, p1]))
+    dev.process_p1(frame(dev, [stamp, t2.replace(b"1-0:1.8.2", b"1-0:1.8.1"), t1.replace(b"1-0:1.8.1", b"1-0:1.8.2"), p1]))
+    assert dev.RP_ENERGY_T1[3] == 1435706 and dev.RP_ENERGY_T2[3] == 1581123
+
+    # a line more: nothing is skipped
+    dev.process_p1(frame(dev, [stamp, t1, t2, p1, b"1-0:41.7.0(00.050*kW)"]))
+    assert dev.RP_ENERGY_T1[3] == 1581123 and dev.RP_ENERGY_T2[3] == 1435706
+    assert dev.RP_L2_P[3] == 50
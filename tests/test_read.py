@@ -0,0 +1,83 @@
+import device
+import xbee
+
+CODE = b"\x34\x12" # MANUFACTURER_CODE, little endian
+
+
+def load():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.receive_callback(dev.callback_receive)
+    return modem, dev
+
+
+def read(modem, cluster, aids, endpoint=1, manufacturer=None):
+    """Read attributes, returns the records of the response."""
+    header = b"\x04" + manufacturer if manufacturer is not None else b"\x00"
+    payload = header + b"\x42\x00" + b"".join(aid.to_bytes(2, "little") for aid in aids)
+    modem.simulate_receive(payload, cluster, 0x0104, dest_ep=endpoint)
+    frame = modem.transmits.pop()
+    assert modem.transmits == []
+    assert frame.cluster == cluster and frame.source_ep == endpoint
+    if manufacturer is not None:
+        assert frame.payload[:3] == b"\x1c" + CODE
+        return frame.payload[5:]
+    assert frame.payload[:3] == b"\x18\x42\x01"
+    return frame.payload[3:]
+
+
+def test_basic_cluster():
+    modem, dev = load()
+    assert read(modem, 0x0000, [0x0000, 0x0005, 0x1234, 0x4000]) == \
+        b"\x00\x00\x00\x20\x08" + \
+        b"\x05\x00\x00\x42\x0fZigbee P1 Meter" + \
+        b"\x34\x12\x86" + \
+        b"\x00\x40\x00\x42\x04v0.1"
+    # the second endpoint has no basic cluster
+    assert read(modem, 0x0000, [0x0000], endpoint=2) == b"\x00\x00\x86"
+
+
+def test_reported_values_on_both_endpoints():
+    modem, dev = load()
+    # no value yet
+    assert read(modem, 0x0702, [0x0400]) == b"\x00\x04\x86"
+    assert read(modem, 0x0702, [0x0000], endpoint=2) == b"\x00\x00\x86"
+
+    dev.report_set(dev.RP_DEMAND, -300)
+    dev.report_set(dev.RP_GAS, 12345)
+    assert read(modem, 0x0702, [0x0400]) == b"\x00\x04\x00\x2a" + (-300).to_bytes(3, "little", signed=True)
+    assert read(modem, 0x0702, [0x0000], endpoint=2) == b"\x00\x00\x00\x25" + (12345).to_bytes(6, "little")
+    # the endpoints keep their own values of the same attribute
+    assert read(modem, 0x0702, [0x0000]) != read(modem, 0x0702, [0x0000], endpoint=2)
+    # an attribute the cluster lacks, and a cluster the endpoint lacks
+    assert read(modem, 0x0702, [0x0400], endpoint=2) == b"\x00\x04\x86"
+    assert read(modem, 0x0b04, [0x050b], endpoint=2) == b"\x0b\x05\x86"
+
+
+def test_manufacturer_specific_attributes():
+    modem, dev = load()
+    dev.report_set(dev.RP_DIAG_ALLOC_READ, 1000)
+    # only with the manufacturer code
+    assert read(modem, 0x0b05, [0xf003], manufacturer=CODE) == b"\x03\xf0\x00\x23\xe8\x03\x00\x00"
+    assert read(modem, 0x0b05, [0xf003]) == b"\x03\xf0\x86"
+    # the standard attributes of the cluster are not manufacturer specific
+    assert read(modem, 0x0b05, [0x0000]) == b"\x00\x00\x00\x21\x00\x00"
+    assert read(modem, 0x0b05, [0x0000], manufacturer=CODE) == b"\x00\x00\x86"
+    # another manufacturer code is ignored
+    modem.simulate_receive(b"\x04\x78\x56\x42\x00\x03\xf0", 0x0b05, 0x0104)
+    assert modem.transmits == []
+
+
+def test_response_fits_the_payload():
+    modem, dev = load()
+    dev.MAX_PAYLOAD = 20
+    aids = [0x0000, 0x0004, 0x0005, 0x4000]
+    # 3 + 5 + 10 fit, the 20 byte model id does not
+    assert read(modem, 0x0000, aids) == b"\x00\x00\x00\x20\x08\x04\x00\x00\x42\x05consp"
+    # the manufacturer code takes 2 bytes of the payload
+    dev.report_set(dev.RP_DIAG_ALLOC_READ, 1)
+    dev.report_set(dev.RP_DIAG_ALLOC_PARSE, 2)
+    dev.MAX_PAYLOAD = 21
+    assert len(read(modem, 0x0b05, [0xf003, 0xf004], manufacturer=CODE)) == 16
+    dev.MAX_PAYLOAD = 20
+    assert len(read(modem, 0x0b05, [0xf003, 0xf004], manufacturer=CODE)) == 8
@@ -0,0 +1,91 @@
+import device
+import xbee
+
+
+def test_rejoin_reports_static_attributes():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.modem_status.callback(dev.callback_status)
+    calls = []
+    report_static = dev.report_static
+    dev.report_static = lambda: (calls.append(dev.STATUS), report_static())
+
+    modem.simulate_status(2)
+    task = dev.task_report()
+    # joined: NP is read, the static attributes are reported and the task waits
+    assert next(task) is dev.EV_REPORT
+    assert calls == [2]
+
+    # the network leaves and rejoins while the task waits for a telegram,
+    # the new network allows a smaller payload
+    modem.simulate_status(3)
+    modem.at["NP"] = 66
+    modem.simulate_status(2)
+    assert next(task) is dev.EV_REPORT
+    assert calls == [2, 2]
+    assert dev.MAX_PAYLOAD == 66
+
+    # no rejoin, no static report
+    assert next(task) is dev.EV_REPORT
+    assert calls == [2, 2]
+
+
+def parse(dev, telegram):
+    """Frame and parse one telegram, the CRC is added here."""
+    body = telegram.replace(b"\n", b"\r\n")
+    data = body + b"!%04X\r\n" % dev.crc16(body + b"!")
+    assert dev.p1_feed(data)
+    dev.process_p1(dev.P1_VIEW[:dev.P1_LENGTH])
+
+
+def test_missing_value_group_is_ignored():
+    dev = device.load(modem=xbee.Modem())
+    # the gas line lacks the value after its timestamp, also as the last line
+    parse(dev, b"/ISK5\\2M550T-1012\n\n1-0:1.8.1(000123.456*kWh)\n0-1:24.2.1(230101120000W)\n")
+    assert dev.RP_ENERGY_T1[3] == 123456
+    assert dev.RP_GAS[3] is None
+    parse(dev, b"/ISK5\\2M550T-1012\n\n0-1:24.2.1(230101120000W)\n1-0:1.8.1(000124.456*kWh)\n")
+    assert dev.RP_ENERGY_T1[3] == 124456
+    assert dev.RP_GAS[3] is None
+    parse(dev, b"/ISK5\\2M550T-1012\n\n0-1:24.2.1(230101120000W)(00012.345*m3)\n")
+    assert dev.RP_GAS[3] == 12345
+
+
+def test_unreported_window_starts_again():
+    dev = device.load(modem=xbee.Modem())
+    dev.RP_L1_P[3] = 65000
+    # a day of telegrams while not joined, nothing publishes the window
+    for now in range(0, 24 * 3600 * 1000, 1000):
+        dev.agg_sample(0b001001, now)
+    assert dev.AGG[0] <= dev.AGG_LIMIT // 1000 + 1
+    assert dev.AGG[2] == dev.AGG[3] == 65000
+
+
+def test_manufacturer_attributes_need_manufacturer_frames():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.receive_callback(dev.callback_receive)
+    dev.report_set(dev.RP_L1_P_MEAN, 300)
+    code = dev.MANUFACTURER_CODE.to_bytes(2, "little")
+    # read attributes 0x05F0 of the electrical measurement cluster
+    modem.simulate_receive(b"\x00\x10\x00\xf0\x05", 0x0B04, 0x0104)
+    modem.simulate_receive(b"\x04" + code + b"\x11\x00\xf0\x05", 0x0B04, 0x0104)
+    standard, specific = [f.payload for f in modem.transmits]
+    assert standard == b"\x18\x10\x01\xf0\x05\x86"
+    assert specific == b"\x1c" + code + b"\x11\x01\xf0\x05\x00\x29\x2c\x01"
+
+
+def test_values_are_clamped_to_their_type():
+    dev = device.load(modem=xbee.Modem())
+    dev.report_set(dev.RP_L1_P, 70000) # uint16
+    dev.report_set(dev.RP_L1_P_MIN, -40000) # int16
+    dev.report_set(dev.RP_DEMAND, -5000) # int24, fits
+    dev.report_set(dev.RP_ENERGY_STATUS, 300) # bitmap8
+    dev.report_encode()
+    for rp, value, encoded in ((dev.RP_L1_P, 0xFFFE, b"\xfe\xff"),
+                               (dev.RP_L1_P_MIN, -0x7FFF, b"\x01\x80"),
+                               (dev.RP_DEMAND, -5000, (-5000 & 0xFFFFFF).to_bytes(3, "little")),
+                               (dev.RP_ENERGY_STATUS, 0xFF, b"\xff")):
+        assert rp[3] == value
+        frame, offset, size = rp[dev.RP_REPORT][2], rp[dev.RP_OFFSET], rp[dev.RP_SIZE]
+        assert bytes(frame[offset:offset + size]) == encoded
@@ -0,0 +1,109 @@
+import pytest
+
+import device
+import utime
+import xbee
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(utime, "CLOCK", 0)
+    return utime
+
+
+def load():
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    modem.receive_callback(dev.callback_receive)
+    return modem, dev
+
+
+def request(modem, cid, records, cluster=0x0702, endpoint=1):
+    """Send a global command to the device and return its response payload."""
+    modem.simulate_receive(bytes([0x00, 0x42, cid]) + records, cluster, 0x0104, dest_ep=endpoint)
+    frame = modem.transmits.pop()
+    assert frame.cluster == cluster and frame.source_ep == endpoint
+    assert frame.payload[:3] == bytes([0x18, 0x42, cid + 1])
+    return frame.payload[3:]
+
+
+def configure(aid, dtype, minimum, maximum, change=b""):
+    return bytes([0x00]) + aid.to_bytes(2, "little") + bytes([dtype]) + \
+        minimum.to_bytes(2, "little") + maximum.to_bytes(2, "little") + change
+
+
+def demand_reports(modem):
+    frames = [f for f in modem.transmits if f.cluster == 0x0702 and b"\x00\x04\x2a" in f.payload]
+    modem.transmits.clear()
+    return len(frames)
+
+
+def test_configure_and_read_back():
+    modem, dev = load()
+    # demand is int24, a negative reportable change counts as its size
+    record = configure(0x0400, 0x2a, 5, 60, (-100).to_bytes(3, "little", signed=True))
+    assert request(modem, 0x06, record) == b"\x00"
+    assert request(modem, 0x08, b"\x00\x00\x04") == b"\x00\x00\x00\x04\x2a\x05\x00\x3c\x00\x64\x00\x00"
+
+    # a bitmap has no reportable change
+    assert request(modem, 0x06, configure(0x0000, 0x1b, 10, 300), cluster=0x0b04) == b"\x00"
+    assert request(modem, 0x08, b"\x00\x00\x00", cluster=0x0b04) == b"\x00\x00\x00\x00\x1b\x0a\x00\x2c\x01"
+    # gas is on the second endpoint, the counter on the first has the same attribute id
+    change = (10).to_bytes(6, "little")
+    assert request(modem, 0x06, configure(0x0000, 0x25, 20, 600, change), endpoint=2) == b"\x00"
+    assert request(modem, 0x08, b"\x00\x00\x00", endpoint=2) == b"\x00\x00\x00\x00\x25\x14\x00\x58\x02" + change
+    assert request(modem, 0x08, b"\x00\x00\x00")[5:9] != b"\x14\x00\x58\x02"
+
+    # unknown attributes and received reports are not supported
+    assert request(modem, 0x08, b"\x00\x34\x12\x01\x00\x04") == b"\x86\x00\x34\x12\x86\x01\x00\x04"
+
+
+def test_configure_failures():
+    modem, dev = load()
+    demand = configure(0x0400, 0x2a, 5, 60, b"\x0a\x00\x00")
+    # a known type that is not the type of the attribute
+    wrong = configure(0x0400, 0x21, 1, 2, b"\x01\x00")
+    assert request(modem, 0x06, wrong + demand) == b"\x8d\x00\x00\x04"
+    assert request(modem, 0x08, b"\x00\x00\x04")[5:7] == b"\x05\x00"
+    # an unknown type: the length of the record is unknown, the rest is not read
+    unknown = configure(0x0400, 0x99, 1, 2)
+    assert request(modem, 0x06, unknown + configure(0x0400, 0x2a, 7, 60, b"\x0a\x00\x00")) == b"\x8d\x00\x00\x04"
+    assert request(modem, 0x08, b"\x00\x00\x04")[5:7] == b"\x05\x00"
+    # an unknown attribute, min larger than max and a received report
+    records = configure(0x1234, 0x21, 1, 2, b"\x01\x00") + configure(0x0400, 0x2a, 70, 60, b"\x0a\x00\x00") + \
+        b"\x01\x00\x04\x10\x00"
+    assert request(modem, 0x06, records) == b"\x86\x00\x34\x12\x87\x00\x00\x04\x86\x01\x00\x04"
+    assert request(modem, 0x08, b"\x00\x00\x04")[5:7] == b"\x05\x00"
+
+
+def test_configured_intervals_and_change(clock):
+    modem, dev = load()
+    record = configure(0x0400, 0x2a, 5, 60, (-100).to_bytes(3, "little", signed=True))
+    assert request(modem, 0x06, record) == b"\x00"
+
+    dev.report_set(dev.RP_DEMAND, 1000)
+    dev.send_data()
+    assert demand_reports(modem) == 1
+    # a change below the reportable change, or within min, is not reported
+    clock.CLOCK = 10000
+    dev.report_set(dev.RP_DEMAND, 1050)
+    dev.send_data()
+    assert demand_reports(modem) == 0
+    clock.CLOCK = 12000
+    dev.report_set(dev.RP_DEMAND, 900)
+    dev.send_data()
+    assert demand_reports(modem) == 1
+    clock.CLOCK = 14000
+    dev.report_set(dev.RP_DEMAND, 700)
+    dev.send_data()
+    assert demand_reports(modem) == 0
+    clock.CLOCK = 17000
+    dev.send_data()
+    assert demand_reports(modem) == 1
+    # max interval passed, reported unchanged
+    clock.CLOCK = 17000 + 59000
+    dev.send_data()
+    assert demand_reports(modem) == 0
+    clock.CLOCK = 17000 + 60000
+    dev.send_data()
+    assert demand_reports(modem) == 1
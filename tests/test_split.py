@@ -0,0 +1,37 @@
+import device
+import xbee
+
+
+def attributes(dev, payload):
+    """Attribute ids of a report frame, in order."""
+    n = 5 if payload[0] & 0x04 else 3
+    assert payload[n - 1] == 0x0a
+    ids = []
+    while n < len(payload):
+        ids.append(payload[n] | payload[n + 1] << 8)
+        n += 3 + dev.TYPE_SIZE[payload[n + 2]]
+    assert n == len(payload)
+    return ids
+
+
+def test_reports_are_split_to_the_maximum_payload():
+    for size in (128, 40, 20, 14):
+        modem = xbee.Modem()
+        dev = device.load(modem=modem)
+        dev.MAX_PAYLOAD = size
+        for rp in (dev.RP_L1_A, dev.RP_L1_V, dev.RP_L1_P, dev.RP_L2_A, dev.RP_L2_V, dev.RP_L2_P,
+                   dev.RP_L3_A, dev.RP_L3_V, dev.RP_L3_P, dev.RP_POWER_SUM):
+            dev.report_set(rp, 100)
+        dev.send_data()
+
+        sent = [f for f in modem.transmits if f.cluster == 0x0B04 and not f.payload[0] & 0x04]
+        assert all(len(f.payload) <= size for f in sent)
+        # each attribute once, in the order of the precompiled frame
+        ids = [aid for f in sent for aid in attributes(dev, f.payload)]
+        frame = [r for r in dev.REPORT_FRAMES if r[0] == 1 and r[1] == 0x0B04 and r[4] == 3][0]
+        expected = [rp[1] for rp in frame[3] if rp[3] is not None]
+        assert ids == expected
+        # every transmit has its own sequence number
+        sequences = [f.payload[1] for f in modem.transmits]
+        assert len(set(sequences)) == len(sequences)
+        assert (len(sent) == 1) == (size == 128)
@@ -0,0 +1,250 @@
+"""Validate and parse archives of raw P1 captures in bulk.
+
+Capture files are memory mapped and processed in blocks with NumPy:
+telegram boundaries ("/" up to "!XXXX", restarting at every "/" like
+p1_feed() does) are found with vectorized scans, the CRCs of all telegrams
+in a block are computed in lockstep with the CRC_TABLE of src/main.py, and
+the values of the OBIS codes main.py knows are parsed from fixed-width
+windows into columns named like decode.py names them ("l1_v", "gas"). The
+meter time (0-0:1.0.0) becomes the "time" column in seconds since 1970.
+
+Files are spread over a process pool. Every file gets a directory with a
+.npy per column, "offset" (of the telegram in the file) and "crc_ok";
+values of telegrams that failed the CRC or lack the code are NaN.
+
+    python tools/archive.py -o parsed/ captures/*.p1
+    python tools/archive.py -j 8 -o parsed/ captures/*.p1
+"""
+import argparse
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import decode
+import device
+
+BLOCK = 64 * 1024 * 1024
+# longest value we parse, "0000123.456*kWh"
+WINDOW = 16
+
+# ascii hex digit values, -1 for other bytes
+HEX = np.full(256, -1, dtype=np.int32)
+for _c in b"0123456789":
+    HEX[_c] = _c - 48
+for _c in b"abcdef":
+    HEX[_c] = HEX[_c - 32] = _c - 87
+
+_DEVICE = None
+
+
+def load_device():
+    global _DEVICE
+    if _DEVICE is None:
+        _DEVICE = device.load()
+    return _DEVICE
+
+
+def obis_code(dev, key):
+    """Text of a packed OBIS key of main.py, the reverse of obis_key()."""
+    groups = []
+    for mul in reversed(dev.OBIS_MUL[1:]):
+        groups.append(key % mul)
+        key //= mul
+    e, d, c, b = groups
+    return b"%d-%d:%d.%d.%d" % (key, b, c, d, e)
+
+
+def obis_fields(dev):
+    """(code, column, decimals, value group) of every OBIS code main.py parses."""
+    names = decode.rp_names(dev)
+    fields = []
+    for key, (rp, decimals, phases, group) in dev.OBIS.items():
+        fields.append((obis_code(dev, key), names[id(rp)][3:].lower(), decimals, group))
+    return fields
+
+
+def find_telegrams(buf, size_limit):
+    """Start offsets and the offsets of "!" of the complete telegrams in buf."""
+    slashes = np.flatnonzero(buf == 0x2F)
+    bangs = np.flatnonzero(buf == 0x21)
+    bangs = bangs[bangs + 5 <= len(buf)]
+    if len(slashes) == 0 or len(bangs) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    # the last "/" before each "!" starts its telegram, only the first "!" after it ends it
+    index = np.searchsorted(slashes, bangs) - 1
+    keep = index >= 0
+    bangs, index = bangs[keep], index[keep]
+    first = np.ones(len(index), dtype=bool)
+    first[1:] = index[1:] != index[:-1]
+    starts, bangs = slashes[index[first]], bangs[first]
+    keep = bangs - starts + 5 <= size_limit
+    return starts[keep], bangs[keep]
+
+
+def crc_ok(buf, starts, bangs, table):
+    """Check the CRC of every telegram, all telegrams advance one byte per step."""
+    lengths = bangs - starts + 1
+    order = np.argsort(-lengths, kind="stable")
+    starts_sorted, lengths_sorted = starts[order], lengths[order]
+    crc = np.zeros(len(starts), dtype=np.int32)
+    if len(starts):
+        for j in range(int(lengths_sorted[0])):
+            # telegrams longer than j are a prefix, they are sorted by length
+            k = np.searchsorted(-lengths_sorted, -j, side="left")
+            c = crc[:k]
+            crc[:k] = table[(c ^ buf[starts_sorted[:k] + j]) & 0xFF] ^ (c >> 8)
+    digits = HEX[buf[bangs[:, None] + np.arange(1, 5)]] if len(bangs) else np.empty((0, 4), np.int32)
+    expected = (digits[:, 0] << 12) | (digits[:, 1] << 8) | (digits[:, 2] << 4) | digits[:, 3]
+    ok = np.zeros(len(starts), dtype=bool)
+    ok[order] = crc == expected[order]
+    return ok & (digits >= 0).all(axis=1)
+
+
+def parse_numbers(buf, positions, decimals):
+    """Fixed point numbers starting at positions, scaled like process_p1()."""
+    window = buf[np.minimum(positions[:, None] + np.arange(WINDOW), len(buf) - 1)].astype(np.int64)
+    digit = (window >= 48) & (window <= 57)
+    point = window == 46
+    # the number ends at the first byte that is no digit or point
+    inside = np.cumprod(digit | point, axis=1).astype(bool)
+    digit &= inside
+    point &= inside
+    # every digit is worth 10 to the number of digits after it
+    after = np.cumsum(digit[:, ::-1], axis=1)[:, ::-1] - digit
+    value = (np.where(digit, window - 48, 0) * 10.0 ** after).sum(axis=1)
+    places = np.where(point.any(axis=1), after[np.arange(len(positions)), np.argmax(point, axis=1)], 0)
+    value = value / 10.0 ** places
+    return np.where(inside[:, 0], np.floor(value * 10 ** decimals + 1e-6) / 10 ** decimals, np.nan)
+
+
+def parse_times(buf, positions):
+    """Meter time YYMMDDhhmmss at positions in seconds since 1970, NaN if invalid."""
+    window = buf[np.minimum(positions[:, None] + np.arange(12), len(buf) - 1)].astype(np.int64) - 48
+    valid = ((window >= 0) & (window <= 9)).all(axis=1)
+    window = np.clip(window, 0, 9)
+    pairs = window[:, 0::2] * 10 + window[:, 1::2]
+    months = np.clip(pairs[:, 0] * 12 + pairs[:, 1] - 1, 0, None)
+    days = (np.datetime64("2000-01", "M") + months.astype("timedelta64[M]")).astype("datetime64[D]")
+    days = days + np.clip(pairs[:, 2] - 1, 0, None).astype("timedelta64[D]")
+    seconds = days.astype("datetime64[s]").astype(np.int64) + pairs[:, 3] * 3600 + pairs[:, 4] * 60 + pairs[:, 5]
+    return np.where(valid, seconds, np.nan)
+
+
+def line_keys(buf, lines):
+    """The first 8 bytes of every line as an integer, to find OBIS codes quickly."""
+    keys = np.zeros(len(lines), dtype=np.uint64)
+    for i in range(8):
+        keys |= buf[np.minimum(lines + i, len(buf) - 1)].astype(np.uint64) << np.uint64(8 * i)
+    return keys
+
+
+def find_values(buf, lines, keys, parens, breaks, code, group, starts, bangs):
+    """Telegram index and value offset of every line with code in a telegram.
+
+    breaks are the offsets of every CR and LF in buf, and len(buf) last.
+    """
+    needle = code + b"("
+    found = lines[keys == np.frombuffer(needle[:8], dtype="<u8")[0]]
+    found = found[found + len(needle) <= len(buf)]
+    for i in range(8, len(needle)):
+        found = found[buf[found + i] == needle[i]]
+    positions = found + len(needle)
+    ends = breaks[np.searchsorted(breaks, positions)]
+    # skip to the value group, e.g. the gas value is after its timestamp,
+    # a line with fewer groups is ignored like process_p1() does
+    for _ in range(group):
+        index = np.searchsorted(parens, positions)
+        keep = index < len(parens)
+        positions = parens[index[keep]] + 1
+        ends = ends[keep]
+        keep = positions <= ends
+        positions = positions[keep]
+        ends = ends[keep]
+    rows = np.searchsorted(starts, positions, side="right") - 1
+    inside = (rows >= 0) & (positions < bangs[np.maximum(rows, 0)]) if len(starts) else rows < -1
+    return rows[inside], positions[inside]
+
+
+def process_file(job):
+    path, output = job
+    dev = load_device()
+    table = np.frombuffer(dev.CRC_TABLE, dtype=np.uint16).astype(np.int32)
+    fields = obis_fields(dev)
+    columns = {"offset": [], "crc_ok": [], "time": []}
+    for _, column, _, _ in fields:
+        columns.setdefault(column, [])
+    started = time.perf_counter()
+    size = os.path.getsize(path)
+    if size:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+            pos = 0
+            while pos < size:
+                end = min(pos + BLOCK, size)
+                buf = data[pos:end]
+                starts, bangs = find_telegrams(buf, dev.P1_BUFFER_SIZE)
+                n = len(starts)
+                ok = crc_ok(buf, starts, bangs, table)
+                columns["offset"].append(starts + pos)
+                columns["crc_ok"].append(ok)
+                block = {}
+                lines = np.flatnonzero(buf == 0x0A) + 1
+                parens = np.flatnonzero(buf == 0x28)
+                breaks = np.append(np.flatnonzero((buf == 0x0D) | (buf == 0x0A)), len(buf))
+                keys = line_keys(buf, lines)
+                for code, column, decimals, group in fields:
+                    rows, positions = find_values(buf, lines, keys, parens, breaks, code, group, starts, bangs)
+                    values = block.setdefault(column, np.full(n, np.nan))
+                    values[rows] = parse_numbers(buf, positions, decimals)
+                rows, positions = find_values(buf, lines, keys, parens, breaks, b"0-0:1.0.0", 0, starts, bangs)
+                block["time"] = np.full(n, np.nan)
+                block["time"][rows] = parse_times(buf, positions)
+                for column, values in block.items():
+                    values[~ok] = np.nan
+                    columns[column].append(values)
+                if end == size:
+                    break
+                # the next block starts after the last complete telegram
+                pos = int(bangs[-1]) + 5 + pos if n else max(end - dev.P1_BUFFER_SIZE, pos + 1)
+            del data, buf, lines, parens, breaks, keys
+    os.makedirs(output, exist_ok=True)
+    for column, parts in columns.items():
+        if parts:
+            values = np.concatenate(parts)
+        else:
+            values = np.empty(0, dtype=bool if column == "crc_ok" else np.float64)
+        np.save(os.path.join(output, column + ".npy"), values)
+    count = sum(len(p) for p in columns["offset"])
+    valid = int(sum(p.sum() for p in columns["crc_ok"]))
+    return path, size, count, valid, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="raw P1 captures")
+    parser.add_argument("-o", "--output", required=True, help="directory for the .npy files")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    for path in args.files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        jobs.append((path, os.path.join(args.output, name)))
+    started = time.perf_counter()
+    total = 0
+    with multiprocessing.Pool(min(args.jobs, len(jobs))) as pool:
+        for path, size, count, valid, elapsed in pool.imap_unordered(process_file, jobs):
+            total += size
+            print("%-30s %10d bytes %7d telegrams %7d valid %7.2f s" % (
+                os.path.basename(path)[:30], size, count, valid, elapsed))
+    elapsed = time.perf_counter() - started
+    print("%d files, %.1f MB in %.2f s: %.1f MB/s" % (len(jobs), total / 1e6, elapsed, total / 1e6 / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
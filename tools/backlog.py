@@ -0,0 +1,86 @@
+"""Decode the backlog frames of the P1 data cluster.
+
+While the device is not joined, or its reports fail, it keeps the energy
+and gas counters every BACKLOG_INTERVAL seconds. After a rejoin they are
+sent as command 0x00 of cluster 0xFC01, as many records per frame as fit.
+Per record, oldest first: the age in seconds (uint32, 0xFFFFFFFF when it
+was recorded before a reset) and the counters of BACKLOG_FIELDS (uint48,
+0xFFFFFFFFFFFF when unknown). Records decodes the frames, the counters
+are named and scaled like tools/decode.py names them.
+
+    python tools/backlog.py frames.txt
+    python tools/backlog.py frames.txt -o backlog.csv
+"""
+import argparse
+import sys
+
+import device
+
+UNKNOWN_AGE = 0xFFFFFFFF
+UNKNOWN = 0xFFFFFFFFFFFF
+
+
+def field_names(dev):
+    """Column name of every counter in a backlog record, "energy_t1" for RP_ENERGY_T1."""
+    names = {id(value): name for name, value in vars(dev).items() if name.startswith("RP_")}
+    return [names[id(rp)][3:].lower() for rp in dev.BACKLOG_FIELDS]
+
+
+class Records:
+    """Feed backlog frames, collect (frame time, age, counters), None if unknown."""
+
+    def __init__(self, dev=None):
+        self.dev = dev or device.load()
+        self.columns = field_names(self.dev)
+        # energy in Wh and gas in dm3, as the meter sends them with 3 decimals
+        self.scale = 1.0 / 1000
+        self.records = []
+        self.frames = 0
+
+    def feed(self, payload, time=0):
+        """Add one frame (ZCL payload of cluster 0xFC01), returns the number of records in it."""
+        if len(payload) < 5 or payload[0] & 0x04 == 0 or payload[4] != 0x00:
+            return 0
+        self.frames += 1
+        size = 4 + 6 * len(self.columns)
+        count = 0
+        for n in range(5, len(payload) - size + 1, size):
+            age = int.from_bytes(payload[n:n + 4], "little")
+            values = []
+            for i in range(n + 4, n + size, 6):
+                value = int.from_bytes(payload[i:i + 6], "little")
+                values.append(None if value == UNKNOWN else value * self.scale)
+            self.records.append((time, None if age == UNKNOWN_AGE else age, tuple(values)))
+            count += 1
+        return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="frame files as tools/replay.py prints them")
+    parser.add_argument("-o", "--output", help="write the records to this csv file")
+    args = parser.parse_args(argv)
+
+    decoder = Records()
+    for path in args.files:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 4 and int(fields[2], 16) == decoder.dev.CLUSTER_P1:
+                    decoder.feed(bytes.fromhex(fields[3]), float(fields[0]))
+    lines = ["time,age," + ",".join(decoder.columns)]
+    for time, age, values in decoder.records:
+        lines.append("%s,%s,%s" % (time, "" if age is None else age,
+                                   ",".join("" if v is None else "%.3f" % v for v in values)))
+    print("%d records in %d frames" % (len(decoder.records), decoder.frames), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        for line in lines:
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
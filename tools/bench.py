@@ -0,0 +1,161 @@
+"""Benchmark the device code per telegram under CPython.
+
+Every telegram in the corpus is framed (CRC), parsed and encoded into
+ZCL reports with the real functions from src/main.py. For each phase the
+median time and the bytes allocated per call are reported, along with
+the number of frames and payload bytes that would go on air.
+
+Parsing is timed twice: in full, as for the first telegram after boot,
+and after the previous telegram of the capture was parsed, the steady
+state where process_p1() skips the lines that did not change. "p1 us"
+is the steady state end to end, framing, crc and parsing of a telegram.
+
+    python tools/bench.py                 # all of tools/corpus
+    python tools/bench.py -n 500 my.p1    # own captures, 500 rounds
+
+The bytes allocated are the difference of gc.mem_alloc() around the call
+with the collector disabled, as measured on the device. CPython frees
+most temporaries at once by reference counting, so here that is the
+memory the call leaves allocated, a lower bound of what the XBee3 heap
+takes until the next collection. While encoding is measured the frames
+go to a transmit that keeps nothing, so the stub modem's copies of them
+are not counted.
+
+CPython numbers are not XBee3 numbers, but relative changes between two
+versions of main.py carry over well enough to catch regressions.
+"""
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import device
+import xbee
+
+CORPUS = os.path.join(device.HERE, "corpus", "*.p1")
+
+
+def measure(func, rounds, setup=None):
+    """Median run time of func() in microseconds, setup() runs untimed before every round."""
+    times = []
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        func()
+        times.append(time.perf_counter_ns() - start)
+    return statistics.median(times) / 1000
+
+
+def allocated(dev, func):
+    """Bytes allocated by func(), the gc.mem_alloc() difference with the collector disabled."""
+    tracemalloc.start()
+    dev.gc.disable()
+    base = dev.gc.mem_alloc()
+    func()
+    used = dev.gc.mem_alloc() - base
+    dev.gc.enable()
+    tracemalloc.stop()
+    return used
+
+
+def discard(*args, **kwargs):
+    """Stand-in for xbee.transmit() that keeps nothing."""
+
+
+def bench_file(dev, modem, path, rounds):
+    raw = device.telegrams(path)
+    totals = dict(telegrams=len(raw), size=0, crc=0, full=0, parse=0, p1=0, encode=0,
+                  crc_alloc=0, full_alloc=0, parse_alloc=0, encode_alloc=0, frames=0, payload=0)
+
+    for i, telegram in enumerate(raw):
+        # the first telegram follows the last one, as if the capture repeats
+        previous = raw[i - 1]
+
+        def frame():
+            return dev.p1_frame(telegram)
+
+        def full():
+            # every line is parsed, as for the first telegram
+            dev.P1_MEMO_LINES = 0
+            dev.process_p1(view)
+
+        def previous_parsed():
+            if dev.p1_frame(previous) is not None:
+                dev.process_p1(dev.P1_VIEW[:dev.P1_LENGTH])
+
+        def after_previous():
+            previous_parsed()
+            frame()
+
+        def parse():
+            dev.process_p1(view)
+
+        def p1():
+            # end to end, framing and crc and the parse after the previous telegram
+            dev.process_p1(frame())
+
+        def encode():
+            dev.report_reset()
+            dev.send_data()
+
+        view = frame()
+        if view is None:
+            print("%s: telegram failed CRC, skipped" % os.path.basename(path), file=sys.stderr)
+            totals["telegrams"] -= 1
+            continue
+        totals["size"] += len(telegram)
+        totals["crc"] += measure(frame, rounds)
+        totals["crc_alloc"] += allocated(dev, frame)
+        view = frame()
+        totals["full"] += measure(full, rounds)
+        totals["full_alloc"] += allocated(dev, full)
+        totals["parse"] += measure(parse, rounds, after_previous)
+        after_previous()
+        totals["parse_alloc"] += allocated(dev, parse)
+        totals["p1"] += measure(p1, rounds, previous_parsed)
+        full()
+        # the stub modem keeps a copy of every frame, that is not device code
+        modem.transmit = discard
+        totals["encode"] += measure(encode, rounds)
+        totals["encode_alloc"] += allocated(dev, encode)
+        del modem.transmit
+        del modem.transmits[:]
+        encode()
+        frames = modem.transmits
+        totals["frames"] += len(frames)
+        totals["payload"] += sum(len(f.payload) for f in frames)
+        del frames[:]
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="P1 captures, default tools/corpus/*.p1")
+    parser.add_argument("-n", "--rounds", type=int, default=200, help="runs per telegram and phase")
+    args = parser.parse_args(argv)
+
+    modem = xbee.Modem()
+    dev = device.load(modem=modem)
+    dev.MAX_PAYLOAD = modem.atcmd("NP")
+    files = args.files or sorted(glob.glob(CORPUS))
+    header = "%-22s %4s %6s | %8s %8s %8s %8s %8s | %7s %7s %7s %7s | %6s %7s" % (
+        "corpus", "tg", "bytes", "crc us", "full us", "parse us", "p1 us", "enc us", "crc B", "full B", "parse B", "enc B",
+        "frames", "payload")
+    print(header)
+    print("-" * len(header))
+    for path in files:
+        t = bench_file(dev, modem, path, args.rounds)
+        n = max(t["telegrams"], 1)
+        print("%-22s %4d %6d | %8.1f %8.1f %8.1f %8.1f %8.1f | %7d %7d %7d %7d | %6.1f %7.1f" % (
+            os.path.splitext(os.path.basename(path))[0][:22], t["telegrams"], t["size"] // n,
+            t["crc"] / n, t["full"] / n, t["parse"] / n, t["p1"] / n, t["encode"] / n,
+            t["crc_alloc"] // n, t["full_alloc"] // n, t["parse_alloc"] // n, t["encode_alloc"] // n,
+            t["frames"] / n, t["payload"] / n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Measure the time from boot to the first report under CPython.
+
+Loads src/main.py (module level tables and report frames), runs setup()
+and the scheduler with a telegram waiting on the P1 port until the first
+report is transmitted. Three cases: the modem is still joined after a reset
+(AI reads 0), configured by an earlier boot or not, and the modem joins
+``--join`` ms after boot. The AT writes setup() makes are counted.
+
+    python tools/boot.py
+    python tools/boot.py --join 2000 my.p1
+"""
+import argparse
+import os
+import time
+
+import device
+import xbee
+
+CORPUS = os.path.join(device.HERE, "corpus", "dsmr50_3phase.p1")
+
+
+def boot(telegram, joined, join_after, configured):
+    at = {"AI": 0 if joined else 0xFF}
+    if configured:
+        # what setup() writes, as a configured modem reads it back
+        at.update({"NI": "XBee P1", "AO": 0b00001110, "ID": 0, "ZS": 2, "NJ": 255, "JN": 1, "EO": 0x1B})
+    modem = xbee.Modem(at)
+    serial = device.Serial(chunk=64)
+    serial.feed(telegram)
+
+    start = time.perf_counter()
+    dev = device.load(modem=modem, serial=serial)
+    loaded = time.perf_counter()
+    dev.setup()
+    ready = time.perf_counter()
+    status_sent = joined
+    while not [f for f in modem.transmits if f.cluster != dev.CLUSTER_P1]:
+        now = time.perf_counter()
+        if not status_sent and (now - start) * 1000 >= join_after:
+            modem.simulate_status(2)
+            status_sent = True
+        if now - start > 10:
+            raise SystemExit("no report within 10 s")
+        wait = dev.run_once()
+        if wait > 0:
+            time.sleep(min(wait, 1) / 1000)
+    reported = time.perf_counter()
+    return dict(load=(loaded - start) * 1000, setup=(ready - loaded) * 1000,
+                report=(reported - start) * 1000, at_writes=len(modem.at_writes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file", nargs="?", default=CORPUS, help="P1 capture, the first telegram is used")
+    parser.add_argument("-j", "--join", type=int, default=1000, help="ms after boot the modem joins")
+    args = parser.parse_args(argv)
+
+    telegram = device.telegrams(args.file)[0]
+    print("%-22s %9s %9s %11s %9s" % ("case", "load ms", "setup ms", "report ms", "AT writes"))
+    for name, joined, configured in (
+            ("joined, configured", True, True),
+            ("joined, unconfigured", True, False),
+            ("joining, configured", False, True)):
+        t = boot(telegram, joined, args.join, configured)
+        print("%-22s %9.2f %9.2f %11.2f %9d" % (name, t["load"], t["setup"], t["report"], t["at_writes"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Decode ZCL report frames of the device in bulk into NumPy columns.
+
+The attribute map (endpoint, cluster, attribute id, type) and the scaling
+are taken from src/main.py itself: every attribute in its report frames is
+a column named after its RP_* variable (RP_L1_V -> "l1_v"), scaled with
+the multiplier and divisor main.py reports for it. Frames of the same
+layout are decoded together with array operations, so months of captures
+decode in seconds.
+
+Input files have one frame per line: time, endpoint, cluster and payload
+in hex, the format tools/replay.py prints. Frames with the same time (a
+report split over several frames) end up in the same row.
+
+With --format tshark the input is a sniffer capture exported by tshark,
+with the ZCL dissector disabled so the payload stays raw and filtered to
+the reports of the device (its network address, here 0x1a2b):
+
+    tshark -r sniff.pcapng --disable-protocol zbee_zcl -T fields \
+        -Y "zbee_nwk.src == 0x1a2b && zbee_aps.cluster" \
+        -e frame.time_epoch -e zbee_aps.src_ep -e zbee_aps.cluster -e data.data > frames.tsv
+
+Sniffed frames of one report arrive milliseconds apart, frames less than
+--merge seconds after the first frame of a row end up in that row.
+
+    python tools/decode.py frames.txt                # column summary
+    python tools/decode.py frames.txt -o frames.npz  # save the columns
+    python tools/decode.py -f tshark frames.tsv      # sniffer capture
+"""
+import argparse
+import collections
+import sys
+
+import numpy as np
+
+import device
+
+# signed zcl integer types
+SIGNED = range(0x28, 0x30)
+
+
+def rp_names(dev):
+    """RP_* variable name of every attribute list in main.py, by id()."""
+    return {id(value): name for name, value in vars(dev).items()
+            if name.startswith("RP_") and isinstance(value, list)}
+
+
+def scale_of(dev, endpoint, name):
+    """Factor main.py's multiplier and divisor attributes give the RP_* variable."""
+    if name.endswith("_MUL") or name.endswith("_DIV") or name in ("RP_PHASES",) or \
+            name.startswith("RP_DIAG") or name.endswith("_STATUS") or name.endswith("_UOM"):
+        return 1.0
+    if name.startswith("RP_GAS") or (name.startswith("RP_ENERGY") or name == "RP_DEMAND") and endpoint == 2:
+        return dev.RP_GAS_MUL[3] / dev.RP_GAS_DIV[3]
+    if name.startswith("RP_ENERGY") or name == "RP_DEMAND":
+        return dev.RP_ENERGY_MUL[3] / dev.RP_ENERGY_DIV[3]
+    if name.endswith("_V"):
+        return dev.RP_V_MUL[3] / dev.RP_V_DIV[3]
+    if name.endswith("_A"):
+        return dev.RP_A_MUL[3] / dev.RP_A_DIV[3]
+    if "_P" in name or "POWER" in name:
+        return dev.RP_P_MUL[3] / dev.RP_P_DIV[3]
+    return 1.0
+
+
+class AttributeMap:
+    """(endpoint, cluster, attribute) -> (column, type, size, scale) of main.py."""
+
+    def __init__(self, dev=None):
+        dev = dev or device.load()
+        names = rp_names(dev)
+        self.attributes = {}
+        self.columns = []
+        for endpoint, cluster, frame, members, header in dev.REPORT_FRAMES:
+            manufacturer = header == 5
+            for rp in members:
+                name = names.get(id(rp), "RP_%04X_%04X" % (cluster, rp[1]))
+                column = name[3:].lower()
+                if endpoint != 1 and not column.startswith("gas"):
+                    column = "%s_%d" % (column, endpoint)
+                self.attributes[(endpoint, cluster, rp[1], manufacturer)] = (
+                    column, rp[2], dev.TYPE_SIZE[rp[2]], scale_of(dev, endpoint, name))
+                self.columns.append(column)
+
+    def layout(self, endpoint, cluster, payload):
+        """Tuple of (offset, attribute key) of a report, None if it is no report."""
+        if len(payload) < 3:
+            return None
+        manufacturer = bool(payload[0] & 0x04)
+        n = 5 if manufacturer else 3 # manufacturer code
+        if payload[n - 1] != 0x0a:
+            return None
+        fields = []
+        while n + 3 <= len(payload):
+            key = (endpoint, cluster, payload[n] | (payload[n + 1] << 8), manufacturer)
+            entry = self.attributes.get(key)
+            if entry is None or payload[n + 2] != entry[1]:
+                return None # unknown to this version of main.py
+            fields.append((n + 3, key))
+            n += 3 + entry[2]
+        return tuple(fields)
+
+
+def decode(frames, attributes=None):
+    """Decode (time, endpoint, cluster, payload) tuples into columns.
+
+    Returns a dict with "time" (sorted unique times) and one float64 column
+    per attribute, NaN where a row did not report the attribute.
+    """
+    attributes = attributes or AttributeMap()
+    groups = collections.defaultdict(list)
+    times = []
+    skipped = 0
+    for time, endpoint, cluster, payload in frames:
+        layout = attributes.layout(endpoint, cluster, payload)
+        if not layout:
+            skipped += 1
+            continue
+        groups[(len(payload), layout)].append((len(times), payload))
+        times.append(time)
+
+    times = np.asarray(times, dtype=np.float64)
+    unique, row_of_frame = np.unique(times, return_inverse=True)
+    columns = {"time": unique}
+    for column in attributes.columns:
+        columns.setdefault(column, np.full(len(unique), np.nan))
+
+    for (length, layout), members in groups.items():
+        index = np.fromiter((i for i, _ in members), dtype=np.int64, count=len(members))
+        data = np.frombuffer(b"".join(p for _, p in members), dtype=np.uint8).reshape(len(members), length)
+        rows = row_of_frame[index]
+        for offset, key in layout:
+            column, dtype, size, scale = attributes.attributes[key]
+            raw = data[:, offset:offset + size].astype(np.int64)
+            value = (raw << (8 * np.arange(size, dtype=np.int64))).sum(axis=1)
+            if dtype in SIGNED:
+                value = np.where(value >= 1 << (8 * size - 1), value - (1 << (8 * size)), value)
+            columns[column][rows] = value * scale
+    columns["skipped"] = skipped
+    return columns
+
+
+def read_frames(path):
+    """Frames from a file with lines: time endpoint cluster(hex) payload(hex)."""
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 4 or line.startswith("#"):
+                continue
+            yield float(fields[0]), int(fields[1]), int(fields[2], 16), bytes.fromhex(fields[3])
+
+
+def read_tshark(path, merge=1.0):
+    """Frames from tshark fields: time_epoch, src_ep, cluster and data, tab or comma separated."""
+    row = None
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().replace(",", "\t").split("\t")
+            if len(fields) != 4 or not all(fields):
+                continue # not a data frame, e.g. a ZDO or APS ack
+            time = float(fields[0])
+            if row is None or not 0 <= time - row < merge:
+                row = time
+            yield row, int(fields[1], 0), int(fields[2], 0), bytes.fromhex(fields[3].replace(":", ""))
+
+
+READERS = {"replay": lambda path, merge: read_frames(path), "tshark": read_tshark}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="frame files, e.g. from tools/replay.py")
+    parser.add_argument("-f", "--format", choices=sorted(READERS), default="replay",
+                        help="input format, default the one tools/replay.py prints")
+    parser.add_argument("-m", "--merge", type=float, default=1.0,
+                        help="seconds within which tshark frames are one row, default 1")
+    parser.add_argument("-o", "--output", help="save the columns to this .npz file")
+    args = parser.parse_args(argv)
+
+    frames = []
+    for path in args.files:
+        frames.extend(READERS[args.format](path, args.merge))
+    columns = decode(frames)
+    skipped = columns.pop("skipped")
+    print("%d frames, %d rows, %d skipped" % (len(frames), len(columns["time"]), skipped))
+    for name, values in columns.items():
+        if name == "time":
+            continue
+        valid = values[~np.isnan(values)]
+        if len(valid):
+            print("%-16s %6d %14.3f %14.3f %14.3f" % (name, len(valid), valid.min(), valid.mean(), valid.max()))
+    if args.output:
+        np.savez(args.output, **columns)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Load the device code from src/main.py on CPython.
+
+The XBee3 specific modules (xbee, machine, utime, micropython) are
+replaced by the stand-ins in tools/stubs, the MicroPython gc functions
+by Heap. Importing main.py has no side
+effects, call ``setup()`` or ``main()`` on the returned module to run it.
+"""
+import gc
+import importlib.util
+import os
+import sys
+import tracemalloc
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUBS = os.path.join(HERE, "stubs")
+MAIN = os.path.join(HERE, os.pardir, "src", "main.py")
+
+# the stand-ins shadow nothing on CPython, import xbee etc. after importing this module
+if STUBS not in sys.path:
+    sys.path.insert(0, STUBS)
+
+
+class Serial:
+    """Non-blocking stand-in for the XBee3 sys.stdin.buffer carrying P1 data.
+
+    read() returns everything fed so far (at most ``chunk`` bytes) or None,
+    like the device does when the UART buffer is empty.
+    """
+
+    def __init__(self, chunk=None):
+        self.pending = bytearray()
+        self.chunk = chunk
+
+    def feed(self, data):
+        self.pending += data
+
+    def read(self, size=-1):
+        if not self.pending:
+            return None
+        n = len(self.pending)
+        if self.chunk:
+            n = min(n, self.chunk)
+        if size is not None and size >= 0:
+            n = min(n, size)
+        data = bytes(self.pending[:n])
+        del self.pending[:n]
+        return data
+
+
+class Heap:
+    """Stand-in for the MicroPython gc module.
+
+    mem_alloc() is what tracemalloc traces (0 when it is not running) and
+    mem_free() the rest of a heap of ``size`` bytes.
+    """
+
+    def __init__(self, size=1024 * 1024):
+        self.size = size
+        self.collects = 0
+        self.limit = -1
+
+    def collect(self):
+        self.collects += 1
+        gc.collect()
+
+    def mem_alloc(self):
+        if not tracemalloc.is_tracing():
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def mem_free(self):
+        return max(self.size - self.mem_alloc(), 0)
+
+    def threshold(self, amount=None):
+        if amount is None:
+            return self.limit
+        self.limit = amount
+
+    def enable(self):
+        gc.enable()
+
+    def disable(self):
+        gc.disable()
+
+
+def load(name="main", modem=None, serial=None):
+    """Return a fresh instance of main.py.
+
+    ``modem`` binds it to its own xbee.Modem, ``serial`` (a Serial) replaces
+    sys.stdin.buffer as the P1 input.
+    """
+    spec = importlib.util.spec_from_file_location(name, MAIN)
+    module = importlib.util.module_from_spec(spec)
+    if modem is not None:
+        # the module level code already talks to its own modem
+        import xbee
+        sys.modules["xbee"] = modem
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.modules["xbee"] = xbee
+    else:
+        spec.loader.exec_module(module)
+    module.gc = Heap()
+    if serial is not None:
+        module.sys = types.SimpleNamespace(
+            stdin=types.SimpleNamespace(buffer=serial), exit=sys.exit, print_exception=print)
+    return module
+
+
+def telegrams(path):
+    """Split a capture file into the raw telegrams it contains."""
+    with open(path, "rb") as f:
+        data = f.read()
+    out = []
+    start = data.find(b"/")
+    while start >= 0:
+        stop = data.find(b"!", start)
+        if stop < 0:
+            break
+        nxt = data.find(b"/", stop)
+        out.append(data[start:stop + 5])
+        start = nxt
+    return out
@@ -0,0 +1,335 @@
+"""Simulate a fleet of meters and a coordinator to load test the ZDO/ZCL stack.
+
+Every meter is its own instance of src/main.py (device.load) with its own
+stub modem and P1 input, all on one virtual clock, reading a telegram every
+``--interval`` ms. Frames between the meters and the coordinator go over a
+simulated radio channel: one shared medium of ``--rate`` kbit/s, a frame
+takes its airtime ``--hops`` times and frames that would wait longer than
+``--queue`` ms are dropped, so a large fleet congests the channel the way a
+busy mesh does.
+
+The coordinator interviews every meter when it joins, like zigbee2mqtt:
+active endpoints, the simple descriptor of every endpoint, the node
+descriptor, a read of the Basic cluster and a bind of the reported
+clusters, repeating a request after RETRY ms without an answer. Reports
+are acknowledged with a default response. Per fleet size it prints the
+interview time, the latency from a telegram arriving at a meter to its
+reports arriving at the coordinator, frames per second on air, how busy
+the channel was, the reports the meters counted as lost and their pace
+(see LINK_BACKOFF).
+
+    python tools/fleet.py                            # 1 to 300 meters
+    python tools/fleet.py -m 500 -d 300 --rate 40    # one size, slower channel
+"""
+import argparse
+import glob
+import heapq
+import itertools
+import os
+import random
+import sys
+import time
+
+import device
+import utime
+import xbee
+
+CORPUS = os.path.join(device.HERE, "corpus", "*.p1")
+# ms before the coordinator repeats an unanswered interview request, an
+# answer to any of the repeats counts
+RETRY = 10000
+# (endpoint, cluster) the coordinator binds, like zigbee2mqtt for a meter
+BINDS = ((1, 0x0702), (1, 0x0B04), (2, 0x0702))
+# Basic cluster attributes read in the interview: manufacturer, model, power source, zcl version
+BASIC = (0x0004, 0x0005, 0x0007, 0x0000)
+COORDINATOR_IEEE = bytes(range(0x10, 0x18))
+
+
+class Heap(device.Heap):
+    """Counts collections but leaves them to CPython, a fleet would spend the run collecting."""
+
+    def collect(self):
+        self.collects += 1
+
+
+class Channel:
+    """One shared radio channel, frames go on air one after the other.
+
+    overhead is what a frame takes on air besides the payload, AIR_OVERHEAD of main.py.
+    """
+
+    def __init__(self, rate, hops, queue, loss, rng, overhead):
+        self.rate = rate
+        self.hops = hops
+        self.queue = queue
+        self.loss = loss
+        self.rng = rng
+        self.overhead = overhead
+        self.free = 0.0
+        self.busy = 0.0
+        self.frames = 0
+        self.dropped = 0
+
+    def send(self, now, size):
+        """Time the frame arrives, None when it is dropped."""
+        start = max(now, self.free)
+        if start - now > self.queue:
+            self.dropped += 1
+            return None
+        # kbit/s is bits per ms
+        airtime = (size + self.overhead) * 8.0 / self.rate * self.hops
+        self.free = start + airtime
+        self.busy += airtime
+        self.frames += 1
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return None
+        return self.free
+
+
+class Meter:
+    """One instance of main.py with its own modem and P1 port."""
+
+    def __init__(self, index, telegrams):
+        self.index = index
+        self.eui = (0x0013A20041000000 + index).to_bytes(8, "big")
+        self.nwk = 0x1000 + index
+        self.modem = xbee.Modem({"AI": 0xFF, "SL": 0x41000000 + index, "MY": self.nwk})
+        self.serial = device.Serial(chunk=64)
+        self.dev = device.load("meter%d" % index, modem=self.modem, serial=self.serial)
+        self.dev.gc = Heap()
+        # main.py prints status changes, keep the output to the results
+        self.dev.print = lambda *args, **kwargs: None
+        self.dev.setup()
+        self.telegrams = telegrams
+        self.count = 0
+        self.fed = None
+        self.wake = None
+
+
+class Coordinator:
+    """Interviews the meters when they join and acknowledges their reports."""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.tsn = itertools.count()
+        # per meter: interview generator, started at, (tsns, profile, cluster, request) waited for
+        self.interviews = {}
+        self.interview_times = []
+        self.latencies = []
+        self.reports = 0
+        self.retries = 0
+
+    def interview(self, meter):
+        """Requests of the interview, (profile, cluster, endpoint, payload without tsn)."""
+        nwk = meter.nwk.to_bytes(2, "little")
+        response = yield (0x0000, 0x0005, 0, nwk)
+        for endpoint in response[5:5 + response[4]]:
+            yield (0x0000, 0x0004, 0, nwk + bytes([endpoint]))
+        yield (0x0000, 0x0002, 0, nwk)
+        yield (0x0104, 0x0000, 1, b"\x00" + b"".join(a.to_bytes(2, "little") for a in BASIC))
+        for endpoint, cluster in BINDS:
+            yield (0x0000, 0x0021, 0, meter.eui[::-1] + bytes([endpoint]) + cluster.to_bytes(2, "little") +
+                   b"\x03" + COORDINATOR_IEEE + b"\x01")
+
+    def joined(self, meter):
+        steps = self.interview(meter)
+        self.interviews[meter.index] = [steps, self.fleet.now, None]
+        self.next(meter, next(steps))
+
+    def next(self, meter, request):
+        profile, cluster, endpoint, body = request
+        tsn = next(self.tsn) & 0xFF
+        if profile == 0:
+            payload = bytes([tsn]) + body
+        else:
+            payload = bytes([0x00, tsn]) + body
+        state = self.interviews[meter.index]
+        if state[2] is not None and state[2][3] is request:
+            state[2][0].append(tsn)
+        else:
+            state[2] = ([tsn], profile, cluster, request)
+        self.fleet.to_meter(meter, payload, cluster, profile, endpoint)
+        self.fleet.at(self.fleet.now + RETRY, self.retry, meter, tsn)
+
+    def retry(self, meter, tsn):
+        state = self.interviews.get(meter.index)
+        if state is not None and state[2] is not None and state[2][0][-1] == tsn:
+            self.retries += 1
+            self.next(meter, state[2][3])
+
+    def answered(self, meter, frame):
+        state = self.interviews.get(meter.index)
+        if state is None or state[2] is None:
+            return False
+        tsns, profile, cluster, _ = state[2]
+        payload = frame.payload
+        if profile == 0:
+            match = frame.profile == 0 and frame.cluster == cluster | 0x8000 and payload[0] in tsns
+        else:
+            match = frame.profile == profile and frame.cluster == cluster and len(payload) > 2 and \
+                payload[1] in tsns and payload[2] == 0x01
+        if not match:
+            return False
+        try:
+            self.next(meter, state[0].send(payload))
+        except StopIteration:
+            self.interview_times.append(self.fleet.now - state[1])
+            del self.interviews[meter.index]
+        return True
+
+    def receive(self, meter, frame, fed):
+        if self.answered(meter, frame) or frame.profile != 0x0104 or len(frame.payload) < 3:
+            return
+        payload = frame.payload
+        command = payload[4] if payload[0] & 0x04 else payload[2]
+        if payload[0] & 0x03 or command != 0x0a:
+            return
+        self.reports += 1
+        if fed is not None:
+            self.latencies.append(self.fleet.now - fed)
+        if not payload[0] & 0x10:
+            # the default response is manufacturer specific like the report
+            header = payload[:3] if payload[0] & 0x04 else payload[:1]
+            self.fleet.to_meter(meter, bytes([0x18 | header[0]]) + header[1:] + bytes([payload[len(header)], 0x0b, 0x0a, 0x00]),
+                                frame.cluster, 0x0104, frame.source_ep)
+
+
+class Fleet:
+    """Meters, channel and coordinator on one virtual clock in ms."""
+
+    def __init__(self, meters, args, rng):
+        self.now = 0.0
+        self.events = []
+        self.order = itertools.count()
+        self.args = args
+        self.rng = rng
+        self.coordinator = Coordinator(self)
+        utime.CLOCK = 0
+        self.meters = [Meter(i, meters[i % len(meters)]) for i in range(args.meters)]
+        self.channel = Channel(args.rate, args.hops, args.queue, args.loss, rng, self.meters[0].dev.AIR_OVERHEAD)
+        for meter in self.meters:
+            self.at(rng.uniform(0, args.interval), self.telegram, meter)
+            self.at(rng.uniform(0, args.spread), self.join, meter)
+            self.schedule(meter, 0)
+
+    def at(self, when, action, *args):
+        heapq.heappush(self.events, (when, next(self.order), action, args))
+
+    def run(self, end):
+        while self.events and self.events[0][0] <= end:
+            when, _, action, args = heapq.heappop(self.events)
+            self.now = when
+            utime.CLOCK = int(when)
+            action(*args)
+
+    def schedule(self, meter, wait):
+        meter.wake = self.now + wait
+        self.at(meter.wake, self.wake, meter, meter.wake)
+
+    def wake(self, meter, when):
+        if meter.wake == when:
+            self.step(meter)
+
+    def step(self, meter):
+        # run the tasks until they all wait, then put the transmits on air
+        for _ in range(100):
+            wait = meter.dev.run_once()
+            if wait > 0:
+                break
+        for frame in meter.modem.transmits:
+            arrive = self.channel.send(self.now, len(frame.payload))
+            if arrive is not None:
+                self.at(arrive, self.coordinator.receive, meter, frame, meter.fed)
+        del meter.modem.transmits[:]
+        self.schedule(meter, max(wait, 1))
+
+    def telegram(self, meter):
+        meter.serial.feed(meter.telegrams[meter.count % len(meter.telegrams)])
+        meter.count += 1
+        meter.fed = self.now
+        self.at(self.now + self.args.interval, self.telegram, meter)
+
+    def join(self, meter):
+        meter.modem.simulate_status(2)
+        self.coordinator.joined(meter)
+        self.step(meter)
+
+    def to_meter(self, meter, payload, cluster, profile, endpoint):
+        arrive = self.channel.send(self.now, len(payload))
+        if arrive is not None:
+            self.at(arrive, self.deliver, meter, payload, cluster, profile, endpoint)
+
+    def deliver(self, meter, payload, cluster, profile, endpoint):
+        meter.modem.simulate_receive(payload, cluster, profile, source_ep=1 if endpoint else 0, dest_ep=endpoint,
+                                     sender=xbee.ADDR_COORDINATOR)
+        self.step(meter)
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q / 100.0 * len(values)), len(values) - 1)]
+
+
+def simulate(meters, args):
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    fleet = Fleet(meters, args, rng)
+    fleet.run(args.duration * 1000)
+    elapsed = time.perf_counter() - started
+    coordinator = fleet.coordinator
+    sent = sum(m.dev.LINK[m.dev.LINK_SENT] for m in fleet.meters)
+    lost = sum(m.dev.LINK[m.dev.LINK_LOST] for m in fleet.meters)
+    pace = sum(m.dev.LINK[m.dev.LINK_PACE] for m in fleet.meters) / 8.0 / len(fleet.meters)
+    return dict(
+        meters=args.meters,
+        interviewed=len(coordinator.interview_times),
+        interview_p50=percentile(coordinator.interview_times, 50),
+        interview_max=percentile(coordinator.interview_times, 100),
+        retries=coordinator.retries,
+        latency_p50=percentile(coordinator.latencies, 50),
+        latency_p90=percentile(coordinator.latencies, 90),
+        latency_p99=percentile(coordinator.latencies, 99),
+        reports=coordinator.reports,
+        frames=fleet.channel.frames / float(args.duration),
+        air=100.0 * min(fleet.channel.busy, args.duration * 1000) / (args.duration * 1000),
+        lost=100.0 * lost / sent if sent else 0.0,
+        pace=pace,
+        speed=args.duration / elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="P1 captures the meters read, default tools/corpus")
+    parser.add_argument("-m", "--meters", type=int, action="append",
+                        help="fleet size, can be repeated (default 1, 10, 50, 100, 300)")
+    parser.add_argument("-d", "--duration", type=int, default=120, help="simulated seconds")
+    parser.add_argument("-i", "--interval", type=int, default=1000, help="ms between telegrams")
+    parser.add_argument("-s", "--spread", type=int, default=10000, help="meters join within this many ms")
+    parser.add_argument("--rate", type=float, default=60, help="channel throughput in kbit/s")
+    parser.add_argument("--hops", type=int, default=2, help="hops from a meter to the coordinator")
+    parser.add_argument("--queue", type=int, default=2000, help="ms a frame may wait for the channel")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of frames lost on air")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random phases and losses")
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted(glob.glob(CORPUS))
+    meters = [device.telegrams(path) for path in files]
+    sizes = args.meters or [1, 10, 50, 100, 300]
+    print("%6s %11s %9s %9s %7s | %7s %7s %7s | %8s %6s %6s %5s | %6s" % (
+        "meters", "interviewed", "int p50", "int max", "retries", "lat p50", "lat p90", "lat p99",
+        "frames/s", "air %", "lost %", "pace", "sim x"))
+    for size in sizes:
+        args.meters = size
+        r = simulate(meters, args)
+        print("%6d %11d %9.0f %9.0f %7d | %7.0f %7.0f %7.0f | %8.1f %6.1f %6.1f %5.2f | %6.1f" % (
+            r["meters"], r["interviewed"], r["interview_p50"], r["interview_max"], r["retries"], r["latency_p50"],
+            r["latency_p90"], r["latency_p99"], r["frames"], r["air"], r["lost"], r["pace"], r["speed"]))
+        sys.stdout.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Download the history of the device and decode it.
+
+Every HISTORY_INTERVAL seconds the device keeps a sample of the average
+phase powers and the energy and gas used since the previous sample. The
+coordinator asks for a time range with command 0x02 of cluster 0xFC01
+(oldest and newest age in seconds) and the device answers with command 0x02
+frames, as many samples per frame as fit. Samples decodes those frames.
+
+The captures are replayed through src/main.py on a virtual clock, looped
+until ``--duration`` seconds of history are kept, then the range is
+requested and task_history() runs until the last frame. The samples are
+checked against the ones the device keeps and the frames, bytes and time
+on air of the download are printed.
+
+    python tools/history.py tools/corpus/*.p1
+    python tools/history.py capture.p1 --oldest 3600 --newest 600 -v
+"""
+import argparse
+import sys
+
+import device # puts the stand-in utime on sys.path
+import utime
+from replay import Replay
+
+COLUMNS = ("l1_p", "l2_p", "l3_p", "energy_in", "energy_out", "gas")
+
+
+class Samples:
+    """Feed history frames, collect (age in seconds, values) oldest first, None if unknown."""
+
+    def __init__(self):
+        self.samples = []
+        self.frames = 0
+        self.frame_bytes = 0
+        self.done = False
+
+    def feed(self, payload):
+        """Add one frame (ZCL payload of cluster 0xFC01), returns True after the last one."""
+        if len(payload) < 11 or payload[0] & 0x04 == 0 or payload[4] != 0x02:
+            return False
+        self.frames += 1
+        self.frame_bytes += len(payload)
+        age = int.from_bytes(payload[7:11], "little")
+        size = 2 + 2 * len(COLUMNS)
+        for n in range(11, len(payload) - size + 1, size):
+            age -= int.from_bytes(payload[n:n + 2], "little")
+            values = []
+            for i in range(n + 2, n + size, 2):
+                value = int.from_bytes(payload[i:i + 2], "little")
+                values.append(None if value == 0xFFFF else value)
+            self.samples.append((age, tuple(values)))
+        self.done = bool(payload[6] & 0x80)
+        return self.done
+
+
+def request(dev, oldest, newest, sequence=0):
+    """Command 0x02 frame asking for the samples between two ages."""
+    return (bytes([0x05, dev.MANUFACTURER_CODE & 0xFF, dev.MANUFACTURER_CODE >> 8, sequence, 0x02]) +
+            oldest.to_bytes(4, "little") + newest.to_bytes(4, "little"))
+
+
+def download(replay, oldest, newest):
+    """Request a range and run task_history() until its last frame, returns the Samples and the ms it took."""
+    dev = replay.dev
+    modem = replay.modem
+    del modem.transmits[:]
+    modem.receive_callback(dev.callback_receive)
+    modem.simulate_receive(request(dev, oldest, newest), dev.CLUSTER_P1, 0x0104)
+    task = dev.task_history()
+    samples = Samples()
+    elapsed = 0
+    while not samples.done:
+        wait = next(task)
+        if not isinstance(wait, int):
+            break
+        for f in modem.transmits:
+            if f.cluster == dev.CLUSTER_P1:
+                samples.feed(f.payload)
+        del modem.transmits[:]
+        if not samples.done:
+            elapsed += wait
+    return samples, elapsed
+
+
+def kept(dev, oldest, newest):
+    """(age, values) of the samples the device keeps in the range, oldest first."""
+    now = utime.time()
+    out = []
+    for j in range(dev.HISTORY_STATE[1]):
+        k = (dev.HISTORY_STATE[0] + j) % dev.HISTORY_SIZE
+        age = now - dev.HISTORY_TIME[k]
+        if newest <= age <= oldest:
+            values = dev.HISTORY[k * dev.HISTORY_RECORD:(k + 1) * dev.HISTORY_RECORD]
+            out.append((age, tuple(None if v == 0xFFFF else v for v in values)))
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="raw P1 captures, looped to build the history")
+    parser.add_argument("-i", "--interval", type=int, default=1000, help="ms between telegrams")
+    parser.add_argument("-d", "--duration", type=int, help="seconds of history, default all the device keeps")
+    parser.add_argument("-p", "--payload", type=int, help="maximum payload, default the stub NP")
+    parser.add_argument("--oldest", type=int, help="age in seconds of the oldest sample wanted, default all")
+    parser.add_argument("--newest", type=int, default=0, help="age in seconds of the newest sample wanted")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the samples")
+    args = parser.parse_args(argv)
+
+    data = b""
+    for path in args.files:
+        with open(path, "rb") as f:
+            data += f.read()
+
+    replay = Replay(interval=args.interval, payload=args.payload)
+    dev = replay.dev
+    duration = args.duration or dev.HISTORY_SIZE * dev.HISTORY_INTERVAL
+    while utime.CLOCK < duration * 1000:
+        replay.run(data)
+    oldest = duration if args.oldest is None else args.oldest
+
+    samples, elapsed = download(replay, oldest, args.newest)
+    if args.verbose:
+        print("%8s %s" % ("age s", " ".join("%10s" % c for c in COLUMNS)))
+        for age, values in samples.samples:
+            print("%8d %s" % (age, " ".join("%10s" % ("-" if v is None else v) for v in values)))
+    ok = samples.samples == kept(dev, oldest, args.newest)
+    air = (samples.frame_bytes + samples.frames * dev.AIR_OVERHEAD) // 125 * 4
+    print("%d samples, %d frames, %d bytes, %d ms on air, %d ms to download, %s" % (
+        len(samples.samples), samples.frames, samples.frame_bytes, air, elapsed,
+        "matches the device" if ok else "DIFFERS from the device"), file=sys.stderr)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""Rebuild the raw telegrams from the P1 data cluster passthrough frames.
+
+With PASSTHROUGH the device sends every telegram (at most every
+PASSTHROUGH_INTERVAL seconds) as command 0x01 of cluster 0xFC01, encoded
+as changes to the previously sent telegram and split over several
+frames. Telegram reassembles and decodes them, every telegram is checked
+with the CRC code of src/main.py.
+
+    python tools/replay.py capture.p1 --passthrough > frames.txt
+    python tools/passthrough.py frames.txt -o telegrams.p1
+"""
+import argparse
+import sys
+
+import device
+
+
+
+def lines_of(telegram, count):
+    """Start and end of the lines of a telegram, split like p1_store() does."""
+    starts = [0]
+    for i, c in enumerate(telegram):
+        if len(starts) == count:
+            break
+        if c == 10:
+            starts.append(i + 1)
+    ends = starts[1:] + [len(telegram)]
+    return list(zip(starts, ends))
+
+
+class Telegrams:
+    """Feed passthrough frames, collect the telegrams and count the bytes."""
+
+    def __init__(self, dev=None):
+        self.dev = dev or device.load()
+        self.telegrams = []
+        self.previous = None
+        self.sequence = None
+        self.fragments = []
+        self.frame_bytes = 0
+        self.lost = 0
+        self.crc_errors = 0
+
+    def feed(self, payload):
+        """Add one frame (ZCL payload of cluster 0xFC01), returns a telegram when one is complete."""
+        if len(payload) < 7 or payload[0] & 0x04 == 0 or payload[4] != 0x01:
+            return None
+        self.frame_bytes += len(payload)
+        sequence, index = payload[5], payload[6]
+        if index & 0x7F == 0:
+            self.sequence = sequence
+            self.fragments = []
+        elif sequence != self.sequence or index & 0x7F != len(self.fragments):
+            # a fragment went missing, wait for the next first fragment
+            self.sequence = None
+            return None
+        self.fragments.append(bytes(payload[7:]))
+        if not index & 0x80:
+            return None
+        self.sequence = None
+        return self.decode(b"".join(self.fragments))
+
+    def decode(self, data):
+        kind, count = data[0], data[2]
+        if kind == 0:
+            telegram = data[3:]
+        elif self.previous is None:
+            # changes to a telegram we do not have
+            self.lost += 1
+            return None
+        else:
+            previous = self.previous
+            changed = data[3:3 + (count + 7) // 8]
+            n = 3 + len(changed)
+            telegram = bytearray()
+            for k, (a, b) in enumerate(lines_of(previous, count)):
+                if not changed[k >> 3] & (1 << (k & 7)):
+                    telegram += previous[a:b]
+                    continue
+                same, end, middle = data[n], data[n + 1], data[n + 2]
+                n += 3
+                telegram += previous[a:a + same] + data[n:n + middle] + previous[b - end:b]
+                n += middle
+            telegram = bytes(telegram)
+        stop = telegram.rfind(b"!")
+        if stop < 0 or "%04X" % self.dev.crc16(telegram[:stop + 1]) != telegram[stop + 1:stop + 5].decode("ascii", "replace").upper():
+            self.crc_errors += 1
+            self.previous = None
+            return None
+        self.previous = telegram
+        self.telegrams.append(telegram)
+        return telegram
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="frame files as tools/replay.py prints them")
+    parser.add_argument("-o", "--output", help="write the telegrams to this file")
+    args = parser.parse_args(argv)
+
+    decoder = Telegrams()
+    for path in args.files:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 4 and int(fields[2], 16) == decoder.dev.CLUSTER_P1:
+                    decoder.feed(bytes.fromhex(fields[3]))
+    raw = sum(len(t) for t in decoder.telegrams)
+    print("%d telegrams, %d bytes, %d bytes in frames (%.1f%%), %d lost, %d crc errors" % (
+        len(decoder.telegrams), raw, decoder.frame_bytes,
+        100.0 * decoder.frame_bytes / raw if raw else 0, decoder.lost, decoder.crc_errors))
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(b"\r\n".join(decoder.telegrams) + b"\r\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
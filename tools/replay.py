@@ -0,0 +1,126 @@
+"""Replay raw P1 captures through the device code and check the ZCL frames.
+
+The capture is fed in chunks, as the UART delivers it, to the real framing
+and CRC (p1_feed), process_p1 and send_data/zcl_send_report of src/main.py.
+Noise, partial telegrams and CRC failures are handled like on the device.
+Transmits go to a stub modem and time runs on a virtual clock that moves
+``--interval`` ms per telegram, so the output only depends on the capture.
+
+    python tools/replay.py capture.p1                      # print the frames
+    python tools/replay.py capture.p1 --record golden.txt  # write a golden file
+    python tools/replay.py capture.p1 --golden golden.txt  # diff against it
+    python tools/replay.py days.p1 --throughput            # telegrams/s
+
+Golden files have one frame per line: telegram number, endpoint, cluster
+and the payload in hex. The exit status is 1 when the frames differ.
+"""
+import argparse
+import collections
+import difflib
+import sys
+import time
+
+import device
+import utime
+import xbee
+
+
+class Replay:
+    """One device instance replaying captures on a virtual clock."""
+
+    def __init__(self, chunk=64, interval=1000, payload=None, passthrough=False):
+        self.chunk = chunk
+        self.interval = interval
+        utime.CLOCK = 0
+        self.modem = xbee.Modem()
+        self.dev = device.load(modem=self.modem)
+        self.dev.MAX_PAYLOAD = payload or self.modem.atcmd("NP")
+        self.dev.STATUS = 2
+        self.dev.PASSTHROUGH = passthrough
+        # count the device's own trace events instead of recording them
+        self.events = collections.Counter()
+        self.dev.TRACE = 1
+        self.dev.trace_setup()
+        self.dev.trace = self.trace
+        self.telegrams = 0
+
+    def trace(self, event, argument=0):
+        self.events[self.dev.TRACE_NAMES[event]] += 1
+
+    def run(self, data, frames=None):
+        """Feed data, append (telegram, endpoint, cluster, payload) of every transmit to frames."""
+        dev = self.dev
+        transmits = self.modem.transmits
+        for start in range(0, len(data), self.chunk):
+            chars = data[start:start + self.chunk]
+            while chars and dev.p1_feed(chars):
+                # like task_p1, the rest of the read is fed after parsing
+                chars = chars[dev.P1_NEXT:]
+                self.telegrams += 1
+                utime.CLOCK += self.interval
+                dev.process_p1(dev.P1_VIEW[:dev.P1_LENGTH])
+                dev.send_data()
+                if frames is not None:
+                    for f in transmits:
+                        frames.append((self.telegrams, f.source_ep, f.cluster, f.payload))
+                del transmits[:]
+
+
+def format_frames(frames):
+    return ["%d %d %04X %s" % (n, endpoint, cluster, payload.hex()) for n, endpoint, cluster, payload in frames]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="raw P1 captures, replayed one after the other")
+    parser.add_argument("-c", "--chunk", type=int, default=64, help="bytes per UART read")
+    parser.add_argument("-i", "--interval", type=int, default=1000, help="ms between telegrams")
+    parser.add_argument("-p", "--payload", type=int, help="maximum payload, default the stub NP")
+    parser.add_argument("--passthrough", action="store_true",
+                        help="also send the telegrams in the P1 data cluster (PASSTHROUGH)")
+    parser.add_argument("-g", "--golden", help="compare the frames with this golden file")
+    parser.add_argument("-r", "--record", help="write the frames to this golden file")
+    parser.add_argument("-t", "--throughput", action="store_true",
+                        help="only measure telegrams per second")
+    parser.add_argument("-n", "--rounds", type=int, default=1, help="replays in throughput mode")
+    args = parser.parse_args(argv)
+
+    data = b""
+    for path in args.files:
+        with open(path, "rb") as f:
+            data += f.read()
+
+    replay = Replay(args.chunk, args.interval, args.payload, args.passthrough)
+    if args.throughput:
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            replay.run(data)
+        elapsed = time.perf_counter() - start
+        print("%d telegrams, %d bytes in %.3f s: %.1f telegrams/s, %.1f kB/s" % (
+            replay.telegrams, len(data) * args.rounds, elapsed,
+            replay.telegrams / elapsed, len(data) * args.rounds / elapsed / 1000))
+        return 0
+
+    frames = []
+    replay.run(data, frames)
+    lines = format_frames(frames)
+    print("%d telegrams, %d frames, %d bytes, %d crc failures" % (
+        replay.telegrams, len(frames), sum(len(f[3]) for f in frames), replay.events["crc fail"]), file=sys.stderr)
+    if args.record:
+        with open(args.record, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    if args.golden:
+        with open(args.golden) as f:
+            golden = f.read().splitlines()
+        diff = list(difflib.unified_diff(golden, lines, args.golden, "replay", lineterm=""))
+        for line in diff:
+            print(line)
+        return 1 if diff else 0
+    if not args.record:
+        for line in lines:
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
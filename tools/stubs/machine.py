@@ -0,0 +1,41 @@
+# Stand-in for the MicroPython machine module so src/main.py runs on CPython.
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    class board:
+        pass
+
+    def __init__(self, pin, mode=-1, pull=None, value=None):
+        self.pin = pin
+        self.mode = mode
+        self._value = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self._value = value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = int(value)
+
+    __call__ = value
+
+
+for _n in range(20):
+    setattr(Pin.board, "D%d" % _n, "D%d" % _n)
+
+RESETS = 0
+
+
+def reset():
+    global RESETS
+    RESETS += 1
+    raise SystemExit("machine.reset()")
+
+
+def unique_id():
+    return b"\x00\x13\xa2\x00\x41\xb2\xc3\xd4"
@@ -0,0 +1,21 @@
+# Stand-in for the MicroPython micropython module so src/main.py runs on CPython.
+
+
+def const(value):
+    return value
+
+
+def kbd_intr(char):
+    pass
+
+
+def opt_level(level=None):
+    return 0
+
+
+def mem_info(verbose=False):
+    pass
+
+
+def schedule(func, arg):
+    func(arg)
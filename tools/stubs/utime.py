@@ -0,0 +1,43 @@
+# Stand-in for the MicroPython utime module so src/main.py runs on CPython.
+import time as _time
+
+# set to a time in ms to run on a virtual clock instead of the real one
+CLOCK = None
+
+
+def ticks_ms():
+    if CLOCK is not None:
+        return CLOCK
+    return int(_time.monotonic() * 1000)
+
+
+def ticks_us():
+    if CLOCK is not None:
+        return CLOCK * 1000
+    return int(_time.monotonic() * 1000000)
+
+
+def ticks_diff(new, old):
+    return new - old
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+
+def sleep(s):
+    _time.sleep(s)
+
+
+def time():
+    if CLOCK is not None:
+        return CLOCK // 1000
+    return int(_time.time())
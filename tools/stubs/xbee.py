@@ -0,0 +1,90 @@
+# Stand-in for the XBee3 xbee module so src/main.py runs on CPython.
+# Transmitted frames are recorded, modem status and received frames are
+# injected with simulate_status() and simulate_receive().
+from collections import namedtuple
+
+ADDR_BROADCAST = b"\x00\x00\x00\x00\x00\x00\xff\xff"
+ADDR_COORDINATOR = b"\x00\x00\x00\x00\x00\x00\x00\x00"
+
+Frame = namedtuple("Frame", "dest payload source_ep dest_ep cluster profile")
+
+# AT parameters as a freshly joined XBee3 reports them
+DEFAULT_AT = {
+    "NI": " ",
+    "AO": 0,
+    "ID": 0,
+    "ZS": 0,
+    "NJ": 254,
+    "JN": 0,
+    "EO": 0,
+    "NP": 82,
+    "AI": 0,
+    "MY": 0x1234,
+    "SH": 0x0013A200,
+    "SL": 0x41B2C3D4,
+}
+
+
+class ModemStatus:
+    def __init__(self):
+        self.handler = None
+
+    def callback(self, handler):
+        self.handler = handler
+
+
+class Modem:
+    # one simulated radio, the module level functions below use DEFAULT
+
+    def __init__(self, at=None):
+        self.at = dict(DEFAULT_AT)
+        if at:
+            self.at.update(at)
+        self.transmits = []
+        self.at_writes = []
+        self.fail = None
+        self.modem_status = ModemStatus()
+        self.receive_handler = None
+        self.ADDR_BROADCAST = ADDR_BROADCAST
+        self.ADDR_COORDINATOR = ADDR_COORDINATOR
+
+    def transmit(self, dest, payload, source_ep=0xE8, dest_ep=0xE8, cluster=0x11, profile=0xC105,
+                 bcast_radius=0, tx_options=0):
+        if self.fail is not None:
+            raise self.fail
+        self.transmits.append(Frame(bytes(dest), bytes(payload), source_ep, dest_ep, cluster, profile))
+
+    def atcmd(self, cmd, value=None):
+        if value is None:
+            return self.at.get(cmd)
+        self.at_writes.append((cmd, value))
+        self.at[cmd] = value
+
+    def receive_callback(self, handler):
+        self.receive_handler = handler
+
+    def simulate_status(self, status):
+        if self.modem_status.handler is not None:
+            self.modem_status.handler(status)
+
+    def simulate_receive(self, payload, cluster, profile, source_ep=1, dest_ep=1,
+                         sender=ADDR_COORDINATOR, nwk=0):
+        self.receive_handler({
+            "sender_eui64": sender,
+            "sender_nwk": nwk,
+            "payload": bytes(payload),
+            "profile": profile,
+            "cluster": cluster,
+            "source_ep": source_ep,
+            "dest_ep": dest_ep,
+            "broadcast": False,
+        })
+
+
+DEFAULT = Modem()
+modem_status = DEFAULT.modem_status
+transmit = DEFAULT.transmit
+atcmd = DEFAULT.atcmd
+receive_callback = DEFAULT.receive_callback
+simulate_status = DEFAULT.simulate_status
+simulate_receive = DEFAULT.simulate_receive
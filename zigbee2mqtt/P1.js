@@ -6,19 +6,28 @@ const extend = require('zigbee-herdsman-converters/lib/extend');
 const e = exposes.presets;
 const ea = exposes.access;
 
+// multipliers and divisors can arrive in an earlier report than the values
+// (reports are split to fit the payload size), fall back to the stored value
+const attrOrStored = (msg, name) => {
+    if (msg.data.hasOwnProperty(name)) {
+        return msg.data[name];
+    }
+    return msg.endpoint.getClusterAttributeValue(msg.cluster, name);
+};
+
 const fzLocal = {
     conspunit: {
         cluster: 'haElectricalMeasurement',
         type: ['attributeReport', 'readResponse'],
         convert: async (model, msg, publish, options, meta) => {
             const attr = msg.data;
-            const powerDivisor = attr['powerDivisor'];
-            const powerMultiplier = attr['powerMultiplier'];
-            const measurementType = attr['measurementType'];
-            const acVoltageMultiplier = attr['acVoltageMultiplier'];
-            const acVoltageDivisor = attr['acVoltageDivisor'];
-            const acCurrentMultiplier = attr['acCurrentMultiplier'];
-            const acCurrentDivisor = attr['acCurrentDivisor'];
+            const powerDivisor = attrOrStored(msg, 'powerDivisor');
+            const powerMultiplier = attrOrStored(msg, 'powerMultiplier');
+            const measurementType = attrOrStored(msg, 'measurementType');
+            const acVoltageMultiplier = attrOrStored(msg, 'acVoltageMultiplier');
+            const acVoltageDivisor = attrOrStored(msg, 'acVoltageDivisor');
+            const acCurrentMultiplier = attrOrStored(msg, 'acCurrentMultiplier');
+            const acCurrentDivisor = attrOrStored(msg, 'acCurrentDivisor');
             const ret = {};
             var P1 = "";
 
@@ -55,6 +64,27 @@ const fzLocal = {
             if (attr.hasOwnProperty('rmsVoltagePhC')) {
                 ret['current_c'] = attr['rmsCurrentPhC'] * acCurrentMultiplier / acCurrentDivisor;
             }
+            // active power over the last window, mean and average (time weighted) are not
+            // zcl attributes and arrive under their attribute id
+            const windowAttributes = [
+                ['', 'activePowerMin', 'activePowerMax', '1520', '1521'],
+                ['_b', 'activePowerMinPhB', 'activePowerMaxPhB', '2544', '2545'],
+                ['_c', 'activePowerMinPhC', 'activePowerMaxPhC', '2800', '2801'],
+            ];
+            for (const [phase, min, max, mean, avg] of windowAttributes) {
+                if (attr.hasOwnProperty(min)) {
+                    ret['power_min' + phase] = attr[min] * powerMultiplier / powerDivisor;
+                }
+                if (attr.hasOwnProperty(max)) {
+                    ret['power_max' + phase] = attr[max] * powerMultiplier / powerDivisor;
+                }
+                if (attr.hasOwnProperty(mean)) {
+                    ret['power_mean' + phase] = attr[mean] * powerMultiplier / powerDivisor;
+                }
+                if (attr.hasOwnProperty(avg)) {
+                    ret['power_avg' + phase] = attr[avg] * powerMultiplier / powerDivisor;
+                }
+            }
             const state = meta['state']
             var P1 = (state['energy_t1'] * 1000).toString() + ";" + (state['energy_t2'] * 1000).toString() + ";" + (state['energy_t1_return'] * 1000).toString() + ";" + (state['energy_t2_return'] * 1000).toString() + ";" + p1power.toString() + ";0";
             console.log(meta);
@@ -67,8 +97,8 @@ const fzLocal = {
         type: ['attributeReport'],
         convert: async (model, msg, publish, options, meta) => {
             const attr = msg.data;
-            const powerDivisor = attr['divisor'];
-            const powerMultiplier = attr['multiplier'];
+            const powerDivisor = attrOrStored(msg, 'divisor');
+            const powerMultiplier = attrOrStored(msg, 'multiplier');
             const ret = {};
             const state = meta['state'];
             var et1 = 0, et2 = 0, et1r = 0, et2r = 0;
@@ -79,6 +109,9 @@ const fzLocal = {
             if (attr.hasOwnProperty('currentSummDelivered') && msg.endpoint.ID == 2) {
                 ret['gas'] = attr['currentSummDelivered'][1] * powerMultiplier / powerDivisor;
             }
+            if (attr.hasOwnProperty('instantaneousDemand') && msg.endpoint.ID == 1) {
+                ret['power_demand'] = attr['instantaneousDemand'] * powerMultiplier / powerDivisor;
+            }
             if (attr.hasOwnProperty('currentTier1SummDelivered') && msg.endpoint.ID == 1) {
                 ret['energy_t1'] = attr['currentTier1SummDelivered'][1] * powerMultiplier / powerDivisor;
                 et1 = ret['energy_t1'];
@@ -122,8 +155,15 @@ const definition = {
         e.energy(),
         exposes.numeric('power_total', ea.STATE).withDescription("Instantaneous measured power (combined)").withUnit("W"),
         e.power(),
+        exposes.numeric('power_demand', ea.STATE).withDescription("Instantaneous demand (from grid minus to grid)").withUnit("kW"),
         exposes.numeric('power_b', ea.STATE).withDescription("Instantaneous measured power (phase B)").withUnit("W"),
         exposes.numeric('power_c', ea.STATE).withDescription("Instantaneous measured power (phase C)").withUnit("W"),
+        ...['', '_b', '_c'].flatMap((phase) => [
+            exposes.numeric('power_min' + phase, ea.STATE).withDescription("Minimum power over the last window" + phase).withUnit("W"),
+            exposes.numeric('power_max' + phase, ea.STATE).withDescription("Maximum power over the last window" + phase).withUnit("W"),
+            exposes.numeric('power_mean' + phase, ea.STATE).withDescription("Mean power of the telegrams in the last window" + phase).withUnit("W"),
+            exposes.numeric('power_avg' + phase, ea.STATE).withDescription("Time weighted average power over the last window" + phase).withUnit("W"),
+        ]),
         //e.power_factor(),
         e.voltage(),
         exposes.numeric('voltage_b', ea.STATE).withDescription("Measured electrical potential value (phase B)").withUnit("V"),